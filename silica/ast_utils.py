@@ -31,6 +31,19 @@ def is_subscript(node):
     return isinstance(node, ast.Subscript)
 
 
+def get_index(subscript):
+    """
+    Returns the index expression of ``subscript``, or ``None`` if it is a
+    slice
+    """
+    index = subscript.slice
+    if isinstance(index, ast.Index):  # Python < 3.9
+        index = index.value
+    if isinstance(index, (ast.Slice, ast.ExtSlice)):
+        return None
+    return index
+
+
 def get_call_func(node):
     if is_name(node.func):
         return node.func.id
@@ -63,3 +76,20 @@ def get_outputs_from_func(tree):
                 raise NotImplementedError(type(_type))
             outputs.append((name, width))
     return outputs
+
+
+def get_inputs_from_func(tree):
+    """
+    Like ``get_outputs_from_func``, returns a list of (name, width) tuples
+    for each ``Bit`` or ``Array`` input
+    """
+    inputs = []
+    for arg in tree.args.args:
+        name = arg.arg
+        _type = eval(astor.to_source(arg.annotation), globals(), magma.__dict__)()
+        if _type.isinput():
+            if isinstance(_type, magma.ArrayType):
+                inputs.append((name, _type.N))
+            elif isinstance(_type, magma.BitType):
+                inputs.append((name, 1))
+    return inputs
@@ -1,2 +1,6 @@
-from silica.backend.python import PyFSM
+from silica.backend.python import PyFSM, PyFSMDefinition
 import silica.backend.magma
+import silica.backend.pysim
+import silica.backend.batch
+import silica.backend.netlist
+import silica.backend.c
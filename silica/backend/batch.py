@@ -0,0 +1,224 @@
+"""
+Simulates many independent instances of an FSM at once with NumPy
+
+``fsm("batch")`` returns a ``BatchFSMDefinition``, calling it with a number
+of instances returns a ``BatchFSM``.  ``yield_state``, the locals and the
+ports of all the instances are arrays of shape ``(instances, )``.  The
+generated step function evaluates the decision diagrams of the
+``ControlFlowGraph`` for every instance: each node gets a mask of the
+instances reaching it, decisions split the mask on their condition and
+assignments are applied with ``np.where``.
+
+Ports hold integers, so multi-bit ports are not converted to lists of bits.
+Values wrap at their widths as with ``pysim`` (see ``silica.backend.pysim``).
+"""
+import ast
+import os
+from copy import deepcopy
+from types import SimpleNamespace
+
+import astor
+import numpy as np
+
+from silica.code_gen import Source
+from silica.cfg.types import Step, Decision
+from silica.cfg.control_flow_graph import sort_transitions, \
+    collect_names_in_transitions
+from silica.cfg.infer_widths import infer_widths
+from silica.backend.python import get_io_vars, rewrite_io_vars
+from silica.backend.pysim import wrap, wrap_to
+from silica.ast_utils import get_index
+
+
+class BatchIO_:
+    """
+    A port of all the instances, ``value`` is an array of shape
+    ``(instances, )``.  Assigning a scalar sets it for every instance.
+    """
+    def __init__(self, instances, width=1):
+        self.width = width
+        self._value = np.zeros(instances, dtype=np.int64)
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        value = np.asarray(value, dtype=np.int64)
+        if self.width < 64:
+            value = value & ((1 << self.width) - 1)
+        self._value = np.broadcast_to(value, self._value.shape).copy()
+
+
+class BatchFSM:
+    """
+    Fields:
+        * ``self.IO`` - a ``BatchIO_`` for each argument
+        * ``self.state`` - a dict mapping ``"yield_state"`` and each local to
+          its array
+        * ``self.instances`` - the number of instances
+    """
+    def __init__(self, definition, instances):
+        self.definition = definition
+        self.instances = instances
+        self.IO = SimpleNamespace(**{
+            var.name: BatchIO_(instances, var.width)
+            for var in definition.io_vars})
+        self.state = {name: np.zeros(instances, dtype=np.int64)
+                      for name in ["yield_state"] + definition.local_vars}
+        self._ports = [getattr(self.IO, var.name)
+                       for var in definition.io_vars]
+        # Run until the first yield, as with ``PyFSM``
+        next(self)
+
+    def __next__(self):
+        self.definition.step(self.state, *self._ports)
+
+
+class BatchFSMDefinition:
+    """
+    Fields:
+        * ``self.io_vars`` - the ``IOVar`` of each argument
+        * ``self.local_vars`` - the names of the locals (sorted)
+        * ``self.step`` - the generated step function, runs one cycle of
+          every instance
+        * ``self.source`` - the source of the step function
+    """
+    def __init__(self, io_vars, local_vars, step, source):
+        self.io_vars = io_vars
+        self.local_vars = local_vars
+        self.step = step
+        self.source = source
+
+    def __call__(self, instances):
+        return BatchFSM(self, instances)
+
+
+def make_call(function, *args):
+    return ast.Call(ast.Attribute(ast.Name("_np", ast.Load()), function,
+                                  ast.Load()), list(args), [])
+
+
+def compile(cfg, local_vars, tree, func_globals, func_locals):
+    io_vars = get_io_vars(tree)
+    # Raises a ``TypeError`` for writes to inputs and reads from outputs, as
+    # with ``PyFSM``
+    rewrite_io_vars(deepcopy(tree), io_vars)
+    input_widths = {var.name: var.width for var in io_vars
+                    if var.typ == "Input"}
+    output_widths = {var.name: var.width for var in io_vars
+                     if var.typ == "Output"}
+    outputs = set(output_widths)
+    _, writes = collect_names_in_transitions(cfg.transitions)
+    declared = dict(local_vars)
+    local_vars = sorted(writes - outputs)
+    # Locals that are not bounded and not declared wrap as int64
+    widths = {name: width for name, width in infer_widths(
+        cfg.transitions, [(name, declared.get(name)) for name in local_vars],
+        sorted(input_widths.items()), default_width=64) if width < 64}
+    widths.update(input_widths)
+
+    def lower(node):
+        """
+        Replaces the operators that do not work element-wise on arrays
+        """
+        if isinstance(node, ast.Subscript) and \
+           isinstance(node.value, ast.Name) and \
+           input_widths.get(node.value.id, 1) > 1 and \
+           get_index(node) is not None:
+            # Multi-bit inputs are indexed MSB first, as with ``PyFSM``
+            width = input_widths[node.value.id]
+            shift = ast.BinOp(ast.Num(width - 1), ast.Sub(), get_index(node))
+            return ast.BinOp(ast.BinOp(node.value, ast.RShift(), shift),
+                             ast.BitAnd(), ast.Num(1))
+        elif isinstance(node, ast.BoolOp):
+            function = "logical_and" if isinstance(node.op, ast.And) \
+                else "logical_or"
+            result = node.values[0]
+            for value in node.values[1:]:
+                result = make_call(function, result, value)
+            return result
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return make_call("logical_not", node.operand)
+        elif isinstance(node, ast.Compare) and len(node.comparators) > 1:
+            # a < b < c -> a < b and b < c
+            lefts = [node.left] + node.comparators[:-1]
+            result = None
+            for left, op, right in zip(lefts, node.ops, node.comparators):
+                compare = ast.Compare(left, [op], [right])
+                result = compare if result is None else \
+                    make_call("logical_and", result, compare)
+            return result
+        elif isinstance(node, ast.IfExp):
+            return make_call("where", node.test, node.body, node.orelse)
+        return node
+
+    def emit_expr(tree):
+        # Indexes are lowered after wrapping, their shifts do not wrap
+        tree = cfg.expressions.fold(cfg.expressions.transform(tree, lower))
+        return astor.to_source(tree).rstrip()
+
+    source = Source()
+    masks = {}
+    incoming = {}
+    for yield_id, root in sorted(cfg.transitions.items()):
+        incoming.setdefault(root, []).append(
+            "(yield_state == {})".format(yield_id))
+
+    def emit_mask(node):
+        mask = "_m{}".format(len(masks))
+        masks[node] = mask
+        source.add_line("    {} = {}".format(mask,
+                                             " | ".join(incoming[node])))
+        return mask
+
+    params = ", ".join("_io_" + var.name for var in io_vars)
+    source.add_line("def step(_state, {}):".format(params))
+    for name in ["yield_state"] + local_vars:
+        source.add_line("    {0} = _next_{0} = _state[{0!r}]".format(name))
+    for name in sorted(input_widths):
+        source.add_line("    {0} = _io_{0}._value".format(name))
+    # Each node is visited after all of its predecessors, so its mask is
+    # the union of the masks of the edges reaching it
+    for node in sort_transitions(cfg.transitions):
+        mask = emit_mask(node)
+        if isinstance(node, Step):
+            for statement in node.statements:
+                if not isinstance(statement, ast.Assign) or \
+                   len(statement.targets) != 1 or \
+                   not isinstance(statement.targets[0], ast.Name):
+                    raise NotImplementedError(astor.to_source(statement))
+                name = statement.targets[0].id
+                value = emit_expr(wrap_to(
+                    cfg.expressions.fold(statement.value),
+                    output_widths.get(name, widths.get(name)), widths))
+                target = "_io_{}._value".format(name) if name in outputs \
+                    else "_next_" + name
+                source.add_line("    {0} = _np.where({1}, {2}, {0})".format(
+                    target, mask, value))
+            incoming.setdefault(node.next, []).append(mask)
+        elif isinstance(node, Decision):
+            cond = "_c{}".format(len(masks))
+            source.add_line("    {} = _np.asarray({}, dtype=bool)".format(
+                cond, emit_expr(wrap(cfg.expressions.fold(node.cond),
+                                     widths)[0])))
+            incoming.setdefault(node.true_edge, []).append(
+                "({} & {})".format(mask, cond))
+            incoming.setdefault(node.false_edge, []).append(
+                "({} & ~{})".format(mask, cond))
+        else:
+            source.add_line(
+                "    _next_yield_state = _np.where({}, {}, "
+                "_next_yield_state)".format(mask, node.end_yield_id))
+    for name in ["yield_state"] + local_vars:
+        source.add_line("    _state[{0!r}] = _next_{0}".format(name))
+    if int(os.environ.get("SILICA_DEBUG", "0")) >= 1:
+        print(source)
+
+    namespace = dict(func_globals)
+    namespace.update(func_locals)
+    namespace["_np"] = np
+    exec(str(source), namespace)
+    return BatchFSMDefinition(io_vars, local_vars, namespace["step"],
+                              str(source))
@@ -0,0 +1,538 @@
+"""
+Simulates an FSM with a C function compiled from its ``ControlFlowGraph``
+
+``fsm("c")`` generates a C function ``run(state, cycles, inputs, outputs)``
+executing the decision diagrams of the FSM (like ``pysim``) over a ``struct``
+holding ``yield_state``, the locals and the ports.  Each field is the
+smallest unsigned integer holding the inferred width of its variable (locals
+that are not bounded and not declared with ``Register(width)`` are signed 64
+bit integers).  The source is compiled with the system C compiler (``$CC``,
+``cc`` by default) to a shared library cached in ``$SILICA_CACHE_DIR``
+(``~/.cache/silica`` by default) and loaded with ``ctypes``.
+
+``run`` runs ``cycles`` cycles.  If ``inputs`` is not ``NULL``, it holds the
+inputs of each cycle (one row of ``int64_t`` per cycle, the inputs in the
+order of the arguments), otherwise the inputs keep the values in the
+``struct``.  If ``outputs`` is not ``NULL``, the outputs after each cycle are
+written to it the same way.  ``CFSM.run_buffers`` calls it with NumPy
+arrays, without copying them.
+
+As with ``pysim``, multi-bit inputs are indexed MSB first, assignments wrap
+at the width of the variable and arithmetic at the width of its widest
+operand.
+"""
+import ast
+import ctypes
+import hashlib
+import itertools
+import os
+import subprocess
+import tempfile
+from copy import deepcopy
+from types import SimpleNamespace
+
+import astor
+import numpy as np
+
+from silica.code_gen import Source
+from silica.types import Input_
+from silica.cfg.types import Step, Decision
+from silica.cfg.control_flow_graph import sort_transitions, find_joins, \
+    collect_names_in_transitions
+from silica.cfg.infer_widths import infer_widths
+from silica.backend.python import Simulation, Snapshot, get_io_vars, \
+    rewrite_io_vars, iterate_input, get_cycles
+from silica.backend.pysim import wrap, wrap_to
+from silica.ast_utils import get_index
+
+
+class CFSMDefinition:
+    """
+    Calling the definition returns a new independent ``CFSM``, like
+    ``PyFSMDefinition`` it forwards ``next`` and its other attributes to a
+    default instance.
+
+    Fields:
+        * ``self.io_vars`` - the ``IOVar`` of each argument
+        * ``self.clock_enable`` - whether instances have a ``CE`` input
+        * ``self.state_vars`` - a list of ``(name, width)`` for
+          ``yield_state`` and the locals
+        * ``self.State`` - the ``ctypes.Structure`` of the ``struct``
+        * ``self.library`` - the loaded shared library
+        * ``self.source`` - the C source
+        * ``self.instance`` - the default instance
+    """
+    def __init__(self, io_vars, clock_enable, state_vars, State, library,
+                 source):
+        self.io_vars = io_vars
+        self.clock_enable = clock_enable
+        self.state_vars = state_vars
+        self.State = State
+        self.library = library
+        self.source = source
+        self.inputs = [var for var in io_vars if var.typ == "Input"]
+        self.outputs = [var for var in io_vars if var.typ == "Output"]
+        self.function = library.run
+        self.function.argtypes = [ctypes.c_void_p, ctypes.c_int64,
+                                  ctypes.c_void_p, ctypes.c_void_p]
+        self.function.restype = None
+        self.instance = CFSM(self)
+
+    def __call__(self):
+        return CFSM(self)
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+    def __next__(self):
+        next(self.instance)
+
+
+class CFSM(Simulation):
+    """
+    An instance of a ``CFSMDefinition``.  The ``Input_`` and ``Output_``
+    containers in ``self.IO`` are copied to (and from) the ``struct`` when
+    the simulation is run.  As with ``PyFSM``, the first cycle is run when
+    the instance is created.
+    """
+    def __init__(self, definition):
+        self.definition = definition
+        self.IO = SimpleNamespace(**{var.name: var.get_container()
+                                     for var in definition.io_vars})
+        if definition.clock_enable:
+            self.IO.CE = Input_(1)
+            self.IO.CE.value = 1
+            self._slow = True
+        self._struct = definition.State()
+        self._pointer = ctypes.addressof(self._struct)
+        self._inputs = [(var.name, getattr(self.IO, var.name))
+                        for var in definition.inputs]
+        self._outputs = [(var.name, getattr(self.IO, var.name))
+                         for var in definition.outputs]
+        self._rows = None
+        self._run(1)
+
+    def __next__(self):
+        if self._slow:
+            self.run_until(1)
+        else:
+            self.cycle += 1
+            self._run(1)
+
+    def _run(self, cycles):
+        if cycles <= 0:
+            return
+        struct = self._struct
+        for name, port in self._inputs:
+            setattr(struct, name, port._value)
+        if self._rows is None:
+            self.definition.function(self._pointer, cycles, None, None)
+        else:
+            for _ in range(cycles):
+                self.definition.function(self._pointer, 1, None, None)
+                self._rows.extend(self._get_trace_row())
+        for name, port in self._outputs:
+            port._value = getattr(struct, name)
+
+    def run_buffers(self, cycles, inputs=None, outputs=None):
+        """
+        Runs ``cycles`` cycles with the inputs of each cycle in ``inputs``
+        (or the current inputs if ``None``) and writes the outputs after
+        each cycle to ``outputs`` (if not ``None``).  Both are C-contiguous
+        ``int64`` arrays with a row per cycle and a column per input
+        (output), in the order of the arguments.  Clock enables are ignored,
+        every cycle is enabled.
+        """
+        pointers = []
+        for buffer, ports in ((inputs, self._inputs),
+                              (outputs, self._outputs)):
+            if buffer is None:
+                pointers.append(None)
+                continue
+            if buffer.dtype != np.int64 or \
+               not buffer.flags["C_CONTIGUOUS"] or \
+               buffer.shape[0] < cycles or \
+               buffer.size != buffer.shape[0] * len(ports):
+                raise ValueError("Expected a C-contiguous int64 array of "
+                                 "shape ({}, {})".format(cycles, len(ports)))
+            pointers.append(buffer.ctypes.data)
+        if inputs is None:
+            for name, port in self._inputs:
+                setattr(self._struct, name, port._value)
+        self.definition.function(self._pointer, cycles, *pointers)
+        for name, port in self._inputs + self._outputs:
+            port._value = getattr(self._struct, name)
+        self.cycle += cycles
+
+    def run(self, inputs, cycles=None):
+        """
+        Like ``Simulation.run``, but runs all the cycles with one call to
+        the C function
+        """
+        if self._slow:
+            return super().run(inputs, cycles)
+        if cycles is None:
+            cycles = get_cycles(inputs)
+        columns = []
+        for name, port in self._inputs:
+            value = inputs.get(name, port._value)
+            if isinstance(value, int):
+                columns.append(value)
+                continue
+            if not isinstance(value, np.ndarray):
+                value = list(itertools.islice(iterate_input(value), cycles))
+            columns.append(np.asarray(value, dtype=np.int64))
+            cycles = min(cycles, len(columns[-1]))
+        buffer = np.empty((cycles, len(self._inputs)), dtype=np.int64)
+        for index, column in enumerate(columns):
+            buffer[:, index] = column if isinstance(column, int) else \
+                column[:cycles]
+        outputs = np.empty((cycles, len(self._outputs)), dtype=np.int64)
+        if cycles:
+            self.run_buffers(cycles, buffer, outputs)
+        return {name: outputs[:, index].copy()
+                for index, (name, _) in enumerate(self._outputs)}
+
+    def _get_trace_signals(self):
+        return list(self.definition.state_vars) + \
+            [(var.name, var.width) for var in self.definition.io_vars]
+
+    def _get_trace_row(self):
+        struct = self._struct
+        return [getattr(struct, name)
+                for name, _ in self.definition.state_vars] + \
+            [getattr(struct, var.name) for var in self.definition.io_vars]
+
+    def _set_tracing(self, tracer):
+        self._rows = None if tracer is None else tracer.rows
+
+    def snapshot(self):
+        """
+        Returns a ``Snapshot`` of the simulation
+        """
+        return Snapshot(
+            self.cycle,
+            {name: getattr(self._struct, name)
+             for name, _ in self.definition.state_vars},
+            {name: port._value for name, port in vars(self.IO).items()})
+
+    def restore(self, snapshot):
+        """
+        Sets the state of the simulation to ``snapshot``
+        """
+        for name, value in snapshot.state.items():
+            setattr(self._struct, name, value)
+        for name, value in snapshot.io.items():
+            port = getattr(self.IO, name)
+            port.value = value
+            if name != "CE":
+                setattr(self._struct, name, port._value)
+        self.cycle = snapshot.cycle
+
+
+binary_ops = {
+    ast.Add: "+",
+    ast.Sub: "-",
+    ast.Mult: "*",
+    ast.LShift: "<<",
+    ast.RShift: ">>",
+    ast.BitAnd: "&",
+    ast.BitOr: "|",
+    ast.BitXor: "^",
+}
+
+compare_ops = {
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+}
+
+# Python's ``//`` and ``%`` round towards negative infinity
+helpers = """\
+static inline int64_t floordiv(int64_t a, int64_t b) {
+    int64_t q = a / b;
+    return (a % b != 0 && (a < 0) != (b < 0)) ? q - 1 : q;
+}
+
+static inline int64_t floormod(int64_t a, int64_t b) {
+    int64_t r = a % b;
+    return (r != 0 && (r < 0) != (b < 0)) ? r + b : r;
+}"""
+
+
+def get_c_type(width):
+    """
+    Returns the C type of a field of ``width`` bits
+    """
+    for bits in (8, 16, 32):
+        if width <= bits:
+            return "uint{}_t".format(bits), getattr(ctypes,
+                                                    "c_uint{}".format(bits))
+    if width < 64:
+        return "uint64_t", ctypes.c_uint64
+    return "int64_t", ctypes.c_int64
+
+
+def emit_transition(source, node, stop, joins, indent, emit_statement,
+                    emit_expr):
+    """
+    Emits the decision diagram starting at ``node`` up to (but not including)
+    ``stop`` as nested ``if``/``else`` blocks, like the verilog backend
+    """
+    while node is not stop and node is not None:
+        if isinstance(node, Step):
+            for statement in node.statements:
+                source.add_line(indent + emit_statement(statement))
+            node = node.next
+        elif isinstance(node, Decision):
+            join = joins[node]
+            cond = emit_expr(node.cond)
+            true_edge, false_edge = node.true_edge, node.false_edge
+            if true_edge is join:
+                # Only the false edge does anything
+                cond = "!({})".format(cond)
+                true_edge, false_edge = false_edge, true_edge
+            source.add_line(indent + "if ({}) {{".format(cond))
+            emit_transition(source, true_edge, join, joins, indent + "    ",
+                            emit_statement, emit_expr)
+            if false_edge is not join:
+                source.add_line(indent + "} else {")
+                emit_transition(source, false_edge, join, joins,
+                                indent + "    ", emit_statement, emit_expr)
+            source.add_line(indent + "}")
+            node = join
+        else:
+            source.add_line(indent + "v_yield_state = {};".format(
+                node.end_yield_id))
+            break
+
+
+def get_cache_dir():
+    return os.environ.get("SILICA_CACHE_DIR", os.path.join(
+        os.path.expanduser("~"), ".cache", "silica"))
+
+
+def build_library(source):
+    """
+    Compiles ``source`` to a shared library, unless a library built from the
+    same source by the same compiler is already cached.
+
+    Returns the path of the library
+    """
+    command = [os.environ.get("CC", "cc"), "-O2", "-shared", "-fPIC"]
+    key = hashlib.sha256("\0".join(command + [source]).encode()).hexdigest()
+    cache_dir = get_cache_dir()
+    path = os.path.join(cache_dir, "silica_{}.so".format(key[:32]))
+    if os.path.exists(path):
+        return path
+    os.makedirs(cache_dir, exist_ok=True)
+    directory = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        c_file = os.path.join(directory, "fsm.c")
+        with open(c_file, "w") as f:
+            f.write(source)
+        library = os.path.join(directory, "fsm.so")
+        result = subprocess.run(command + ["-o", library, c_file],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        if result.returncode != 0:
+            raise RuntimeError("Compiling the FSM failed:\n{}".format(
+                result.stdout))
+        # Atomic, so concurrent builds of the same FSM do not conflict
+        os.replace(library, path)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    return path
+
+
+def compile(cfg, local_vars, tree, clock_enable, func_globals, func_locals):
+    io_vars = get_io_vars(tree)
+    # Raises a ``TypeError`` for writes to inputs and reads from outputs, as
+    # with ``PyFSM``
+    rewrite_io_vars(deepcopy(tree), io_vars)
+    input_widths = {var.name: var.width for var in io_vars
+                    if var.typ == "Input"}
+    output_widths = {var.name: var.width for var in io_vars
+                     if var.typ == "Output"}
+    _, writes = collect_names_in_transitions(cfg.transitions)
+    declared = dict(local_vars)
+    names = sorted(writes - set(output_widths))
+    widths = dict(infer_widths(
+        cfg.transitions, [(name, declared.get(name)) for name in names],
+        sorted(input_widths.items()), default_width=64))
+    widths["yield_state"] = max((len(cfg.transitions) - 1).bit_length(), 1)
+    widths.update(input_widths)
+    widths.update(output_widths)
+    state_vars = [("yield_state", widths["yield_state"])] + \
+        [(name, widths[name]) for name in names]
+
+    def lower(node):
+        """
+        Returns the C code for ``node`` and its width (``None`` if it is not
+        known)
+        """
+        if isinstance(node, ast.NameConstant):  # Python < 3.8
+            return str(int(node.value)), 1
+        elif isinstance(node, ast.Num):  # Python < 3.8
+            if not isinstance(node.n, int) or node.n >= 1 << 63:
+                raise NotImplementedError(astor.to_source(node).rstrip())
+            return "INT64_C({})".format(node.n), None
+        elif isinstance(node, ast.Name):
+            if node.id not in widths:
+                raise NotImplementedError(
+                    "Name {} is not a local or port".format(node.id))
+            return "v_" + node.id, widths[node.id]
+        elif isinstance(node, ast.BinOp):
+            left, left_width = lower(node.left)
+            right, right_width = lower(node.right)
+            if isinstance(node.op, ast.FloorDiv):
+                return "floordiv({}, {})".format(left, right), left_width
+            elif isinstance(node.op, ast.Mod):
+                return "floormod({}, {})".format(left, right), right_width
+            elif type(node.op) in compare_ops:
+                # ``desugar_for_loops`` builds comparisons as a ``BinOp``
+                return "({} {} {})".format(left, compare_ops[type(node.op)],
+                                           right), 1
+            elif type(node.op) not in binary_ops:
+                raise NotImplementedError(astor.to_source(node).rstrip())
+            width = None
+            if isinstance(node.op, (ast.BitAnd, ast.BitOr, ast.BitXor)) and \
+               left_width is not None and right_width is not None:
+                width = max(left_width, right_width)
+            return "({} {} {})".format(left, binary_ops[type(node.op)],
+                                       right), width
+        elif isinstance(node, ast.Compare):
+            terms = []
+            left, _ = lower(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                if type(op) not in compare_ops:
+                    raise NotImplementedError(astor.to_source(node).rstrip())
+                right, _ = lower(comparator)
+                terms.append("{} {} {}".format(left, compare_ops[type(op)],
+                                               right))
+                left = right
+            return "({})".format(" && ".join(terms)), 1
+        elif isinstance(node, ast.BoolOp):
+            op = " && " if isinstance(node.op, ast.And) else " || "
+            return "({})".format(op.join(lower(value)[0]
+                                         for value in node.values)), 1
+        elif isinstance(node, ast.UnaryOp):
+            operand, width = lower(node.operand)
+            if isinstance(node.op, ast.Not):
+                return "(!{})".format(operand), 1
+            elif isinstance(node.op, ast.USub):
+                return "(-{})".format(operand), None
+            elif isinstance(node.op, ast.Invert):
+                return "(~{})".format(operand), width
+        elif isinstance(node, ast.IfExp):
+            test, _ = lower(node.test)
+            body, body_width = lower(node.body)
+            orelse, orelse_width = lower(node.orelse)
+            width = max(body_width, orelse_width) \
+                if body_width is not None and orelse_width is not None \
+                else None
+            return "({} ? {} : {})".format(test, body, orelse), width
+        elif isinstance(node, ast.Subscript) and \
+                isinstance(node.value, ast.Name) and \
+                node.value.id in input_widths and \
+                get_index(node) is not None:
+            # Multi-bit inputs are indexed MSB first, as with ``PyFSM``
+            value, width = lower(node.value)
+            index, _ = lower(get_index(node))
+            return "(({} >> ({} - {})) & 1)".format(value, width - 1,
+                                                    index), 1
+        raise NotImplementedError(astor.to_source(node).rstrip())
+
+    # The 64 bit locals wrap as ``int64_t``
+    wrapped_widths = {name: width for name, width in widths.items()
+                      if width < 64}
+
+    def emit_expr(tree):
+        return lower(wrap(cfg.expressions.fold(tree), wrapped_widths)[0])[0]
+
+    def emit_statement(statement):
+        statement = cfg.expressions.fold(statement)
+        if not isinstance(statement, ast.Assign) or \
+           len(statement.targets) != 1 or \
+           not isinstance(statement.targets[0], ast.Name):
+            raise NotImplementedError(astor.to_source(statement).rstrip())
+        name = statement.targets[0].id
+        value = lower(wrap_to(statement.value, wrapped_widths.get(name),
+                              wrapped_widths))[0]
+        target = "_next_" + name if name in buffered else "v_" + name
+        return "{} = {};".format(target, value)
+
+    joins = find_joins(sort_transitions(cfg.transitions))
+    buffered = set()
+    inputs = [var for var in io_vars if var.typ == "Input"]
+    outputs = [var for var in io_vars if var.typ == "Output"]
+    fields = state_vars + [(var.name, var.width) for var in io_vars]
+    # Widest fields first, so the ``struct`` has no padding
+    fields.sort(key=lambda field: -ctypes.sizeof(get_c_type(field[1])[1]))
+
+    source = Source()
+    source.add_line("#include <stdint.h>")
+    source.add_line("")
+    source.add_line("typedef struct {")
+    for name, width in fields:
+        source.add_line("    {} {};".format(get_c_type(width)[0], name))
+    source.add_line("} state_t;")
+    source.add_line("")
+    source.add_line(helpers)
+    source.add_line("")
+    source.add_line("void run(state_t *_state, int64_t _cycles, "
+                    "const int64_t *_inputs, int64_t *_outputs) {")
+    # The fields are loaded into local variables for the whole run
+    for name, _ in fields:
+        source.add_line("    int64_t v_{0} = _state->{0};".format(name))
+    for name, _ in state_vars[1:]:
+        source.add_line("    int64_t _next_{};".format(name))
+    source.add_line("    for (int64_t _cycle = 0; _cycle < _cycles; "
+                    "_cycle++) {")
+    source.add_line("        if (_inputs) {")
+    for index, var in enumerate(inputs):
+        source.add_line("            v_{} = _inputs[{}] & {};".format(
+            var.name, index, hex((1 << var.width) - 1)))
+    source.add_line("            _inputs += {};".format(len(inputs)))
+    source.add_line("        }")
+    source.add_line("        switch (v_yield_state) {")
+    for yield_id, root in sorted(cfg.transitions.items()):
+        reads, writes = collect_names_in_transitions({yield_id: root})
+        # Statements read the values from the start of the cycle
+        buffered.clear()
+        buffered.update(reads & writes & set(names))
+        source.add_line("        case {}:".format(yield_id))
+        for name in sorted(buffered):
+            source.add_line("            _next_{0} = v_{0};".format(name))
+        emit_transition(source, root, None, joins, "            ",
+                        emit_statement, emit_expr)
+        for name in sorted(buffered):
+            source.add_line("            v_{0} = _next_{0};".format(name))
+        source.add_line("            break;")
+    source.add_line("        }")
+    source.add_line("        if (_outputs) {")
+    for index, var in enumerate(outputs):
+        source.add_line("            _outputs[{}] = v_{};".format(index,
+                                                                 var.name))
+    source.add_line("            _outputs += {};".format(len(outputs)))
+    source.add_line("        }")
+    source.add_line("    }")
+    for name, _ in fields:
+        source.add_line("    _state->{0} = v_{0};".format(name))
+    source.add_line("}")
+    source = str(source)
+    if int(os.environ.get("SILICA_DEBUG", "0")) >= 1:
+        print(source)
+
+    library = ctypes.CDLL(build_library(source))
+    State = type("State", (ctypes.Structure, ), {
+        "_fields_": [(name, get_c_type(width)[1]) for name, width in fields]
+    })
+    return CFSMDefinition(io_vars, clock_enable, state_vars, State, library,
+                          source)
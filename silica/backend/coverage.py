@@ -0,0 +1,166 @@
+"""
+State and branch coverage of the ``pysim`` simulations
+
+A state of the ``ControlFlowGraph`` (see ``build_state_info``) is a path
+through the decision diagram of a yield, so the generated function counts
+paths.  They are numbered as in Ball and Larus' path profiling: the false
+edge of a decision adds the number of paths through its true edge, so the
+sum of the edges taken is the index of the path among the paths of its
+yield, in the order of ``cfg.states``.  Each cycle only adds constants on
+the false edges it takes and increments one counter, the counts of the
+branches are computed from the counts of the paths.
+
+Counts are plain arrays, the coverage of simulations run in other processes
+(e.g. pickled ``Coverage`` objects) is merged by adding them.
+"""
+import linecache
+
+import astor
+import numpy as np
+
+from silica.cfg.types import Step, Decision
+from silica.cfg.control_flow_graph import sort_transitions
+
+
+# The maximum number of states (paths) that can be counted
+MAX_PATHS = 1 << 16
+
+
+def count_paths(transitions):
+    """
+    Returns a dict mapping each node of the decision diagrams in
+    ``transitions`` to the number of paths from it to an ``End``
+    """
+    counts = {}
+    for node in reversed(sort_transitions(transitions)):
+        if isinstance(node, Step):
+            counts[node] = counts[node.next]
+        elif isinstance(node, Decision):
+            counts[node] = counts[node.true_edge] + counts[node.false_edge]
+        else:
+            counts[node] = 1
+    return counts
+
+
+def get_path_numbering(transitions):
+    """
+    Returns ``(bases, increments, total)``:
+
+        * ``bases`` - a dict mapping each yield to the index of its first path
+        * ``increments`` - a dict mapping each ``Decision`` to the number
+          added to the path index by its false edge
+        * ``total`` - the number of paths
+
+    Raises a ``ValueError`` if there are more than ``MAX_PATHS`` paths
+    """
+    counts = count_paths(transitions)
+    bases = {}
+    total = 0
+    for yield_id, root in sorted(transitions.items()):
+        bases[yield_id] = total
+        total += counts[root]
+    if total > MAX_PATHS:
+        raise ValueError("Cannot count the coverage of {} states (more than "
+                         "{})".format(total, MAX_PATHS))
+    increments = {node: counts[node.true_edge] for node in counts
+                  if isinstance(node, Decision)}
+    return bases, increments, total
+
+
+def get_paths(transitions):
+    """
+    Returns the paths through the decision diagrams in ``transitions``, in
+    the order of ``build_state_info``, as ``(start_yield_id, end_yield_id,
+    edges)`` where ``edges`` are the ``(decision, value)`` taken
+    """
+    paths = []
+    for start_yield_id, root in sorted(transitions.items()):
+        stack = [(root, [])]
+        while stack:
+            node, edges = stack.pop()
+            if isinstance(node, Step):
+                stack.append((node.next, edges))
+            elif isinstance(node, Decision):
+                stack.append((node.false_edge, edges + [(node, False)]))
+                stack.append((node.true_edge, edges + [(node, True)]))
+            else:
+                paths.append((start_yield_id, node.end_yield_id, edges))
+    return paths
+
+
+def get_location(file_name, node):
+    """
+    Returns ``"file:line"`` for ``node`` and the source of that line, or
+    the source of ``node`` if it has no line number
+    """
+    line_no = getattr(node, "lineno", None)
+    if line_no is None:
+        return "{}:?".format(file_name), astor.to_source(node).strip()
+    line = linecache.getline(file_name, line_no).strip() if file_name \
+        else ""
+    return "{}:{}".format(file_name, line_no), \
+        line or astor.to_source(node).strip()
+
+
+class Coverage:
+    """
+    Fields:
+        * ``self.paths`` - the paths of ``get_paths``, the states of the FSM
+        * ``self.counts`` - an array with the number of cycles that took
+          each path
+        * ``self.file_name`` - the file defining the FSM
+    """
+    def __init__(self, paths, counts, file_name=None):
+        self.paths = paths
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.file_name = file_name
+
+    def __add__(self, other):
+        if len(self.counts) != len(other.counts):
+            raise ValueError("Cannot merge the coverage of different FSMs")
+        return Coverage(self.paths, self.counts + other.counts,
+                        self.file_name)
+
+    def get_branch_counts(self):
+        """
+        Returns a list of ``(start_yield_id, decision, value, count)`` for
+        each edge of the decision diagram of each yield, in the order of the
+        paths
+        """
+        counts = {}
+        for (start, _, edges), count in zip(self.paths, self.counts.tolist()):
+            for decision, value in edges:
+                key = (start, decision, value)
+                counts[key] = counts.get(key, 0) + count
+        return [key + (count, ) for key, count in counts.items()]
+
+    def report(self):
+        """
+        Returns a summary of the coverage, with the source lines of the
+        branches and the states that were never taken
+        """
+        covered = int(np.count_nonzero(self.counts))
+        branches = self.get_branch_counts()
+        lines = [
+            "states: {}/{} covered".format(covered, len(self.counts)),
+            "branches: {}/{} covered".format(
+                sum(1 for branch in branches if branch[3]), len(branches))]
+        uncovered = [branch[:3] for branch in branches if branch[3] == 0]
+        if uncovered:
+            lines.append("uncovered branches:")
+        for start, decision, value in uncovered:
+            location, line = get_location(self.file_name, decision.cond)
+            lines.append("    {}: {} never {} (from yield {})".format(
+                location, line, "true" if value else "false", start))
+        if covered < len(self.counts):
+            lines.append("uncovered states:")
+        for (start, end, edges), count in zip(self.paths,
+                                              self.counts.tolist()):
+            if count:
+                continue
+            lines.append("    yield {} -> yield {}".format(start, end))
+            for decision, value in edges:
+                location, line = get_location(self.file_name, decision.cond)
+                lines.append("        {}: {} is {}".format(
+                    location, line, "true" if value else "false"))
+        return "\n".join(lines)
@@ -1,105 +1,377 @@
+"""
+Builds the circuit of an FSM with magma and mantle
+
+``build_datapath`` builds a ``Datapath`` from the ``ControlFlowGraph``: the
+registers of the FSM and the muxes computing their next values and enables.
+``build_netlist`` renders it as the source of a ``@circuit`` definition,
+which ``compile`` elaborates with mantle and ``silica.backend.netlist``
+simulates.
+"""
+import ast
 import os
+from copy import deepcopy
+
+import astor
 
 from silica.code_gen import Source
-from silica.transformations import desugar_for_loops, desugar_yield_from_range, \
-    specialize_constants, replace_symbols, constant_fold
 from silica.visitors import collect_names
+from silica.cfg.types import Step, Decision
 
 import silica.ast_utils as ast_utils
 
 from mantle.expressions import process_circuit_ast
 
-import ast
-import astor
 
+# The encodings of the ``yield_state`` register
+state_encodings = ("binary", "one-hot", "gray")
 
-# TODO: Factor this into transformations module
-class ComparesWithIncrementsSpecializer(ast.NodeTransformer):
-    def visit_Compare(self, node):
-        if len(node.comparators) == 1:
-            if isinstance(node.comparators[0], ast.Num):
-                if isinstance(node.left, ast.BinOp) and isinstance(node.left.right, ast.Num):
-                    if isinstance(node.left.op, ast.Add):
-                        node.comparators[0].n -= node.left.right.n
-                    else:
-                        raise NotImplementedError()
-                    node.left = node.left.left
-        return node
 
+def get_state_width(encoding, num_yields):
+    """
+    Returns the width of ``yield_state`` for ``num_yields`` yields
+    """
+    if encoding == "one-hot":
+        # Yield 0 is encoded as 0, so the reset state is valid
+        return max(num_yields - 1, 1)
+    return max((num_yields - 1).bit_length(), 1)
 
-def specialize_compares_with_increments(tree):
-    return ComparesWithIncrementsSpecializer().visit(tree)
 
-def compile(cfg, local_vars, tree, clock_enable, func_globals, func_locals):
-    source = Source()
+def encode_state(encoding, yield_id):
+    """
+    Returns the value of ``yield_state`` for ``yield_id``.  Yields are
+    numbered in program order, so with the gray encoding the transitions to
+    the next yield only flip one bit.
+    """
+    if encoding == "one-hot":
+        return 0 if yield_id == 0 else 1 << (yield_id - 1)
+    elif encoding == "gray":
+        return yield_id ^ (yield_id >> 1)
+    return yield_id
+
+
+def specialize_compare(node):
+    """
+    Returns ``node`` (interned) with a comparison of an increment to a
+    constant rewritten to compare the variable, so ``i + 1 < 8`` does not
+    overflow the width of ``i``
+    """
+    if isinstance(node, ast.Compare) and len(node.comparators) == 1 and \
+       isinstance(node.comparators[0], ast.Num) and \
+       isinstance(node.left, ast.BinOp) and \
+       isinstance(node.left.right, ast.Num):
+        if not isinstance(node.left.op, ast.Add):
+            raise NotImplementedError()
+        return ast.Compare(node.left.left, node.ops, [
+            ast.Num(node.comparators[0].n - node.left.right.n)])
+    return node
 
-    # for statement in cfg.initial_statements:
-    #     source.add_line(astor.to_source(statement).rstrip())
-    num_yields = cfg.curr_yield_id
-    yield_width = (num_yields - 1).bit_length()
 
+def is_shareable(node):
+    """
+    Whether ``node`` is an expression instantiating logic, so its uses can
+    share a single instance
+    """
+    if isinstance(node, ast.Subscript):
+        # A constant index is a wire
+        index = ast_utils.get_index(node)
+        return index is not None and not isinstance(index, ast.Num)
+    return isinstance(node, (ast.BinOp, ast.Compare, ast.UnaryOp,
+                             ast.BoolOp, ast.IfExp))
+
+
+class Datapath:
+    """
+    The registers and muxes of an FSM
+
+    Fields:
+        * ``self.registers`` - a list of ``(name, width, ce)`` for the
+          register of each variable (``name`` is the variable with a
+          ``_reg`` suffix), ``ce`` is whether it has a clock enable
+        * ``self.outputs`` - the names of the variables whose register
+          drives the output of the same name
+        * ``self.state_width`` - the width of ``yield_state``
+        * ``self.clock_enable`` - whether the FSM has a ``CE`` input
+        * ``self.records`` - the muxes and connections in the order they are
+          made: ``(mux, width)`` declares a mux and ``(value, port)`` drives
+          ``port`` (e.g. ``"x_reg.I"``) with ``value``.  Values are the names
+          of nets (the ``O`` port of a register or mux, ``CE``, or
+          ``yield_state_bit_i`` for bit ``i`` of ``yield_state``) or interned
+          expressions, so equal values are the same object.
+    """
+    def __init__(self, registers, outputs, state_width, clock_enable,
+                 records):
+        self.registers = registers
+        self.outputs = outputs
+        self.state_width = state_width
+        self.clock_enable = clock_enable
+        self.records = records
+
+
+def build_datapath(cfg, local_vars, tree, clock_enable, encoding="binary"):
+    """
+    Returns the ``Datapath`` of the FSM: a register for each variable live
+    across a yield, each output and ``yield_state`` (encoded with
+    ``encoding``, see ``state_encodings``), and the muxes computing the next
+    value and the enable of each register.  Equal muxes are only made once.
+    """
+    if encoding not in state_encodings:
+        raise ValueError("Unknown state encoding {}".format(encoding))
+    expressions = cfg.expressions
+
+    num_yields = len(cfg.transitions)
+    yield_width = get_state_width(encoding, num_yields)
+
+    # Locals that are not live across a yield are wires, their values are
+    # already promoted into the statements that read them
+    local_vars = [(var, width) for var, width in local_vars
+                  if var in cfg.state_vars]
     local_vars.append(("yield_state", yield_width))
     outputs = ast_utils.get_outputs_from_func(tree)
 
-    num_states = len(cfg.states)
-    state_width = (num_states - 1).bit_length()
-    source.add_line("state = Register({}, ce={})".format(num_states, clock_enable))
-    DEBUG_STATE = False
-    if DEBUG_STATE:
-        source.add_line("wire(state.O, state_out)")
-    if clock_enable:
-        source.add_line("wire(state.CE, CE)")
     replace_symbol_table = {}
     for var, width in local_vars + outputs:
-        source.add_line("{}_reg = Register({}, ce={})".format(var, width, clock_enable))
-        if clock_enable:
-            source.add_line("wire({}_reg.CE, CE)".format(var))
-        if (var, width) in outputs:
-            source.add_line("wire({var}_reg.O, {var})".format(var=var))
         replace_symbol_table[var] = ast.Attribute(ast.Name(var + "_reg", ast.Load()), "O", ast.Load())
-        source.add_line("{}_next = Or({}, {})".format(var, num_states, width))
-        source.add_line("wire({var}_next.O, {var}_reg.I)".format(var=var))
-    for i, state_info in enumerate(cfg.states):
-        state_info.statements = [replace_symbols(statement, replace_symbol_table, ast.Load) for statement in state_info.statements]
-        curr = state_info.yield_state
-        for cond in state_info.conds:
-            curr = ast.BinOp(curr, ast.BitAnd(), cond)
-        for var, _ in local_vars + outputs:
-            symbol_table = {
-                var: ast.Attribute(ast.Name(var + "_next", ast.Load()), "O", ast.Load())
-            }
-            curr = replace_symbols(curr, symbol_table, ast.Load)
-        source.add_line("state.I[{}] = {}".format(i, astor.to_source(curr).rstrip()))
-    for var, width in local_vars + outputs:
-        for i, state_info in enumerate(cfg.states):
-            source.add_line("{}_{} = And(2, {})".format(var, i, width))
-            source.add_line("wire({var}_{i}.O, {var}_next.I{i})".format(var=var, i=i))
-            if width > 1:
-                for j in range(width):
-                    source.add_line("wire(state.O[{i}], {var}_{i}.I0[{j}])".format(i=i, var=var, j=j))
+    widths = dict(local_vars + outputs)
+
+    # See ``Datapath.records``
+    records = []
+    # Maps ``(width, select, if_false, if_true)`` to the output of the mux
+    muxes = {}
+    # Generated names are numbered with one counter, so they are unique
+    names = [0]
+    one = expressions.intern(ast.Num(1))
+    zero = expressions.intern(ast.Num(0))
+
+    def connect(value, port):
+        if not isinstance(value, str):
+            value = expressions.transform(value, specialize_compare)
+        records.append((value, port))
+
+    def add_mux(prefix, width, select, if_false, if_true):
+        """
+        Returns the output of a mux, reusing the mux with the same inputs
+        if there is one.  The muxes of the enables selecting between
+        constants are their select (or its negation).
+        """
+        if if_false is zero and if_true is one:
+            return select
+        elif if_false is one and if_true is zero:
+            if isinstance(select, str):
+                select = ast.parse(select).body[0].value
+            return expressions.intern(ast.UnaryOp(ast.Invert(), select))
+        key = (width, select, if_false, if_true)
+        if key not in muxes:
+            names[0] += 1
+            mux = "{}_{}".format(prefix, names[0])
+            records.append((mux, width))
+            connect(if_false, mux + ".I0")
+            connect(if_true, mux + ".I1")
+            connect(select, mux + ".S")
+            muxes[key] = mux + ".O"
+        return muxes[key]
+
+    # The next value of a variable if the FSM is at a yield is a tree of
+    # muxes following the decision diagram of the yield, a ``Decision``
+    # selects between the values of its edges with its condition.  Paths
+    # that do not assign the variable hold its value: they have no value
+    # (``None``) and clear the enable of the register, which is a tree of
+    # the same shape.
+    assignments = {}
+    memo = {}
+
+    def get_assignments(step):
+        if step not in assignments:
+            assigned = {}
+            for statement in step.statements:
+                for var in collect_names(statement, ast.Store):
+                    if var in widths:
+                        # TODO: Should we use last connect semantics?
+                        assigned[var] = expressions.substitute(
+                            statement, replace_symbol_table, ast.Load).value
+            assignments[step] = assigned
+        return assignments[step]
+
+    def get_value(node, var, value):
+        """
+        Returns ``(value, enable)`` for ``var`` at the end of the paths from
+        ``node``, keeping ``value`` if they do not assign it
+        """
+        while isinstance(node, Step):
+            value = get_assignments(node).get(var, value)
+            node = node.next
+        if not isinstance(node, Decision):
+            if var == "yield_state":
+                value = expressions.intern(
+                    ast.Num(encode_state(encoding, node.end_yield_id)))
+            return value, zero if value is None else one
+        key = (node, var, value)
+        if key not in memo:
+            cond = expressions.substitute(node.cond, replace_symbol_table,
+                                          ast.Load)
+            if_true, true_enable = get_value(node.true_edge, var, value)
+            if_false, false_enable = get_value(node.false_edge, var, value)
+            if if_false is None or if_true == if_false:
+                value = if_true
+            elif if_true is None:
+                value = if_false
             else:
-                source.add_line("wire(state.O[{i}], {var}_{i}.I0)".format(i=i, var=var))
-            result = [statement for statement in  state_info.statements if var in collect_names(statement, ast.Store)]
-            # assert len(result) <= 1, [astor.to_source(s).rstrip() for s in result]
-            if len(result) == 0:
-                source.add_line("wire({var}_reg.O, {var}_{i}.I1)".format(var=var, i=i))
+                value = add_mux(var, widths[var], cond, if_false, if_true)
+            if true_enable is false_enable:
+                enable = true_enable
+            elif true_enable is one and false_enable is zero:
+                enable = cond
+            elif true_enable is zero and false_enable is one:
+                enable = expressions.intern(ast.UnaryOp(ast.Invert(), cond))
             else:
-                statement = result[-1]  # TODO: Should we use last connect semantics?
-                symbol_table = {
-                    var: ast.Attribute(ast.Name("{}_{}".format(var, i), ast.Load()), "I1", ast.Store())
-                }
-                statement = replace_symbols(statement, symbol_table, ast.Store)
-                source.add_line(astor.to_source(statement).rstrip())
+                enable = add_mux(var + "_en", 1, cond, false_enable,
+                                 true_enable)
+            memo[key] = value, enable
+        return memo[key]
+
+    # The next value (and enable) of each register is selected by the
+    # current yield, with a tree of muxes on the bits of ``yield_state`` (a
+    # chain on the bits for the one-hot encoding).  Muxes are shared, so the
+    # yields with the same value share a subtree.
+    def select(prefix, width, bit, leaves):
+        # ``leaves`` maps the encoded states that differ only in the bits
+        # up to ``bit`` to their values, the others are not used
+        first = next(iter(leaves.values()))
+        if all(value == first for value in leaves.values()):
+            return first
+        low = {code: value for code, value in leaves.items()
+               if not code >> bit & 1}
+        high = {code: value for code, value in leaves.items()
+                if code >> bit & 1}
+        if not low or not high:
+            return select(prefix, width, bit - 1, low or high)
+        return add_mux(prefix, width, "yield_state_bit_{}".format(bit),
+                       select(prefix, width, bit - 1, low),
+                       select(prefix, width, bit - 1, high))
+
+    def select_yield(prefix, width, values):
+        # ``values`` maps the yields to their values, ``None`` for the yields
+        # where it does not matter
+        values = {yield_id: value for yield_id, value in values.items()
+                  if value is not None}
+        if not values:
+            return None
+        elif encoding != "one-hot":
+            return select(prefix, width, yield_width - 1, {
+                encode_state(encoding, yield_id): value
+                for yield_id, value in values.items()})
+        yield_ids = sorted(values)
+        value = values[yield_ids[0]]
+        for yield_id in yield_ids[1:]:
+            if values[yield_id] != value:
+                # Yield 0 is the only one without a bit
+                value = add_mux(prefix, width,
+                                "yield_state_bit_{}".format(yield_id - 1),
+                                value, values[yield_id])
+        return value
+
+    registers = []
+    for var, width in local_vars + outputs:
+        results = {yield_id: get_value(root, var, None)
+                   for yield_id, root in cfg.transitions.items()}
+        value = select_yield(var + "_sel", width, {
+            yield_id: value for yield_id, (value, _) in results.items()})
+        enable = select_yield(var + "_en_sel", 1, {
+            yield_id: enable for yield_id, (_, enable) in results.items()})
+        if value is None:
+            # Never assigned, it holds its initial value
+            value, enable = "{}_reg.O".format(var), one
+        registers.append((var + "_reg", width,
+                          clock_enable or enable is not one))
+        connect(value, "{}_reg.I".format(var))
+        if enable is not one:
+            if isinstance(enable, str):
+                enable = ast.parse(enable).body[0].value
+            if clock_enable:
+                enable = ast.BinOp(ast.Name("CE", ast.Load()), ast.BitAnd(),
+                                   enable)
+            connect(expressions.intern(enable), "{}_reg.CE".format(var))
+        elif clock_enable:
+            connect("CE", "{}_reg.CE".format(var))
+
+    return Datapath(registers, [var for var, _ in outputs], yield_width,
+                    clock_enable, records)
+
 
+def build_netlist(cfg, local_vars, tree, clock_enable, encoding="binary"):
+    """
+    Returns a copy of ``tree`` rewritten to the ``@circuit`` definition of
+    the ``Datapath`` of the FSM (see ``silica.backend.netlist`` to simulate
+    it).  Expressions used more than once are a single net.
+    """
+    datapath = build_datapath(cfg, local_vars, tree, clock_enable, encoding)
+    records = datapath.records
+
+    # Expressions used more than once become a single net, defined before
+    # the first use
+    uses = {}
+    stack = [value for value, _ in records if isinstance(value, ast.AST)]
+    while stack:
+        node = stack.pop()
+        uses[node] = uses.get(node, 0) + 1
+        if uses[node] == 1:
+            stack.extend(ast.iter_child_nodes(node))
+    shared = {node: None for node, count in uses.items()
+              if count > 1 and is_shareable(node)}
+    # Numbered after the muxes, so the names are unique
+    names = [len(records)]
+    source = Source()
 
-    # print(source)
+    def emit_expr(node):
+        """
+        Returns ``node`` with the shared expressions replaced by their nets
+        """
+        if shared.get(node) is not None:
+            return ast.Name(shared[node], ast.Load())
+        fields = {}
+        for name, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST):
+                value = emit_expr(value)
+            elif isinstance(value, list):
+                value = [emit_expr(item) if isinstance(item, ast.AST)
+                         else item for item in value]
+            fields[name] = value
+        result = type(node)(**fields)
+        if node in shared:
+            names[0] += 1
+            shared[node] = "expr_{}".format(names[0])
+            source.add_line("{} = {}".format(
+                shared[node], astor.to_source(result).rstrip()))
+            return ast.Name(shared[node], ast.Load())
+        return result
+
+    for name, width, ce in datapath.registers:
+        source.add_line("{} = Register({}, ce={})".format(name, width, ce))
+        var = name[:-len("_reg")]
+        if var in datapath.outputs:
+            source.add_line("wire({}.O, {})".format(name, var))
+    for bit in range(datapath.state_width):
+        source.add_line("yield_state_bit_{} = yield_state_reg.O[{}]".format(bit, bit))
+    for value, port in records:
+        if isinstance(port, int):
+            source.add_line("{} = Mux(2, {})".format(value, port))
+        elif isinstance(value, str):
+            source.add_line("wire({}, {})".format(value, port))
+        else:
+            statement = ast.Assign([ast.parse(port).body[0].value],
+                                   emit_expr(value))
+            source.add_line(astor.to_source(statement).rstrip())
+
+    tree = deepcopy(tree)
     tree.body = ast.parse(str(source)).body
     tree.decorator_list = [ast.Name("circuit", ast.Load())]
     if clock_enable:
         tree.args.args.append(ast.arg("CE", ast.parse("In(Bit)").body[0].value))
-    if DEBUG_STATE:
-        tree.args.args.append(ast.arg("state_out", ast.parse("Out(Array({}, Bit))".format(num_states)).body[0].value))
-    tree = specialize_compares_with_increments(tree)
+    return tree
+
+
+def compile(cfg, local_vars, tree, clock_enable, func_globals, func_locals,
+            encoding="binary"):
+    tree = build_netlist(cfg, local_vars, tree, clock_enable, encoding)
     if int(os.environ.get("SILICA_DEBUG", "0")) >= 1:
         print(astor.to_source(tree))
     source, name = process_circuit_ast(tree)
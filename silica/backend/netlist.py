@@ -0,0 +1,550 @@
+"""
+Cycle-accurate simulation of silica's netlist description of an FSM
+
+``fsm("netlist")`` builds the ``@circuit`` definition of
+``silica.backend.magma.build_netlist`` (the registers, conditions and muxes
+of the FSM) and compiles it to a flat Python function.  It is not
+elaborated with magma, so this simulates silica's description rather than
+the circuit ``magma.compile`` produces.  Every net becomes a local variable
+computed with integer operations, in topological order, once per cycle:
+
+    * ``x = Register(width)`` - ``x_O`` holds the value, ``wire(..., x.I)``
+      is the next value and ``wire(..., x.CE)`` the clock enable
+    * ``m = Mux(2, width)`` - ``m_O = m_I1 if m_S else m_I0``
+    * ``net = expr`` - ``expr`` with integer semantics modelled on the
+      mantle operators on ``Bits``: arithmetic wraps at the width of the
+      widest operand and ``a[i]`` is bit ``i``, LSB first
+
+The ``CE`` input is handled like the ``CE`` of ``PyFSM``, the registers only
+update on the enabled cycles.
+"""
+import ast
+import os
+from types import SimpleNamespace
+
+import astor
+
+from silica.code_gen import Source
+from silica.types import Input_
+import silica.ast_utils as ast_utils
+from silica.backend.python import Simulation, Snapshot, IOVar
+from silica.ast_utils import get_index
+from silica.backend.pysim import SAVE_STATE, LOAD_STATE
+
+
+class NetlistFSMDefinition:
+    """
+    Calling the definition returns a new independent ``NetlistFSM``, like
+    ``PyFSMDefinition`` it forwards ``next`` and its other attributes to a
+    default instance.
+
+    Fields:
+        * ``self.io_vars`` - the ``IOVar`` of each port, except ``CE``
+        * ``self.clock_enable`` - whether instances have a ``CE`` input
+        * ``self.registers`` - a list of ``(name, width)``, in the order of
+          the state saved by the generated function
+        * ``self.function`` - the generated function
+        * ``self.source`` - the source of the generated function
+        * ``self.instance`` - the default instance
+    """
+    def __init__(self, io_vars, clock_enable, registers, function, source):
+        self.io_vars = io_vars
+        self.clock_enable = clock_enable
+        self.registers = registers
+        self.function = function
+        self.source = source
+        self.instance = NetlistFSM(self)
+
+    def __call__(self):
+        return NetlistFSM(self)
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+    def __next__(self):
+        next(self.instance)
+
+
+class NetlistFSM(Simulation):
+    """
+    An instance of a ``NetlistFSMDefinition``, the registers start at ``0``.
+    As with ``PyFSM``, the first cycle is run when the instance is created.
+    """
+    def __init__(self, definition):
+        self.definition = definition
+        self.IO = SimpleNamespace(**{var.name: var.get_container()
+                                     for var in definition.io_vars})
+        if definition.clock_enable:
+            self.IO.CE = Input_(1)
+            self.IO.CE.value = 1
+            self._slow = True
+        self._state = []
+        run = definition.function(self._state, *(
+            getattr(self.IO, var.name) for var in definition.io_vars))
+        self._send = run.send
+        next(run)
+        self._send(1)
+        self._rows = None
+
+    def __next__(self):
+        if self._slow:
+            self.run_until(1)
+        else:
+            self.cycle += 1
+            self._send(1)
+
+    def _run(self, cycles):
+        if self._rows is None:
+            if cycles > 0:
+                self._send(cycles)
+            return
+        for _ in range(cycles):
+            self._send(1)
+            self._rows.extend(self._get_trace_row())
+
+    def _get_trace_signals(self):
+        return [(name, width) for name, width in self.definition.registers] \
+            + [(var.name, var.width) for var in self.definition.io_vars]
+
+    def _get_trace_row(self):
+        self._send(SAVE_STATE)
+        return self._state + [getattr(self.IO, var.name)._value
+                              for var in self.definition.io_vars]
+
+    def _set_tracing(self, tracer):
+        self._rows = None if tracer is None else tracer.rows
+
+    def snapshot(self):
+        """
+        Returns a ``Snapshot`` of the simulation, ``state`` maps the name of
+        each register to its value
+        """
+        self._send(SAVE_STATE)
+        return Snapshot(
+            self.cycle,
+            dict(zip((name for name, _ in self.definition.registers),
+                     self._state)),
+            {name: port._value for name, port in vars(self.IO).items()})
+
+    def restore(self, snapshot):
+        """
+        Sets the state of the simulation to ``snapshot``
+        """
+        self._state[:] = [snapshot.state[name]
+                          for name, _ in self.definition.registers]
+        self._send(LOAD_STATE)
+        for name, value in snapshot.io.items():
+            getattr(self.IO, name).value = value
+        self.cycle = snapshot.cycle
+
+
+binary_ops = {
+    ast.Add: "+",
+    ast.Sub: "-",
+    ast.Mult: "*",
+    ast.FloorDiv: "//",
+    ast.Mod: "%",
+    ast.LShift: "<<",
+    ast.RShift: ">>",
+    ast.BitAnd: "&",
+    ast.BitOr: "|",
+    ast.BitXor: "^",
+}
+
+compare_ops = {
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+}
+
+# Operators whose result can be wider than their operands
+wrapping_ops = (ast.Add, ast.Sub, ast.Mult, ast.LShift)
+
+
+def get_net(node):
+    """
+    Returns the name of the net ``node`` refers to (``x`` or ``x.O``), or
+    ``None`` if it is not a net
+    """
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+        return "{}.{}".format(node.value.id, node.attr)
+    return None
+
+
+def get_reads(tree):
+    """
+    Returns the nets read by the expression ``tree``
+    """
+    reads = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        net = get_net(node)
+        if net is not None:
+            reads.append(net)
+        else:
+            stack.extend(ast.iter_child_nodes(node))
+    return reads
+
+
+def get_variable(net):
+    return net.replace(".", "_")
+
+
+def get_constant(node):
+    if isinstance(node, ast.Num):  # Python < 3.8
+        return node.n
+    elif isinstance(node, ast.NameConstant):  # Python < 3.8
+        return int(node.value)
+    raise NotImplementedError(astor.to_source(node).rstrip())
+
+
+class Netlist:
+    """
+    The nets of a ``@circuit`` built by ``build_netlist``
+
+    Fields:
+        * ``self.ports`` - a list of ``IOVar``, in the order of the arguments
+        * ``self.inputs`` - a dict mapping each input to its width
+        * ``self.output_widths`` - a dict mapping each output to its width
+        * ``self.outputs`` - a dict mapping each output to the expression
+          driving it
+        * ``self.registers`` - a dict mapping each register to its width
+        * ``self.muxes`` - a dict mapping each mux to its width
+        * ``self.drivers`` - a dict mapping each net (``cond``, ``m.I1``,
+          ``x.I``, ...) to the expression driving it
+    """
+    def __init__(self, tree):
+        self.inputs = dict(ast_utils.get_inputs_from_func(tree))
+        self.output_widths = dict(ast_utils.get_outputs_from_func(tree))
+        self.ports = []
+        for arg in tree.args.args:
+            if arg.arg in self.inputs:
+                self.ports.append(IOVar(arg.arg, "Input",
+                                        self.inputs[arg.arg]))
+            elif arg.arg in self.output_widths:
+                self.ports.append(IOVar(arg.arg, "Output",
+                                        self.output_widths[arg.arg]))
+        self.outputs = {}
+        self.registers = {}
+        self.muxes = {}
+        self.drivers = {}
+        for statement in tree.body:
+            self.add(statement)
+
+    def add(self, statement):
+        if isinstance(statement, ast.Expr) and \
+           isinstance(statement.value, ast.Call) and \
+           ast_utils.get_call_func(statement.value) == "wire" and \
+           len(statement.value.args) == 2:
+            # ``wire`` connects its arguments in either order
+            value, target = statement.value.args
+            if not self.is_sink(get_net(target)):
+                value, target = target, value
+            net = get_net(target)
+            if not self.is_sink(net):
+                raise NotImplementedError(astor.to_source(statement).rstrip())
+            elif net in self.output_widths:
+                self.outputs[net] = value
+            else:
+                self.drivers[net] = value
+            return
+        if isinstance(statement, ast.Assign) and \
+           len(statement.targets) == 1:
+            net = get_net(statement.targets[0])
+            value = statement.value
+            if isinstance(value, ast.Call) and \
+               ast_utils.get_call_func(value) == "Register":
+                self.registers[net] = get_constant(value.args[0])
+                return
+            elif isinstance(value, ast.Call) and \
+                    ast_utils.get_call_func(value) == "Mux":
+                if get_constant(value.args[0]) != 2:
+                    raise NotImplementedError(
+                        astor.to_source(statement).rstrip())
+                self.muxes[net] = get_constant(value.args[1])
+                return
+            elif net is not None:
+                self.drivers[net] = value
+                return
+        raise NotImplementedError(astor.to_source(statement).rstrip())
+
+    def is_sink(self, net):
+        """
+        Whether ``net`` is driven by a ``wire``: an output or an input of a
+        register or a mux
+        """
+        if net is None:
+            return False
+        name, _, port = net.partition(".")
+        if name in self.registers:
+            return port in ("I", "CE")
+        elif name in self.muxes:
+            return port in ("I0", "I1", "S")
+        return not port and name in self.output_widths
+
+    def is_computed(self, net):
+        """
+        Whether ``net`` is computed every cycle, i.e. it is a condition or the
+        output of a mux
+        """
+        name, _, port = net.partition(".")
+        if name in self.muxes:
+            return port == "O"
+        return not port and name in self.drivers
+
+    def get_dependencies(self, net):
+        """
+        Returns the computed nets read to compute ``net``
+        """
+        name, _, port = net.partition(".")
+        if name in self.muxes and port == "O":
+            reads = []
+            for port in ("I0", "I1", "S"):
+                driver = "{}.{}".format(name, port)
+                if driver not in self.drivers:
+                    raise ValueError("{} is not driven".format(driver))
+                reads.extend(get_reads(self.drivers[driver]))
+        elif net in self.drivers:
+            reads = get_reads(self.drivers[net])
+        else:
+            return []
+        return [read for read in reads if self.is_computed(read)]
+
+    def sort(self, roots):
+        """
+        Returns the computed nets needed for the expressions ``roots`` in
+        topological order
+        """
+        order = []
+        done = set()
+        seen = set()
+        stack = [(net, False) for root in reversed(roots)
+                 for net in reversed(get_reads(root))
+                 if self.is_computed(net)]
+        while stack:
+            net, expanded = stack.pop()
+            if expanded:
+                order.append(net)
+                done.add(net)
+                continue
+            if net in seen:
+                continue
+            seen.add(net)
+            stack.append((net, True))
+            for dependency in reversed(self.get_dependencies(net)):
+                if dependency not in seen:
+                    stack.append((dependency, False))
+                elif dependency not in done:
+                    raise ValueError("Combinational loop through {}".format(
+                        dependency))
+        return order
+
+
+def compile_netlist(netlist):
+    """
+    Returns the source of a generator ``run(_state, _io_...)`` running the
+    netlist, it is sent the number of cycles to run (or a ``SAVE_STATE`` or
+    ``LOAD_STATE`` command)
+    """
+    def lower(node):
+        """
+        Returns the code for ``node`` and its width (``None`` for
+        constants)
+        """
+        net = get_net(node)
+        if net is not None:
+            name, _, port = net.partition(".")
+            if net == "CE" and net in netlist.inputs:
+                # Enabled cycles are selected by ``Simulation``
+                return "1", 1
+            elif net in netlist.inputs:
+                return get_variable(net), netlist.inputs[net]
+            elif name in netlist.registers and port == "O":
+                return get_variable(net), netlist.registers[name]
+            elif name in netlist.muxes and port == "O":
+                return get_variable(net), netlist.muxes[name]
+            elif net in widths:
+                return get_variable(net), widths[net]
+            raise NotImplementedError(astor.to_source(node).rstrip())
+        elif isinstance(node, (ast.Num, ast.NameConstant)):
+            return str(get_constant(node)), None
+        elif isinstance(node, ast.BinOp) and type(node.op) in binary_ops:
+            left, left_width = lower(node.left)
+            right, right_width = lower(node.right)
+            width = max(left_width or 0, right_width or 0) or None
+            code = "({} {} {})".format(left, binary_ops[type(node.op)], right)
+            if width is not None and isinstance(node.op, wrapping_ops):
+                code = "({} & {})".format(code, (1 << width) - 1)
+            return code, width
+        elif isinstance(node, ast.Compare):
+            terms = []
+            left, _ = lower(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                if type(op) not in compare_ops:
+                    raise NotImplementedError(astor.to_source(node).rstrip())
+                right, _ = lower(comparator)
+                terms.append("{} {} {}".format(left, compare_ops[type(op)],
+                                               right))
+                left = right
+            return "({})".format(" and ".join(terms)), 1
+        elif isinstance(node, ast.UnaryOp):
+            operand, width = lower(node.operand)
+            if isinstance(node.op, ast.Not):
+                return "(not {})".format(operand), 1
+            elif isinstance(node.op, (ast.Invert, ast.USub)):
+                op = "~" if isinstance(node.op, ast.Invert) else "-"
+                if width is None:
+                    return "({}{})".format(op, operand), None
+                return "({}{} & {})".format(op, operand, (1 << width) - 1), \
+                    width
+        elif isinstance(node, ast.BoolOp):
+            op = " and " if isinstance(node.op, ast.And) else " or "
+            return "({})".format(op.join(lower(value)[0]
+                                         for value in node.values)), 1
+        elif isinstance(node, ast.IfExp):
+            test, _ = lower(node.test)
+            body, body_width = lower(node.body)
+            orelse, orelse_width = lower(node.orelse)
+            return "({} if {} else {})".format(body, test, orelse), \
+                max(body_width or 0, orelse_width or 0) or None
+        elif isinstance(node, ast.Subscript):
+            value, width = lower(node.value)
+            index = get_index(node)
+            if index is not None:
+                return "(({} >> {}) & 1)".format(value, lower(index)[0]), 1
+            lower_bound = 0 if node.slice.lower is None else \
+                get_constant(node.slice.lower)
+            upper_bound = width if node.slice.upper is None else \
+                get_constant(node.slice.upper)
+            return "(({} >> {}) & {})".format(
+                value, lower_bound,
+                (1 << (upper_bound - lower_bound)) - 1), \
+                upper_bound - lower_bound
+        raise NotImplementedError(astor.to_source(node).rstrip())
+
+    def lower_to(net, width):
+        """
+        Returns the code for the driver of ``net`` truncated to ``width``
+        """
+        driver = netlist.drivers[net]
+        if isinstance(driver, (ast.Num, ast.NameConstant)):
+            return str(get_constant(driver) & ((1 << width) - 1))
+        code, code_width = lower(driver)
+        if isinstance(driver, (ast.Compare, ast.BoolOp)) or \
+           isinstance(driver, ast.UnaryOp) and isinstance(driver.op, ast.Not):
+            # Registers hold ints, not bools
+            code = "int{}".format(code)
+        elif code_width is None or code_width > width:
+            code = "({} & {})".format(code, (1 << width) - 1)
+        return code
+
+    def emit_net(net):
+        name, _, port = net.partition(".")
+        if name in netlist.muxes:
+            # Only the selected input is evaluated
+            width = netlist.muxes[name]
+            code = "{} if {} else {}".format(
+                lower_to(name + ".I1", width), lower(netlist.drivers[
+                    name + ".S"])[0], lower_to(name + ".I0", width))
+        else:
+            code, width = lower(netlist.drivers[net])
+        widths[net] = width
+        source.add_line("        {} = {}".format(get_variable(net), code))
+
+    registers = sorted(netlist.registers)
+    outputs = [var.name for var in netlist.ports if var.typ == "Output"]
+    enables = {}
+    for register in registers:
+        enable = "{}.CE".format(register)
+        if enable in netlist.drivers and \
+           lower(netlist.drivers[enable])[0] == "1":
+            enable = None
+        enables.setdefault(enable if enable in netlist.drivers else None,
+                           []).append(register)
+    roots = [netlist.drivers["{}.I".format(register)]
+             for register in registers] + \
+        [netlist.drivers[enable] for enable in enables
+         if enable is not None] + \
+        [netlist.outputs[output] for output in outputs]
+
+    widths = {}
+    source = Source()
+    params = ", ".join(["_state"] + ["_io_" + var.name
+                                     for var in netlist.ports
+                                     if var.name != "CE"])
+    state = "{},".format(", ".join(get_variable(register + ".O")
+                                   for register in registers))
+    source.add_line("def run({}):".format(params))
+    for register in registers:
+        source.add_line("    {} = 0".format(get_variable(register + ".O")))
+    source.add_line("    _budget = (yield) or 1")
+    source.add_line("    while True:")
+    order = netlist.sort(roots)
+    reads = set()
+    for root in roots + [netlist.drivers[net] for net in order
+                         if net in netlist.drivers]:
+        reads.update(get_reads(root))
+    for net in order:
+        name = net.partition(".")[0]
+        if name in netlist.muxes:
+            for port in ("I0", "I1", "S"):
+                reads.update(get_reads(netlist.drivers[name + "." + port]))
+    for name in sorted(netlist.inputs):
+        if name in reads and name != "CE":
+            source.add_line("        {} = _io_{}._value".format(
+                get_variable(name), name))
+    for net in order:
+        emit_net(net)
+    # Every net is computed before the registers are updated
+    for enable, enabled in sorted(enables.items(),
+                                  key=lambda item: item[0] or ""):
+        indent = "        "
+        if enable is not None:
+            source.add_line("        if {}:".format(
+                lower(netlist.drivers[enable])[0]))
+            indent += "    "
+        source.add_line(indent + "{}, = {},".format(
+            ", ".join(get_variable(register + ".O") for register in enabled),
+            ", ".join(lower_to(register + ".I", netlist.registers[register])
+                      for register in enabled)))
+    for output in outputs:
+        source.add_line("        _io_{}._value = {}".format(
+            output, lower(netlist.outputs[output])[0]))
+    source.add_line("        if _budget > 1:")
+    source.add_line("            _budget -= 1")
+    source.add_line("            continue")
+    source.add_line("        _budget = (yield) or 1")
+    source.add_line("        while _budget < 0:")
+    source.add_line("            if _budget == {}:".format(SAVE_STATE))
+    source.add_line("                _state[:] = {}".format(state))
+    source.add_line("            else:")
+    source.add_line("                {} = _state".format(state))
+    source.add_line("            _budget = (yield) or 1")
+    return str(source)
+
+
+def compile(tree, clock_enable):
+    """
+    Compiles the ``@circuit`` definition ``tree`` returned by
+    ``build_netlist``
+
+    Returns a ``NetlistFSMDefinition``
+    """
+    netlist = Netlist(tree)
+    source = compile_netlist(netlist)
+    if int(os.environ.get("SILICA_DEBUG", "0")) >= 1:
+        print(source)
+    namespace = {}
+    exec(source, namespace)
+    io_vars = [var for var in netlist.ports if var.name != "CE"]
+    registers = [(name[:-len("_reg")] if name.endswith("_reg") else name,
+                  netlist.registers[name])
+                 for name in sorted(netlist.registers)]
+    return NetlistFSMDefinition(io_vars, clock_enable, registers,
+                                namespace["run"], source)
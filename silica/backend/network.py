@@ -0,0 +1,137 @@
+"""
+Simulates FSM instances of the python backends connected by their ports
+
+The outputs of an FSM are registers, so an instance reads the values its
+drivers held at the start of a cycle: each cycle of a ``Network`` steps the
+active instances, then copies the outputs that changed to the inputs they
+drive.  An instance whose last cycle changed neither its state nor its
+outputs will do the same again until one of its inputs changes, so it is
+idle and is not stepped until then.
+
+Inputs that are not connected can be set between calls to ``next`` and
+``run_until``, every instance is active at the start of a call.
+"""
+from silica.types import Input_, Output_
+
+
+class Network:
+    """
+    Fields:
+        * ``self.instances`` - a dict mapping names to the instances (a
+          ``PyFSM`` or ``PySimFSM``) in the order they were added
+        * ``self.cycle`` - the number of cycles run
+    """
+    def __init__(self):
+        self.instances = {}
+        self.cycle = 0
+        # Maps ``id(port)`` to ``(instance, name)`` for the ports of the
+        # instances
+        self._owners = {}
+        # Maps ``id(output)`` to ``(output, [input, ...])``
+        self._connections = {}
+        self._driven = set()
+
+    def add(self, name, instance):
+        """
+        Adds ``instance`` (or the default instance of a definition) as
+        ``name``.
+
+        Returns the instance
+        """
+        instance = getattr(instance, "instance", instance)
+        if name in self.instances:
+            raise ValueError("Duplicate instance name {}".format(name))
+        self.instances[name] = instance
+        for port_name, port in vars(instance.IO).items():
+            self._owners[id(port)] = (instance, port_name)
+        return instance
+
+    def connect(self, output, *inputs):
+        """
+        Drives each port in ``inputs`` with ``output``, all of them ports of
+        instances in the network
+        """
+        if not isinstance(output, Output_) or id(output) not in self._owners:
+            raise ValueError("Expected an output of an instance in the "
+                             "network")
+        _, sinks = self._connections.setdefault(id(output), (output, []))
+        for port in inputs:
+            if not isinstance(port, Input_) or id(port) not in self._owners:
+                raise ValueError("Expected an input of an instance in the "
+                                 "network")
+            if id(port) in self._driven:
+                raise ValueError("Input {} is already driven".format(
+                    self._owners[id(port)][1]))
+            if port.width != output.width:
+                raise ValueError(
+                    "Cannot connect {} (width {}) to {} (width {})".format(
+                        self._owners[id(output)][1], output.width,
+                        self._owners[id(port)][1], port.width))
+            self._driven.add(id(port))
+            sinks.append(port)
+            port._value = output._value
+
+    def __next__(self):
+        self.run_until(1)
+
+    def run_until(self, cycles):
+        """
+        Runs ``cycles`` cycles of every instance
+        """
+        if cycles <= 0:
+            return
+        instances = list(self.instances.values())
+        index = {id(instance): i for i, instance in enumerate(instances)}
+        # The outputs of each instance, with their sinks and the instances
+        # owning them
+        outputs = [[] for _ in instances]
+        for output, sinks in self._connections.values():
+            owner = self._owners[id(output)][0]
+            outputs[index[id(owner)]].append(
+                (output, sinks, [index[id(self._owners[id(port)][0])]
+                                 for port in sinks]))
+        # Traced and clock enabled instances record every cycle, they are
+        # never idle
+        always = [instance._slow for instance in instances]
+        # The cycle each idle instance went idle at, ``None`` if it is
+        # active
+        idle = [None] * len(instances)
+        # The state row of each instance after its last cycle, the inputs
+        # are part of the row so a cycle after an input changed never
+        # matches it
+        rows = [None] * len(instances)
+        active = list(range(len(instances)))
+        stop = self.cycle + cycles
+        while self.cycle < stop:
+            if not active:
+                # Nothing changes anymore
+                self.cycle = stop
+                break
+            changed = []
+            for i in active:
+                instance = instances[i]
+                values = [output._value for output, _, _ in outputs[i]]
+                next(instance)
+                for value, connection in zip(values, outputs[i]):
+                    if connection[0]._value != value:
+                        changed.append(connection)
+                if always[i]:
+                    continue
+                row = instance._get_state_row()
+                if row is not None and row == rows[i]:
+                    idle[i] = self.cycle + 1
+                rows[i] = row
+            self.cycle += 1
+            woken = set()
+            for output, sinks, owners in changed:
+                for port in sinks:
+                    port._value = output._value
+                woken.update(owners)
+            for i in woken:
+                if idle[i] is not None:
+                    instances[i].cycle += self.cycle - idle[i]
+                    idle[i] = None
+            active = [i for i in range(len(instances)) if idle[i] is None]
+        for instance, went_idle in zip(instances, idle):
+            if went_idle is not None:
+                instance.cycle += self.cycle - went_idle
@@ -0,0 +1,706 @@
+"""
+Simulates an FSM with a function generated from its ``ControlFlowGraph``
+
+Unlike ``PyFSM``, which runs the FSM as written, the generated function
+executes the same decision diagrams as the hardware backends: each cycle is
+one flat transition without nested loops or ``yield from``.
+Locals and outputs are local variables of the generated function (outputs
+are stored to their ``Output_`` when it yields), ``yield_state`` is an int
+and the current yield is found with a tree of comparisons.
+
+``run_until`` fast-forwards through cycles that repeat a self loop whose only
+effect (besides outputs) is adding a constant to a counter, such as the loops
+of ``yield from range(n)``, or nothing at all, such as ``while not done:
+yield`` with ``done`` unchanged.  The number of iterations left in the loop
+is computed from the conditions on the counter, the counter is advanced to
+the last of them and that iteration is run normally to update the outputs.
+
+Assignments wrap at the width of their variable (the declared or inferred
+width, see ``infer_widths``) and arithmetic wraps at the width of its widest
+operand, as in the netlist.  The operands of a comparison are compared
+exactly, as the hardware backends specialize ``i + 1 < n`` to ``i < n - 1``.
+
+Compiling with ``coverage=True`` counts the cycles taking each state (path)
+of the ``ControlFlowGraph``, see ``silica.backend.coverage``.
+"""
+import ast
+import os
+from copy import deepcopy
+from types import SimpleNamespace
+
+import astor
+
+from silica.code_gen import Source
+from silica.ast_utils import get_index
+from silica.cfg.types import Step, Decision
+from silica.cfg.control_flow_graph import sort_transitions, find_joins, \
+    collect_names_in_transitions
+from silica.cfg.infer_widths import INF, infer_widths, get_offset_name, \
+    negated_ops, flipped_ops
+from silica.backend.python import Simulation, Snapshot, get_io_vars, \
+    rewrite_io_vars
+from silica.backend.vcd import TABLE_WIDTH
+from silica.backend.coverage import Coverage, get_path_numbering, get_paths
+
+
+# The maximum number of paths through the transition of a yield searched for
+# self loops that can be fast-forwarded
+MAX_PATHS = 64
+
+
+class PySimFSMDefinition:
+    """
+    Calling the definition returns a new independent ``PySimFSM``, like
+    ``PyFSMDefinition`` it forwards ``next`` and its other attributes to a
+    default instance.
+
+    Fields:
+        * ``self.io_vars`` - the ``IOVar`` of each argument
+        * ``self.state_vars`` - the names of ``yield_state`` and the locals,
+          in the order of the state saved by the generated function
+        * ``self.state_widths`` - the width of each of ``self.state_vars``,
+          ``None`` for unbounded locals
+        * ``self.function`` - the generated function
+        * ``self.source`` - the source of the generated function
+        * ``self.paths`` - the paths counted for coverage (see
+          ``silica.backend.coverage.get_paths``), or ``None`` if the
+          function was compiled without coverage
+        * ``self.file_name`` - the file defining the FSM
+        * ``self.instance`` - the default instance
+    """
+    def __init__(self, io_vars, state_vars, state_widths, function, source,
+                 paths=None, file_name=None):
+        self.io_vars = io_vars
+        self.state_vars = state_vars
+        self.state_widths = state_widths
+        self.function = function
+        self.source = source
+        self.paths = paths
+        self.file_name = file_name
+        self.instance = PySimFSM(self)
+
+    def __call__(self):
+        return PySimFSM(self)
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+    def __next__(self):
+        next(self.instance)
+
+
+class PySimFSM(Simulation):
+    """
+    An instance of a ``PySimFSMDefinition``
+
+    Fields:
+        * ``self.IO`` - the ``Input_`` and ``Output_`` containers of each
+          argument, as with ``PyFSM``
+        * ``self.step`` - runs one cycle of the generated function
+    """
+    # The generated function times and flushes its trace lines
+    _traces_cycles = True
+
+    def __init__(self, definition):
+        self.definition = definition
+        self.IO = SimpleNamespace(**{var.name: var.get_container()
+                                     for var in definition.io_vars})
+        # The generated function saves its state to (and loads it from) this
+        # list when it is sent ``SAVE_STATE`` (``LOAD_STATE``)
+        self._state = []
+        # The count of each path, incremented in place by the generated
+        # function
+        self._coverage = None if definition.paths is None else \
+            [0] * len(definition.paths)
+        run = definition.function(self._state, self._coverage, *(
+            getattr(self.IO, var.name) for var in definition.io_vars))
+        self.step = run.__next__
+        self._send = run.send
+        # Run until the first yield, as with ``PyFSM``
+        self.step()
+
+    def __next__(self):
+        if self._slow:
+            self.run_until(1)
+        else:
+            self.cycle += 1
+            self.step()
+
+    def _run(self, cycles):
+        if cycles > 0:
+            if self._tracer is not None and self._trace_time != self.cycle:
+                # The disabled cycles since the last traced one
+                self._state[:] = [self.cycle]
+                self._send(SET_TIME)
+            self._send(cycles)
+            self._trace_time = self.cycle + cycles
+
+    def _get_trace_signals(self):
+        return list(zip(self.definition.state_vars,
+                        self.definition.state_widths)) + \
+            [(var.name, var.width) for var in self.definition.io_vars]
+
+    def _get_trace_row(self):
+        self._send(SAVE_STATE)
+        return self._state + [getattr(self.IO, var.name)._value
+                              for var in self.definition.io_vars]
+
+    def _set_tracing(self, tracer):
+        # The generated function appends the lines of the changes itself
+        if tracer is None:
+            self._state[:] = [None]
+        else:
+            self._state[:] = [tracer.lines.append, tracer.flush,
+                              tracer.chunk_size, self.cycle] + [
+                tracer.get_line_format(index)
+                for index in range(len(tracer.signals))]
+            self._trace_time = self.cycle
+        self._send(SET_TRACE)
+
+    def snapshot(self):
+        """
+        Returns a ``Snapshot`` of the simulation
+        """
+        self._send(SAVE_STATE)
+        return Snapshot(
+            self.cycle,
+            dict(zip(self.definition.state_vars, self._state)),
+            {name: port._value for name, port in vars(self.IO).items()})
+
+    def restore(self, snapshot):
+        """
+        Sets the state of the simulation to ``snapshot``, which can come
+        from another instance of the same definition
+        """
+        for name, value in snapshot.io.items():
+            getattr(self.IO, name).value = value
+        self._state[:] = [snapshot.state[name]
+                          for name in self.definition.state_vars]
+        self._send(LOAD_STATE)
+        self.cycle = snapshot.cycle
+
+    def get_coverage(self):
+        """
+        Returns the ``Coverage`` of the cycles run so far, the definition
+        must be compiled with ``coverage=True``
+        """
+        if self._coverage is None:
+            raise ValueError("The FSM was not compiled with coverage=True")
+        return Coverage(self.definition.paths, self._coverage,
+                        self.definition.file_name)
+
+    def reset_coverage(self):
+        if self._coverage is not None:
+            self._coverage[:] = [0] * len(self._coverage)
+
+
+# Commands sent to the generated function, cycle budgets are positive
+SAVE_STATE = -1
+LOAD_STATE = -2
+# Loads the function appending trace lines (or ``None``), the function
+# flushing them, the cycles per flush, the time of the last traced cycle and
+# the line formats (see ``VCDWriter.get_line_format``) from the state list
+SET_TRACE = -3
+# Loads the time of the last traced cycle from the state list
+SET_TIME = -4
+
+
+# Operators whose result can be wider than their operands, see ``wrap``
+wrapping_ops = (ast.Add, ast.Sub, ast.Mult, ast.LShift)
+
+ops = {
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+}
+
+
+def count_iterations(x, step, op, bound):
+    """
+    Returns the number of consecutive values ``x``, ``x + step``, ``x + 2 *
+    step``, ... for which ``value <op> bound`` holds, ``inf`` if it always
+    does
+    """
+    if op in (">", ">="):
+        x, step, bound = -x, -step, -bound
+        op = "<" if op == ">" else "<="
+    if op == "<=":
+        op, bound = "<", bound + 1
+    if op == "<":
+        if x >= bound:
+            return 0
+        elif step <= 0:
+            return float("inf")
+        return (bound - x + step - 1) // step
+    elif op == "==":
+        if x != bound:
+            return 0
+        return float("inf") if step == 0 else 1
+    if x == bound:
+        return 0
+    elif step != 0 and (bound - x) % step == 0 and (bound - x) // step > 0:
+        return (bound - x) // step
+    return float("inf")
+
+
+def emit_count_iterations(x, step, op, bound):
+    """
+    Returns the source of ``count_iterations(x, step, op, bound)`` for the
+    source ``x`` of a value known to satisfy ``x <op> bound``, as an
+    inline expression for the orderings.  ``None`` if the count is ``inf``.
+    """
+    if op in ("<", "<=") and step > 0:
+        if op == "<=":
+            bound += 1
+        if step == 1:
+            return "{} - ({})".format(bound, x)
+        return "({} - ({}) + {}) // {}".format(bound, x, step - 1, step)
+    elif op in (">", ">=") and step < 0:
+        if op == ">=":
+            bound -= 1
+        if step == -1:
+            return "({}) - {}".format(x, bound)
+        return "(({}) - {} + {}) // {}".format(x, bound, -step - 1, -step)
+    elif op in ("<", "<=", ">", ">="):
+        return None
+    return "_count_iterations({}, {}, {!r}, {})".format(x, step, op, bound)
+
+
+def get_reads(tree):
+    return {node.id for node in ast.walk(tree)
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+
+
+def get_self_loops(root, yield_id, local_vars):
+    """
+    Returns the paths through the transition ``root`` of yield ``yield_id``
+    that end at the same yield and only add a constant to (at most) one
+    local, as ``(index, conds, counter, bounds)``:
+
+        * ``index`` - the index of the path among the paths of the
+          transition, in the order of ``build_state_info``
+        * ``conds`` - the ``(cond, value)`` taken on the path
+        * ``counter`` - ``(name, step)`` for the local, or ``None``
+        * ``bounds`` - ``(expr, op, n)`` for the conditions on the counter,
+          the path is taken as long as each ``expr <op> n`` holds
+    """
+    paths = []
+    stack = [(root, [], [])]
+    while stack and len(paths) < MAX_PATHS:
+        node, conds, statements = stack.pop()
+        if isinstance(node, Step):
+            stack.append((node.next, conds, statements + node.statements))
+        elif isinstance(node, Decision):
+            stack.append((node.false_edge, conds + [(node.cond, False)],
+                          statements))
+            stack.append((node.true_edge, conds + [(node.cond, True)],
+                          statements))
+        else:
+            paths.append((conds, statements, node.end_yield_id))
+    loops = []
+    for index, (conds, statements, end_yield_id) in enumerate(paths):
+        if end_yield_id != yield_id:
+            continue
+        counter = None
+        for statement in statements:
+            if not isinstance(statement, ast.Assign) or \
+               len(statement.targets) != 1 or \
+               not isinstance(statement.targets[0], ast.Name):
+                # Skipping it could skip an effect, such as a call
+                break
+            name = statement.targets[0].id
+            if name not in local_vars or \
+               isinstance(statement.value, ast.Name) and \
+               statement.value.id == name:
+                continue  # Outputs are recomputed by the last iteration
+            offset_name = get_offset_name(statement.value)
+            if counter is not None or offset_name is None or \
+               offset_name[0] != name:
+                break
+            counter = offset_name
+        else:
+            bounds = get_bounds(conds, counter)
+            if bounds is not None:
+                loops.append((index, conds, counter, bounds))
+    return loops
+
+
+def get_bounds(conds, counter):
+    """
+    Returns the bounds (see ``get_self_loops``) on ``counter`` implied by
+    ``conds``, or ``None`` if a condition reading the counter is not a
+    comparison of it (plus or minus a constant) to a constant
+    """
+    bounds = []
+    for cond, value in conds:
+        if counter is None or counter[0] not in get_reads(cond):
+            # Does not change while looping
+            continue
+        if isinstance(cond, ast.BinOp) and type(cond.op) in ops:
+            # ``desugar_for_loops`` builds its conditions as a ``BinOp``
+            op, left, right = type(cond.op), cond.left, cond.right
+        elif isinstance(cond, ast.Compare) and len(cond.ops) == 1 and \
+                type(cond.ops[0]) in ops:
+            op, left, right = type(cond.ops[0]), cond.left, \
+                cond.comparators[0]
+        else:
+            return None
+        if isinstance(left, ast.Num):
+            left, right = right, left
+            op = flipped_ops[op]
+        offset_name = get_offset_name(left)
+        if not isinstance(right, ast.Num) or offset_name is None or \
+           offset_name[0] != counter[0]:
+            return None
+        if not value:
+            op = negated_ops[op]
+        bounds.append((left, ops[op], right.n))
+    return bounds
+
+
+def emit_transition(source, node, stop, joins, indent, emit_statement,
+                    emit_expr, increments=None):
+    """
+    Emits the decision diagram starting at ``node`` up to (but not including)
+    ``stop`` as nested ``if``/``else`` blocks, like the verilog backend.
+    ``emit_statement`` and ``emit_expr`` return the code for a statement and
+    a condition.
+
+    If ``increments`` (see ``get_path_numbering``) is given, the false edges
+    add their increment to ``_path`` and the path is counted in
+    ``_coverage`` at the end.
+    """
+    while node is not stop and node is not None:
+        if isinstance(node, Step):
+            for statement in node.statements:
+                source.add_line(indent + emit_statement(statement))
+            node = node.next
+        elif isinstance(node, Decision):
+            join = joins[node]
+            cond = emit_expr(node.cond)
+            true_edge, false_edge = node.true_edge, node.false_edge
+            count_path = ""
+            if increments is not None:
+                count_path = indent + "    _path += {}".format(
+                    increments[node])
+            if true_edge is join:
+                # Only the false edge does anything
+                source.add_line(indent + "if not ({}):".format(cond))
+                if count_path:
+                    source.add_line(count_path)
+                emit_transition(source, false_edge, join, joins,
+                                indent + "    ", emit_statement, emit_expr,
+                                increments)
+                node = join
+                continue
+            source.add_line(indent + "if {}:".format(cond))
+            emit_transition(source, true_edge, join, joins, indent + "    ",
+                            emit_statement, emit_expr, increments)
+            if false_edge is not join or count_path:
+                source.add_line(indent + "else:")
+                if count_path:
+                    source.add_line(count_path)
+                emit_transition(source, false_edge, join, joins,
+                                indent + "    ", emit_statement, emit_expr,
+                                increments)
+            node = join
+        else:
+            if increments is not None:
+                source.add_line(indent + "_coverage[_path] += 1")
+            source.add_line(indent + "yield_state = {}".format(
+                node.end_yield_id))
+            break
+
+
+def emit_dispatch(source, yield_ids, indent, emit_yield):
+    """
+    Emits a binary tree of comparisons on ``yield_state`` with the code of
+    each yield in ``yield_ids`` (sorted) at the leaves
+    """
+    if len(yield_ids) == 1:
+        emit_yield(yield_ids[0], indent)
+        return
+    middle = len(yield_ids) // 2
+    source.add_line(indent + "if yield_state < {}:".format(yield_ids[middle]))
+    emit_dispatch(source, yield_ids[:middle], indent + "    ", emit_yield)
+    source.add_line(indent + "else:")
+    emit_dispatch(source, yield_ids[middle:], indent + "    ", emit_yield)
+
+
+def mask(node, width):
+    return ast.BinOp(node, ast.BitAnd(), ast.Num((1 << width) - 1))
+
+
+def wrap(node, widths, exact=False):
+    """
+    Returns ``node`` with the results of its arithmetic wrapped at the
+    width of their widest operand (not the result of ``node`` itself if
+    ``exact``), and its width (``None`` for constants).  ``widths`` maps the
+    names of the variables to their widths, the others are unbounded (their
+    width is ``INF``) and do not wrap.
+    """
+    if isinstance(node, ast.Name):
+        return node, widths.get(node.id, INF)
+    elif isinstance(node, ast.BinOp) and type(node.op) in ops:
+        # ``desugar_for_loops`` builds comparisons as a ``BinOp``
+        return ast.BinOp(wrap(node.left, widths, True)[0], node.op,
+                         wrap(node.right, widths, True)[0]), 1
+    elif isinstance(node, ast.BinOp):
+        left, left_width = wrap(node.left, widths)
+        right, right_width = wrap(node.right, widths)
+        width = max(left_width or 0, right_width or 0) or None
+        node = ast.BinOp(left, node.op, right)
+        if width is not None and width < INF and \
+           isinstance(node.op, wrapping_ops) and not exact:
+            node = mask(node, width)
+        return node, width
+    elif isinstance(node, ast.Compare):
+        return ast.Compare(wrap(node.left, widths, True)[0], node.ops, [
+            wrap(comparator, widths, True)[0]
+            for comparator in node.comparators]), 1
+    elif isinstance(node, ast.BoolOp):
+        return ast.BoolOp(node.op, [wrap(value, widths)[0]
+                                    for value in node.values]), 1
+    elif isinstance(node, ast.UnaryOp):
+        operand, width = wrap(node.operand, widths)
+        node = ast.UnaryOp(node.op, operand)
+        if isinstance(node.op, ast.Not):
+            return node, 1
+        elif width is not None and width < INF and not exact and \
+                isinstance(node.op, (ast.Invert, ast.USub)):
+            node = mask(node, width)
+        return node, width
+    elif isinstance(node, ast.IfExp):
+        body, body_width = wrap(node.body, widths)
+        orelse, orelse_width = wrap(node.orelse, widths)
+        return ast.IfExp(wrap(node.test, widths)[0], body, orelse), \
+            max(body_width or 0, orelse_width or 0) or None
+    elif isinstance(node, ast.Subscript) and get_index(node) is not None:
+        index = wrap(get_index(node), widths)[0]
+        if isinstance(node.slice, ast.Index):  # Python < 3.9
+            index = ast.Index(index)
+        return ast.Subscript(node.value, index, node.ctx), 1
+    return node, None
+
+
+def wrap_to(node, width, widths):
+    """
+    Returns ``node`` wrapped (see ``wrap``) and truncated to ``width`` bits
+    (not truncated if ``width`` is ``None``)
+    """
+    node, node_width = wrap(node, widths)
+    if width is not None and (node_width is None or node_width > width):
+        node = mask(node, width)
+    return node
+
+
+def compile(cfg, local_vars, tree, func_globals, func_locals, coverage=False,
+            file_name=None):
+    io_vars = get_io_vars(tree)
+    # Raises a ``TypeError`` for writes to inputs and reads from outputs, as
+    # with ``PyFSM``
+    rewrite_io_vars(deepcopy(tree), io_vars)
+    input_widths = {var.name: var.width for var in io_vars
+                    if var.typ == "Input"}
+    output_widths = {var.name: var.width for var in io_vars
+                     if var.typ == "Output"}
+    outputs = set(output_widths)
+    _, writes = collect_names_in_transitions(cfg.transitions)
+    declared = dict(local_vars)
+    local_vars = sorted(writes - outputs)
+    # Locals that are not bounded and not declared are left unbounded, the
+    # python ints of 64 bits and more are not wrapped
+    widths = {name: width for name, width in infer_widths(
+        cfg.transitions, [(name, declared.get(name)) for name in local_vars],
+        sorted(input_widths.items()), default_width=64) if width < 64}
+    widths.update(input_widths)
+
+    def lower(node):
+        if isinstance(node, ast.Subscript) and \
+           isinstance(node.value, ast.Name) and \
+           input_widths.get(node.value.id, 1) > 1 and \
+           get_index(node) is not None:
+            # Multi-bit inputs are indexed MSB first, as with ``PyFSM``
+            width = input_widths[node.value.id]
+            shift = ast.BinOp(ast.Num(width - 1), ast.Sub(), get_index(node))
+            return ast.BinOp(ast.BinOp(node.value, ast.RShift(), shift),
+                             ast.BitAnd(), ast.Num(1))
+        return node
+
+    def to_source(tree):
+        # Indexes are lowered after wrapping, their shifts do not wrap
+        tree = cfg.expressions.fold(cfg.expressions.transform(tree, lower))
+        return astor.to_source(tree).rstrip()
+
+    def emit_expr(tree, exact=False):
+        return to_source(wrap(cfg.expressions.fold(tree), widths, exact)[0])
+
+    def emit_statement(statement):
+        statement = cfg.expressions.fold(statement)
+        if isinstance(statement, ast.Assign) and \
+           len(statement.targets) == 1 and \
+           isinstance(statement.targets[0], ast.Name):
+            name = statement.targets[0].id
+            value = wrap_to(statement.value,
+                            output_widths.get(name, widths.get(name)), widths)
+            if isinstance(value, (ast.Compare, ast.BoolOp)) or \
+                    isinstance(value, ast.UnaryOp) and \
+                    isinstance(value.op, ast.Not):
+                # Variables hold ints, not bools.  A conditional expression
+                # is cheaper than calling ``int``.
+                value = ast.IfExp(value, ast.Num(1), ast.Num(0))
+            value = to_source(value)
+            if name in buffered:
+                return "_next_{} = {}".format(name, value)
+            return "{} = {}".format(name, value)
+        return to_source(statement)
+
+    joins = find_joins(sort_transitions(cfg.transitions))
+    paths = bases = increments = None
+    if coverage:
+        bases, increments, _ = get_path_numbering(cfg.transitions)
+        paths = get_paths(cfg.transitions)
+
+    source = Source()
+    buffered = set()
+
+    def emit_fast_forward(yield_id, indent):
+        loops = get_self_loops(cfg.transitions[yield_id], yield_id,
+                               set(local_vars))
+        for i, (index, conds, counter, bounds) in enumerate(loops):
+            checks = ["_budget > 1", "not _tracing"]
+            for cond, value in conds:
+                cond = emit_expr(cond)
+                checks.append(cond if value else "not ({})".format(cond))
+            source.add_line(indent + "{} {}:".format(
+                "if" if i == 0 else "elif", " and ".join(checks)))
+            counts = ["_budget"]
+            for expr, op, bound in bounds:
+                counts.append(emit_count_iterations(
+                    emit_expr(expr, True), counter[1], op, bound))
+            if counter is not None and counter[0] in widths:
+                # Stops before the counter wraps around
+                counts.append(emit_count_iterations(
+                    counter[0], counter[1], "<" if counter[1] > 0 else ">=",
+                    1 << widths[counter[0]] if counter[1] > 0 else 0))
+            counts = [count for count in counts if count is not None]
+            count = "min({})".format(", ".join(counts)) \
+                if len(counts) > 1 else counts[0]
+            source.add_line(indent + "    _skip = {} - 1".format(count))
+            if counter is not None:
+                source.add_line(indent + "    {} += {} * _skip".format(
+                    counter[0], counter[1]))
+            if coverage:
+                source.add_line(indent + "    _coverage[{}] += _skip".format(
+                    bases[yield_id] + index))
+            source.add_line(indent + "    _budget -= _skip")
+
+    def emit_yield(yield_id, indent):
+        root = cfg.transitions[yield_id]
+        reads, writes = collect_names_in_transitions({yield_id: root})
+        # Only read the inputs used by this yield
+        for name in sorted(reads & set(input_widths)):
+            source.add_line(indent + "{0} = _io_{0}._value".format(name))
+        if coverage:
+            source.add_line(indent + "_path = {}".format(bases[yield_id]))
+        emit_fast_forward(yield_id, indent)
+        # Statements read the values from the start of the cycle, so a local
+        # that is also read is updated once the transition is done
+        buffered.clear()
+        buffered.update(reads & writes & set(local_vars))
+        for name in sorted(buffered):
+            source.add_line(indent + "_next_{0} = {0}".format(name))
+        emit_transition(source, root, None, joins, indent, emit_statement,
+                        emit_expr, increments)
+        for name in sorted(buffered):
+            source.add_line(indent + "{0} = _next_{0}".format(name))
+
+    # The FSM runs as a generator, so the locals are fast local variables
+    params = ", ".join(["_state", "_coverage"] +
+                       ["_io_" + var.name for var in io_vars])
+    state_vars = ["yield_state"] + local_vars
+    # Outputs are never read, so they are local variables too, stored to
+    # their ``Output_`` only before yielding
+    output_names = sorted(outputs)
+    source.add_line("def run({}):".format(params))
+    source.add_line("    yield_state = 0")
+    for var in local_vars + output_names:
+        source.add_line("    {} = 0".format(var))
+    # ``_budget`` is the number of cycles left to run before yielding
+    source.add_line("    _budget = 1")
+    source.add_line("    _tracing = False")
+    source.add_line("    while True:")
+    emit_dispatch(source, sorted(cfg.transitions), "        ", emit_yield)
+    state_widths = [max(cfg.transitions).bit_length() or 1] + \
+        [widths.get(name) for name in local_vars]
+    signals = list(zip(state_vars, state_widths)) + [
+        (var.name if var.name in outputs else "_io_{}._value".format(
+            var.name), var.width) for var in io_vars]
+    # While tracing, each cycle appends the lines of the signals that
+    # changed, after the time of the cycle.  The lines are flushed before
+    # the first change of a cycle once a chunk of cycles was traced.
+    mark = ["_marked = True",
+            "if _time >= _flush_time:",
+            "    _flush_time = _time + _chunk_size",
+            "    _flush()",
+            '_append("#%d\\n" % _time)']
+    source.add_line("        if _tracing:")
+    source.add_line("            _time += 1")
+    source.add_line("            _marked = False")
+    for index, (value, width) in enumerate(signals):
+        source.add_line("            if {} != _last_{}:".format(value, index))
+        source.add_line("                _last_{} = {}".format(index, value))
+        if index == 0:
+            for line in mark:
+                source.add_line("                " + line)
+        else:
+            source.add_line("                if not _marked:")
+            for line in mark:
+                source.add_line("                    " + line)
+        if width is not None and width <= TABLE_WIDTH:
+            line = "_vcd_{0}[_last_{0}]".format(index)
+        else:
+            line = "_vcd_{0}(_last_{0} & {1})".format(
+                index, (1 << (64 if width is None else width)) - 1)
+        source.add_line("                _append({})".format(line))
+    source.add_line("        if _budget > 1:")
+    source.add_line("            _budget -= 1")
+    source.add_line("        else:")
+    for name in output_names:
+        source.add_line("            _io_{0}._value = {0}".format(name))
+    source.add_line("            _budget = (yield) or 1")
+    state = "{},".format(", ".join(state_vars))
+    source.add_line("            while _budget < 0:")
+    source.add_line("                if _budget == {}:".format(SAVE_STATE))
+    source.add_line("                    _state[:] = {}".format(state))
+    source.add_line("                elif _budget == {}:".format(LOAD_STATE))
+    source.add_line("                    {} = _state".format(state))
+    for name in output_names:
+        # ``restore`` sets the outputs before loading the state
+        source.add_line("                    {0} = _io_{0}._value".format(name))
+    source.add_line("                elif _budget == {}:".format(SET_TRACE))
+    source.add_line("                    _tracing = _state[0] is not None")
+    source.add_line("                    if _tracing:")
+    source.add_line("                        _append, _flush, _chunk_size, "
+                    "_time, {}, = _state".format(
+                        ", ".join("_vcd_{}".format(index)
+                                  for index in range(len(signals)))))
+    source.add_line("                        _flush_time = _time + _chunk_size")
+    source.add_line("                        {}, = {},".format(
+        ", ".join("_last_{}".format(index) for index in range(len(signals))),
+        ", ".join(value for value, _ in signals)))
+    source.add_line("                else:")
+    source.add_line("                    _time, = _state")
+    source.add_line("                _budget = (yield) or 1")
+    if int(os.environ.get("SILICA_DEBUG", "0")) >= 1:
+        print(source)
+
+    namespace = dict(func_globals)
+    namespace.update(func_locals)
+    namespace["_count_iterations"] = count_iterations
+    exec(str(source), namespace)
+    return PySimFSMDefinition(io_vars, state_vars, state_widths,
+                              namespace["run"], str(source), paths, file_name)
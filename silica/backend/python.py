@@ -1,5 +1,10 @@
 import ast
+import itertools
+from collections import namedtuple
+from types import SimpleNamespace
+import numpy as np
 from silica.ast_utils import *
+from silica.backend.vcd import VCDWriter
 from silica.types import *
 from silica.transformations.specialize_constants import specialize_constants
 
@@ -55,6 +60,26 @@ class IOVarRewriter(ast.NodeTransformer):
 def rewrite_io_vars(tree, io_vars):
     return IOVarRewriter(io_vars).visit(tree)
 
+
+def get_io_vars(tree):
+    """
+    Returns an ``IOVar`` for each argument of ``tree`` (an
+    ``ast.FunctionDef``) annotated with ``Input``, ``Output``,
+    ``Input[width]`` or ``Output[width]``
+    """
+    io_vars = []
+    for arg in tree.args.args:
+        annotation = arg.annotation
+        width = 1  # default width
+        if is_subscript(annotation):
+            index = get_index(annotation)
+            assert isinstance(index, ast.Num)
+            width = index.n
+            annotation = annotation.value  # Input[1] -> Input
+        assert annotation.id in {"Input", "Output"}, annotation.id
+        io_vars.append(IOVar(arg.arg, annotation.id, width))
+    return io_vars
+
 def get_global_vars_for_func(fn):
     """
     inspect.getmembers() returns a list of (name, value) pairs.
@@ -63,21 +88,244 @@ def get_global_vars_for_func(fn):
     return [x for x in inspect.getmembers(fn) if x[0] == "__globals__"][0][1]
 
 
-class PyFSM:
+# The state of a simulation at cycle ``cycle``: ``state`` maps
+# ``"yield_state"`` and each local to its value and ``io`` maps each port to
+# its value
+Snapshot = namedtuple("Snapshot", ["cycle", "state", "io"])
+
+
+def iterate_input(value):
+    """
+    Returns an iterator over the per-cycle values of an input given to
+    ``Simulation.run``: an int (the same value every cycle), a NumPy array or
+    any iterable
+    """
+    if isinstance(value, int):
+        return itertools.repeat(value)
+    elif isinstance(value, np.ndarray):
+        # Python ints are cheaper to compute with than NumPy scalars
+        return iter(value.tolist())
+    return iter(value)
+
+
+def get_cycles(inputs):
+    """
+    Returns the length of the shortest input given to ``Simulation.run``
+    that has a length, raises a ``ValueError`` if there are none
+    """
+    lengths = [len(value) for value in inputs.values()
+               if hasattr(value, "__len__")]
+    if not lengths:
+        raise ValueError("The number of cycles is not bounded, inputs "
+                         "without a length need cycles")
+    return min(lengths)
+
+
+class Simulation:
+    """
+    Drives a simulation with streams of inputs, for classes with an ``IO``
+    field holding the ``Input_`` and ``Output_`` containers, a ``__next__``
+    method running one cycle and a ``_run(cycles)`` method advancing the FSM
+    by ``cycles`` enabled cycles.  For tracing, they also implement
+    ``_get_trace_signals`` and ``_get_trace_row`` (see ``VCDWriter``) and
+    ``_set_tracing(tracer)``, which starts recording the cycles to the
+    ``VCDWriter`` (stops if it is ``None``), as rows or as formatted lines.
+    Simulations setting ``_traces_cycles`` time the lines and flush the
+    writer themselves, so their enabled cycles skip ``start`` and ``ran``.
+    ``silica.backend.network`` compares the rows of
+    ``_get_state_row`` to find idle instances.
+
+    Fields:
+        * ``self.cycle`` - the number of cycles run, enabled or not
+        * ``self.ce_schedule`` - ``None`` if the FSM is enabled by its ``CE``
+          input (if it has one), otherwise a period ``n`` (enabled every
+          ``n`` cycles, starting with cycle ``0``) or a sorted array of the
+          enabled cycles
+    """
+    cycle = 0
+    ce_schedule = None
+    _tracer = None
+    # True if ``next`` has to go through ``run_until``: cycles can be
+    # disabled (by a ``CE`` input or a schedule) or are traced by the writer
+    _slow = False
+    _traces_cycles = False
+
+    def _get_state_row(self):
+        """
+        Returns the values of the state and the ports, the FSM is idle if a
+        cycle does not change them.  ``None`` if the state is not known.
+        """
+        return self._get_trace_row()
+
+    def _update_slow(self):
+        self._slow = self.ce_schedule is not None or \
+            hasattr(self.IO, "CE") or \
+            (self._tracer is not None and not self._traces_cycles)
+
+    def set_ce_schedule(self, schedule):
+        """
+        Sets ``self.ce_schedule`` to ``schedule``, a period or an iterable of
+        the enabled cycles.  ``None`` goes back to the ``CE`` input.
+        """
+        if schedule is not None and not isinstance(schedule, int):
+            schedule = np.unique(np.asarray(list(schedule), dtype=np.int64))
+        self.ce_schedule = schedule
+        self._update_slow()
+
+    def count_enabled(self, cycles):
+        """
+        Returns the number of enabled cycles among the next ``cycles``
+        """
+        start, stop = self.cycle, self.cycle + cycles
+        schedule = self.ce_schedule
+        if schedule is None:
+            ce = getattr(self.IO, "CE", None)
+            return cycles if ce is None or ce._value else 0
+        elif isinstance(schedule, int):
+            # The multiples of the period in [start, stop)
+            return -(-stop // schedule) + (-start // schedule)
+        return int(np.searchsorted(schedule, stop) -
+                   np.searchsorted(schedule, start))
+
+    def run_until(self, cycles):
+        """
+        Runs ``cycles`` cycles with the inputs held at their current values,
+        the FSM only advances on the enabled cycles
+        """
+        if cycles <= 0:
+            return
+        tracer = self._tracer
+        if tracer is None or \
+           (self._traces_cycles and self.ce_schedule is None):
+            self._run(self.count_enabled(cycles))
+            self.cycle += cycles
+        elif self.ce_schedule is None:
+            if not self.count_enabled(cycles):
+                self.cycle += cycles
+                return
+            # Records a row per cycle, flushed by the tracer every chunk
+            while cycles > 0:
+                chunk = min(cycles, tracer.chunk_size)
+                tracer.start(self.cycle + 1)
+                self._run(chunk)
+                self.cycle += chunk
+                cycles -= chunk
+                tracer.ran(self.cycle + 1)
+        else:
+            for _ in range(cycles):
+                if self.count_enabled(1):
+                    tracer.start(self.cycle + 1)
+                    self._run(1)
+                    tracer.ran(self.cycle + 2)
+                self.cycle += 1
+
+    def trace(self, file, chunk_size=1 << 16):
+        """
+        Starts recording the ports, ``yield_state`` and the locals of every
+        cycle to ``file`` (a path or a file object) as a VCD waveform, one
+        time unit per cycle.
+
+        Returns the ``VCDWriter``
+        """
+        if self._tracer is not None:
+            self.stop_trace()
+        self._tracer = VCDWriter(file, self._get_trace_signals(), self.cycle,
+                                 chunk_size=chunk_size)
+        self._tracer.rows.extend(self._get_trace_row())
+        self._tracer.ran(self.cycle + 1)
+        self._set_tracing(self._tracer)
+        self._update_slow()
+        return self._tracer
+
+    def stop_trace(self):
+        """
+        Stops recording and writes the rest of the waveform
+        """
+        self._set_tracing(None)
+        self._tracer.close()
+        self._tracer = None
+        self._update_slow()
+
+    def stream(self, inputs, cycles=None, chunk_size=4096):
+        """
+        Each cycle sets the inputs to the next value from ``inputs`` (a dict
+        mapping input names to values accepted by ``iterate_input``), then
+        runs the cycle and records the outputs.  Stops after ``cycles``
+        cycles or when an input runs out.
+
+        Yields dicts mapping each output name to a NumPy array with the
+        values of (up to) ``chunk_size`` cycles.  Multi-bit outputs are
+        recorded as integers.
+        """
+        ports = [getattr(self.IO, name) for name in inputs]
+        values = [iterate_input(inputs[name]) for name in inputs]
+        outputs = [(name, port) for name, port in vars(self.IO).items()
+                   if isinstance(port, Output_)]
+        cycle_values = zip(*values) if values else itertools.repeat(())
+        if cycles is not None:
+            cycle_values = itertools.islice(cycle_values, cycles)
+        step = self.__next__
+        while True:
+            traces = [[] for _ in outputs]
+            count = 0
+            for cycle in itertools.islice(cycle_values, chunk_size):
+                for port, value in zip(ports, cycle):
+                    port.value = value
+                step()
+                for trace, (_, port) in zip(traces, outputs):
+                    trace.append(port._value)
+                count += 1
+            if count == 0:
+                return
+            yield {name: np.array(trace, dtype=np.int64)
+                   for trace, (name, _) in zip(traces, outputs)}
+            if count < chunk_size:
+                return
+
+    def run(self, inputs, cycles=None):
+        """
+        Like ``stream``, but returns a dict mapping each output name to a
+        NumPy array with its value in every cycle.  Raises a ``ValueError``
+        if ``cycles`` is not given and no input has a length (a list or an
+        array, not an iterator), as the inputs might never run out.
+        """
+        if cycles is None:
+            cycles = get_cycles(inputs)
+        chunks = list(self.stream(inputs, cycles))
+        return {name: np.concatenate([chunk[name] for chunk in chunks])
+                if chunks else np.zeros(0, dtype=np.int64)
+                for name, port in vars(self.IO).items()
+                if isinstance(port, Output_)}
+
+
+class PyFSMDefinition:
+    """
+    Rewrites and ``exec``s the FSM once, calling the definition returns a
+    new independent ``PyFSM``.  The definition also forwards ``next`` and
+    its other attributes (``IO``, ``run``, ...) to a default instance, so it
+    can be used as a single simulation.
+
+    Fields:
+        * ``self.io_vars`` - the ``IOVar`` of each argument
+        * ``self.clock_enable`` - whether instances have a ``CE`` input
+        * ``self.function`` - the rewritten generator function
+        * ``self.hidden_state`` - whether the generator has state that is not
+          in its locals, the iterators of ``for`` loops not over a ``range``
+        * ``self.instance`` - the default instance
+    """
     def __init__(self, f, clock_enable):
+        self.clock_enable = clock_enable
         # `ast_utils.get_ast` returns a module so grab first statement in body
         tree = get_ast(f).body[0]
-        io_vars = []
-        for arg in tree.args.args:
-            annotation = arg.annotation
-            width = 1  # default width
-            if is_subscript(annotation):
-                assert isinstance(annotation.slice.value, ast.Num)
-                width = annotation.slice.value.n
-                annotation = annotation.value  # Input[1] -> Input
-            assert annotation.id in {"Input", "Output"}, annotation.id
-            io_vars.append(IOVar(arg.arg, annotation.id, width))
-        tree = rewrite_io_vars(tree, io_vars)
+        # The loop variable of a ``range`` changes every iteration
+        self.hidden_state = any(
+            isinstance(node, ast.For) and not (
+                isinstance(node.iter, ast.Call) and
+                isinstance(node.iter.func, ast.Name) and
+                node.iter.func.id == "range")
+            for node in ast.walk(tree))
+        self.io_vars = get_io_vars(tree)
+        tree = rewrite_io_vars(tree, self.io_vars)
         tree.decorator_list = []
         constants = {}
         func_globals = get_global_vars_for_func(f)
@@ -87,16 +335,85 @@ class PyFSM:
         tree = specialize_constants(tree, constants)
         src = astor.to_source(tree)
         # print(src)
-        exec(src)
-        f = eval(tree.name)
+        namespace = {}
+        exec(src, globals(), namespace)
+        self.function = namespace[tree.name]
+        self.instance = PyFSM(self)
+
+    def __call__(self):
+        return PyFSM(self)
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+    def __next__(self):
+        next(self.instance)
+
+
+class PyFSM(Simulation):
+    """
+    An instance of a ``PyFSMDefinition`` with its own coroutine and IO
+    containers.  With ``clock_enable``, ``IO.CE`` (initially high) is the
+    clock enable, the FSM holds its state on cycles where it is low.
+
+    There is no ``snapshot`` or ``restore``, a generator can not be copied.
+    The pysim, netlist and c simulations support them.
+    """
+    def __init__(self, definition):
         args = []
-        for var in io_vars:
+        for var in definition.io_vars:
             args.append(var.get_container())
-        self.cor = f(*args)
+        self.cor = definition.function(*args)
         next(self.cor)
-        self.IO = lambda x: None  # Hack, allows us to dynamically add attributes
-        for var, arg in zip(io_vars, args):
+        self.IO = SimpleNamespace()
+        for var, arg in zip(definition.io_vars, args):
             setattr(self.IO, var.name, arg)
+        if definition.clock_enable:
+            self.IO.CE = Input_(1)
+            self.IO.CE.value = 1
+            self._slow = True
+        self._hidden_state = definition.hidden_state
+        self._ports = [(var.name, arg) for var, arg in
+                       zip(definition.io_vars, args)]
+        code = self.cor.gi_code
+        self._locals = code.co_varnames[code.co_argcount:]
+
+    def _run(self, cycles):
+        if self._tracer is None:
+            for _ in range(cycles):
+                next(self.cor)
+        else:
+            rows = self._tracer.rows
+            for _ in range(cycles):
+                next(self.cor)
+                rows.extend(self._get_trace_row())
+
+    def _get_state_row(self):
+        # The state of a ``yield from`` (e.g. a ``range``) is not in the
+        # frame
+        if self._hidden_state or self.cor.gi_yieldfrom is not None:
+            return None
+        return self._get_trace_row()
+
+    def _get_trace_signals(self):
+        # The generator does not have a ``yield_state``, the line of the
+        # current ``yield`` is recorded instead
+        return [(name, port.width) for name, port in self._ports] + \
+            [("yield_state", None)] + [(name, None) for name in self._locals]
+
+    def _get_trace_row(self):
+        frame = self.cor.gi_frame
+        values = frame.f_locals
+        return tuple(port._value for _, port in self._ports) + \
+            (frame.f_lineno, ) + \
+            tuple(values.get(name) for name in self._locals)
+
+    def _set_tracing(self, tracer):
+        pass
 
     def __next__(self):
-        next(self.cor)
+        if self._slow:
+            self.run_until(1)
+        else:
+            self.cycle += 1
+            next(self.cor)
@@ -0,0 +1,232 @@
+"""
+Writes the traces of the python simulations as VCD waveforms
+
+Simulations append one row (the value of every signal) per cycle to
+``VCDWriter.rows``.  Rows are only compared and formatted when the writer is
+flushed, in chunks of many cycles: NumPy finds the signals that changed and
+only those changes are written.
+
+Simulations generating code (pysim) find the changes themselves instead and
+append the formatted lines to ``VCDWriter.lines``, with the lines of
+``get_line_format``, flushing the writer every chunk.
+"""
+import numpy as np
+
+# Signals with up to this many bits have their lines precomputed
+TABLE_WIDTH = 12
+
+
+def get_identifier(index):
+    """
+    Returns the VCD identifier of the ``index``th signal, in base 94 with the
+    printable ASCII characters as digits
+    """
+    identifier = ""
+    while True:
+        identifier += chr(33 + index % 94)
+        index //= 94
+        if index == 0:
+            return identifier
+
+
+class VCDWriter:
+    """
+    Fields:
+        * ``self.signals`` - a list of ``(name, width)``, the columns of the
+          rows.  A width of ``None`` records the value as a 64 bit integer.
+        * ``self.rows`` - the values of the rows recorded since the last
+          flush, one after the other in a flat list
+        * ``self.segments`` - a list of ``(index, time)``, the row at
+          ``index`` (and the rows after it) start at ``time``, a row is
+          otherwise one cycle after the row before it
+        * ``self.next_time`` - the time of the next row if it is not moved
+          by ``start``
+        * ``self.lines`` - the lines appended since the last flush by a
+          simulation finding the changes itself, written after the rows
+    """
+    def __init__(self, file, signals, time, scope="top", chunk_size=1 << 16):
+        if isinstance(file, str):
+            self.file = open(file, "w")
+            self.owns_file = True
+        else:
+            self.file = file
+            self.owns_file = False
+        self.signals = signals
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.lines = []
+        self.segments = [(0, time)]
+        self.next_time = time
+        self.last = None
+        self.identifiers = [get_identifier(i) for i in range(len(signals))]
+        self.masks = [(1 << (64 if width is None else width)) - 1
+                      for _, width in signals]
+        # The formatted lines of all the values of narrow signals, indexed
+        # by value (see ``get_table``)
+        self.tables = {}
+        header = ["$timescale 1ns $end\n",
+                  "$scope module {} $end\n".format(scope)]
+        for (name, width), identifier in zip(signals, self.identifiers):
+            if width is None:
+                header.append("$var integer 64 {} {} $end\n".format(
+                    identifier, name))
+            else:
+                header.append("$var wire {} {} {} $end\n".format(
+                    width, identifier, name))
+        header.append("$upscope $end\n$enddefinitions $end\n")
+        self.file.write("".join(header))
+
+    def start(self, time):
+        """
+        Called before running from ``time``, the next row is at ``time``
+        """
+        if time != self.next_time:
+            self.segments.append((len(self.rows) // len(self.signals),
+                                  time))
+
+    def ran(self, time):
+        """
+        Called after running, ``time`` is the time of the next row
+        """
+        self.next_time = time
+        if len(self.rows) >= self.chunk_size * len(self.signals):
+            self.flush()
+
+    def format_value(self, index, value):
+        if value is None:
+            value = "x"
+        else:
+            value = format(int(value) & self.masks[index], "b")
+        if self.signals[index][1] == 1:
+            return value + self.identifiers[index] + "\n"
+        return "b{} {}\n".format(value, self.identifiers[index])
+
+    def format_changes(self, values, times):
+        """
+        Returns the lines for the changes between consecutive rows of
+        ``values`` (an array starting with the last row written), the rows
+        after the first are at ``times``.  Each distinct value of a signal is
+        only formatted once.
+        """
+        changed_rows, changed_signals = np.nonzero(values[1:] != values[:-1])
+        if len(changed_rows) == 0:
+            return []
+        changed_values = values[1:][changed_rows, changed_signals]
+        lines = np.empty(len(changed_rows), dtype=object)
+        counts = np.bincount(changed_signals, minlength=len(self.signals))
+        for index in np.flatnonzero(counts).tolist():
+            selected = changed_signals == index
+            table = self.get_table(index)
+            if table is not None:
+                lines[selected] = table[changed_values[selected] &
+                                        self.masks[index]]
+                continue
+            distinct, inverse = np.unique(changed_values[selected],
+                                          return_inverse=True)
+            formatted = np.array([self.format_value(index, value)
+                                  for value in distinct.tolist()],
+                                 dtype=object)
+            lines[selected] = formatted[inverse]
+        # Each row with changes starts with its time
+        new_row = np.empty(len(changed_rows), dtype=bool)
+        new_row[0] = True
+        new_row[1:] = changed_rows[1:] != changed_rows[:-1]
+        positions = np.arange(len(changed_rows)) + np.cumsum(new_row)
+        output = np.empty(len(changed_rows) + int(new_row.sum()),
+                          dtype=object)
+        output[positions] = lines
+        output[positions[new_row] - 1] = list(map(
+            "#{}\n".format,
+            np.asarray(times)[changed_rows[new_row]].tolist()))
+        return output.tolist()
+
+    def get_table(self, index):
+        """
+        Returns an array with the line of each value of a signal with at most
+        ``TABLE_WIDTH`` bits, otherwise ``None``
+        """
+        width = self.signals[index][1]
+        if width is None or width > TABLE_WIDTH:
+            return None
+        if index not in self.tables:
+            self.tables[index] = np.array(
+                [self.format_value(index, value)
+                 for value in range(1 << width)], dtype=object)
+        return self.tables[index]
+
+    def get_line_format(self, index):
+        """
+        Returns the lines of the changes of the ``index``th signal: a list
+        indexed by its value if it has at most ``TABLE_WIDTH`` bits,
+        otherwise a function of its value masked to its width
+        """
+        table = self.get_table(index)
+        if table is not None:
+            return table.tolist()
+        return "b{{:b}} {}\n".format(self.identifiers[index]).format
+
+    def get_times(self):
+        count = len(self.rows) // len(self.signals)
+        times = np.empty(count, dtype=np.int64)
+        bounds = self.segments + [(count, None)]
+        for (start, time), (stop, _) in zip(bounds, bounds[1:]):
+            times[start:stop] = np.arange(time, time + stop - start)
+        return times
+
+    def flush(self):
+        """
+        Writes the value changes in ``self.rows`` and the lines in
+        ``self.lines`` and clears them
+        """
+        if self.rows:
+            self.flush_rows()
+        if self.lines:
+            self.file.write("".join(self.lines))
+            del self.lines[:]
+        self.segments = [(0, self.next_time)]
+
+    def flush_rows(self):
+        times = self.get_times().tolist()
+        width = len(self.signals)
+        output = []
+        rows = self.rows
+        if self.last is None:
+            output.append("#{}\n$dumpvars\n".format(times[0]))
+            for index, value in enumerate(rows[:width]):
+                output.append(self.format_value(index, value))
+            output.append("$end\n")
+            self.last = rows[:width]
+            rows, times = rows[width:], times[1:]
+        try:
+            values = np.array(self.last + rows, dtype=np.int64)
+        except (TypeError, ValueError, OverflowError):
+            # Values that are not all integers (``None``)
+            values = None
+        if values is not None:
+            output.extend(self.format_changes(values.reshape(-1, width),
+                                              times))
+        else:
+            current = None
+            last = self.last
+            for row_index in range(len(times)):
+                row = rows[row_index * width:(row_index + 1) * width]
+                for index, (value, old) in enumerate(zip(row, last)):
+                    if value != old:
+                        if row_index != current:
+                            current = row_index
+                            output.append("#{}\n".format(times[row_index]))
+                        output.append(self.format_value(index, value))
+                last = row
+        if rows:
+            self.last = rows[-width:]
+        self.file.write("".join(output))
+        # Simulations hold a reference to the lists, so they are cleared in
+        # place
+        del self.rows[:]
+
+    def close(self):
+        self.flush()
+        if self.owns_file:
+            self.file.close()
+        else:
+            self.file.flush()
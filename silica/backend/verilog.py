@@ -2,6 +2,8 @@ import ast
 import astor
 import magma
 import os
+from silica.cfg.types import Step, Decision
+from silica.cfg.control_flow_graph import sort_transitions, find_joins
 
 def compile(cfg, local_vars, tree, clock_enable, func_globals, func_locals, file_dir):
     local_widths = {name: width for name, width in local_vars}
@@ -18,7 +20,7 @@ def compile(cfg, local_vars, tree, clock_enable, func_globals, func_locals, file
     params.append("input CLKIN")
     source = ""
     source += "module {}({});\n".format(tree.name, ", ".join(params))
-    state_width = (len(cfg.states) - 1).bit_length()
+    state_width = max((len(cfg.transitions) - 1).bit_length(), 1)
     source += "reg [{}:0] yield_state;\n".format(state_width - 1)
     source += "initial begin\n    yield_state = 0;\nend\n"
     for var in sorted(cfg.state_vars):  # Sort for regression tests
@@ -29,21 +31,15 @@ def compile(cfg, local_vars, tree, clock_enable, func_globals, func_locals, file
         source += "always @(posedge CLKIN) if (clock_enable) begin\n"
     else:
         source += "always @(posedge CLKIN) begin\n"
-    for state in cfg.states:
-        if state is cfg.states[0]:  # Is first state hack
+    joins = find_joins(sort_transitions(cfg.transitions))
+    for yield_id, root in sorted(cfg.transitions.items()):
+        if yield_id == 0:  # Is first state hack
             prog = "if "
         else:
             prog = "else if "
-        prog += "({}".format(astor.to_source(state.yield_state).rstrip())
-        if len(state.conds) > 0:
-            prog += " && "
-        prog += " && ".join(astor.to_source(cond) for cond in state.conds).rstrip()
-        prog += ") begin \n    "
-        prog += ";\n    ".join(astor.to_source(statement).rstrip() for statement in state.statements)
-        prog += ";\nend\n"
-        prog = prog.replace("~", "!")
-        prog = prog.replace(" = ", " <= ")
-        prog = prog.replace("and", "&&")
+        prog += "(yield_state == {}) begin\n".format(yield_id)
+        prog += emit_transition(root, None, joins, "    ")
+        prog += "end\n"
         prog = "\n    ".join(prog.splitlines())
         source += "    " + prog + "\n"
     source += "end\n"
@@ -51,3 +47,47 @@ def compile(cfg, local_vars, tree, clock_enable, func_globals, func_locals, file
     with open(os.path.join(file_dir, tree.name + ".v"), "w") as f:
         f.write(source)
     return None
+
+
+def to_verilog(tree):
+    prog = astor.to_source(tree).rstrip()
+    prog = prog.replace("~", "!")
+    prog = prog.replace(" = ", " <= ")
+    prog = prog.replace("and", "&&")
+    return prog
+
+
+def emit_transition(node, stop, joins, indent):
+    """
+    Emits the decision diagram starting at ``node`` up to (but not including)
+    ``stop`` as nested ``if``/``else`` blocks.  The edges of a ``Decision``
+    are emitted up to their join, which is then emitted once after the
+    ``if``/``else``.  Assignments are non-blocking and the statements only
+    read values from the previous cycle, so this is equivalent to executing
+    each path.
+    """
+    prog = ""
+    while node is not stop and node is not None:
+        if isinstance(node, Step):
+            for statement in node.statements:
+                prog += indent + to_verilog(statement) + ";\n"
+            node = node.next
+        elif isinstance(node, Decision):
+            join = joins[node]
+            cond = to_verilog(node.cond)
+            true_edge, false_edge = node.true_edge, node.false_edge
+            if true_edge is join:
+                # Only the false edge does anything
+                cond = "!({})".format(cond)
+                true_edge, false_edge = false_edge, true_edge
+            prog += indent + "if ({}) begin\n".format(cond)
+            prog += emit_transition(true_edge, join, joins, indent + "    ")
+            if false_edge is not join:
+                prog += indent + "end else begin\n"
+                prog += emit_transition(false_edge, join, joins, indent + "    ")
+            prog += indent + "end\n"
+            node = join
+        else:
+            prog += indent + "yield_state <= {};\n".format(node.end_yield_id)
+            break
+    return prog
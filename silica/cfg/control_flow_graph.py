@@ -4,20 +4,25 @@ Silica's Control Flow Graph (CFG)
 TODO: We need an explicit HeadBlock object?
 """
 import tempfile
+import operator
 from copy import deepcopy
 
 import ast
 import astor
 import magma
 
-from silica.transformations import specialize_constants, replace_symbols, constant_fold
+from silica.transformations import specialize_constants
 from silica.visitors import collect_names
-from silica.cfg.types import BasicBlock, Yield, Branch, HeadBlock, State
+from silica.cfg.types import BasicBlock, Yield, Branch, HeadBlock, State, \
+    PathNode, Step, Decision, End, BlockGraph, sort_transitions
+from silica.cfg.minimize_states import minimize_states
+from silica.cfg.expressions import ExpressionTable
 
 
 def parse_arguments(arguments):
     """
-    arguments : a list of ast.arg nodes each annotated with a magma In or Out type
+    arguments : a list of ast.arg nodes each annotated with a magma In or Out
+                type (or a silica Input or Output type)
 
     return    : a tuple (inputs, outputs), where inputs and outputs sets of
                 strings containing the input and output arguments respectively
@@ -25,6 +30,17 @@ def parse_arguments(arguments):
     outputs = set()
     inputs = set()
     for arg in arguments:
+        annotation = arg.annotation
+        if isinstance(annotation, ast.Subscript):
+            annotation = annotation.value  # Input[8] -> Input
+        if isinstance(annotation, ast.Name) and \
+           annotation.id in ("Input", "Output"):
+            # Types used by the python backends (``silica.types``)
+            if annotation.id == "Output":
+                outputs.add(arg.arg)
+            else:
+                inputs.add(arg.arg)
+            continue
         _type = eval(astor.to_source(arg.annotation), globals(), magma.__dict__)()
         if _type.isoutput():
             outputs.add(arg.arg)
@@ -38,43 +54,44 @@ def add_edge(source, sink, label=""):
     """
     Add an edge between source and sink with label
     """
-    source.add_outgoing_edge(sink, label)
-    sink.add_incoming_edge(source, label)
+    source.graph.add_edge(source.id, sink.id, label)
 
 
 def add_true_edge(source, sink):
     """
-    Add an edge form source to sink with label="T" and set the ``true_edge``
-    attribute on source
+    Add an edge form source to sink with label="T", the ``true_edge`` of
+    source
     """
     assert isinstance(source, Branch)
-    source.add_outgoing_edge(sink, "T")
-    source.true_edge = sink
-    sink.add_incoming_edge(source, "T")
+    add_edge(source, sink, "T")
 
 
 def add_false_edge(source, sink):
     """
-    Add an edge from source to sink with label="F" and set the ``false_edge``
-    attribute on source
+    Add an edge from source to sink with label="F", the ``false_edge`` of
+    source
     """
     assert isinstance(source, Branch)
-    source.add_outgoing_edge(sink, "F")
-    source.false_edge = sink
-    sink.add_incoming_edge(source, "F")
+    add_edge(source, sink, "F")
 
 
-class ControlFlowGraph:
+class ControlFlowGraph(BlockGraph):
     """
     Params:
         * ``tree`` - an instance of ``ast.FunctionDef``
+        * ``minimize`` - merge equivalent yields (see
+          ``silica.cfg.minimize_states``)
 
     Fields:
         * ``self.curr_block`` - the current block used by the construction
           algorithm
+        * ``self.blocks``, ``self.outgoing``, ``self.incoming`` - the blocks
+          and edges, indexed by block id (see ``BlockGraph``)
+        * ``self.expressions`` - the ``ExpressionTable`` interning the
+          statements and conditions in ``self.transitions``
     """
-    def __init__(self, tree):
-        self.blocks = []
+    def __init__(self, tree, minimize=False):
+        super().__init__()
         self.curr_block = None
         self.curr_yield_id = 1
         self.initial_statements = None
@@ -83,28 +100,42 @@ class ControlFlowGraph:
         inputs, outputs = parse_arguments(tree.args.args)
         self.build(tree)
         self.bypass_conds()
-        try:
-            self.paths = self.collect_paths_between_yields()
-        except RecursionError as error:
-            # Most likely infinite loop in CFG, TODO: should catch this with an analysis phase
-            self.render()
-            raise error
-        self.paths = promote_live_variables(self.paths)
-        self.states, self.state_vars = build_state_info(self.paths, outputs, inputs)
+        self.check_for_combinational_loops()
+        self.paths = self.collect_paths_between_yields()
+        self.expressions = ExpressionTable()
+        self.transitions = promote_live_variables(self.blocks, self.paths,
+                                                  self.expressions)
+        self.transitions = prune_infeasible_paths(self.transitions)
+        self.transitions = remove_dead_assigns(self.transitions, outputs)
+        if minimize:
+            self.transitions = minimize_states(self.transitions)
+        self.state_vars = collect_state_vars(
+            self.transitions, outputs, inputs,
+            {var for var, _ in self.local_vars})
+        self._states = None
 
         # self.render()
-        # render_paths_between_yields(self.paths)
+        # render_paths_between_yields(self.blocks, self.collect_paths_between_yields())
         # render_fsm(self.states)
         # exit()
 
+    @property
+    def states(self):
+        """
+        A ``State`` for each path through ``self.transitions``, built the first
+        time it is accessed
+        """
+        if self._states is None:
+            self._states = build_state_info(self.transitions)
+        return self._states
+
     def build(self, func_def):
         """
         Called by ``__init__`` to actually construct the CFG
         TODO: Should self.local_vars logic be in here?
         """
         assert isinstance(func_def, ast.FunctionDef)
-        self.head_block = HeadBlock()
-        self.blocks.append(self.head_block)
+        self.head_block = self.add_block(HeadBlock())
         self.curr_block = self.gen_new_block()
         add_edge(self.head_block, self.curr_block)
         self.initial_statements = func_def.body[:-1]
@@ -112,45 +143,82 @@ class ControlFlowGraph:
             if isinstance(statement, ast.Assign) and isinstance(statement.value, ast.Call) and \
                isinstance(statement.value.func, ast.Name) and statement.value.func.id == "Register":
                 assert isinstance(statement.targets[0], ast.Name) and len(statement.targets) == 1
-                self.local_vars.add((statement.targets[0].id, statement.value.args[0].n))
+                # ``Register()`` leaves the width to ``infer_widths``
+                width = statement.value.args[0].n if statement.value.args else None
+                self.local_vars.add((statement.targets[0].id, width))
             else:
                 raise NotImplementedError()
         assert isinstance(func_def.body[-1], ast.While), "FSMs should end with a ``while True:``"
         self.process_stmt(func_def.body[-1])
         self.consolidate_empty_blocks()
         self.remove_if_trues()
+        self.compact()
 
-
-    def find_paths(self, block):
+    def collect_paths_between_yields(self):
         """
-        Given a block, recursively build paths to yields
+        Builds the DAG of paths between yields without enumerating them.
+
+        Each (block, outgoing edge label) pair becomes a single ``PathNode``
+        whose successors are the nodes for the blocks that edge leads to
+        (entering a ``Branch`` leads to both its "T" and "F" nodes).  Paths
+        stop at ``Yield`` nodes, so the graph restricted to edges that do not
+        leave a ``Yield`` must be acyclic.
+
+        Returns the root node of each Yield (and the HeadBlock), in the order
+        they appear in ``self.blocks``.  TODO: HeadBlock is confusing
+
+        Assumes ``self.check_for_combinational_loops`` has passed.
         """
-        if isinstance(block, Yield):
-            return [[deepcopy(block)]]
-        elif isinstance(block, BasicBlock):
-            return [[deepcopy(block)] + path for path in self.find_paths(block.outgoing_edge[0])]
-        elif isinstance(block, Branch):
-            true_paths = [[deepcopy(block)] + path for path in self.find_paths(block.true_edge)]
-            false_paths = [[deepcopy(block)] + path for path in self.find_paths(block.false_edge)]
-            for path in true_paths:
-                path[0].true_edge = path[1]
-            for path in false_paths:
-                path[0].false_edge = path[1]
-            return true_paths + false_paths
-        else:
-            raise NotImplementedError(type(block))
+        nodes = {}
+        worklist = []
 
-    def collect_paths_between_yields(self):
+        def entry_nodes(block):
+            labels = ("T", "F") if isinstance(block, Branch) else ("",)
+            result = []
+            for label in labels:
+                key = (block.id, label)
+                if key not in nodes:
+                    nodes[key] = PathNode(block.id, label)
+                    worklist.append(nodes[key])
+                result.append(nodes[key])
+            return result
+
+        roots = [entry_nodes(block)[0] for block in self.blocks
+                 if isinstance(block, (Yield, HeadBlock))]
+        while worklist:
+            node = worklist.pop()
+            outgoing = self.outgoing[node.block_id]
+            if node.label:
+                sink = next(sink for sink, label in outgoing if label == node.label)
+            else:
+                assert len(outgoing) == 1
+                sink = outgoing[0][0]
+            node.successors = entry_nodes(self.blocks[sink])
+        return roots
+
+    def check_for_combinational_loops(self):
         """
-        For each block, if it's a Yield (or HeadBlock): TODO: HeadBlock is confusing
-            Add a path for each path returned from calling ``self.find_paths`` on
-            the outgoing edge
+        Every loop in an FSM must contain a ``yield``, otherwise the hardware
+        would have a combinational cycle.  Computes the strongly connected
+        components of the CFG with the edges leaving a ``Yield`` removed and
+        raises a ``CombinationalLoopError`` listing the source lines of any
+        component that forms a cycle.
         """
-        paths = []
-        for block in self.blocks:
-            if isinstance(block, (Yield, HeadBlock)):
-                paths.extend([block] + path for path in self.find_paths(block.outgoing_edge[0]))
-        return paths
+        def successors(block_id):
+            if isinstance(self.blocks[block_id], Yield):
+                return []
+            return [sink for sink, _ in self.outgoing[block_id]]
+
+        for component in strongly_connected_components(
+                range(len(self.blocks)), successors):
+            if len(component) == 1 and component[0] not in successors(component[0]):
+                continue
+            lines = set()
+            for block_id in component:
+                lines |= get_line_numbers(self.blocks[block_id])
+            raise CombinationalLoopError(
+                "Found a loop without a yield in the FSM (lines {})".format(
+                    ", ".join(str(line) for line in sorted(lines))))
 
     def bypass_conds(self):
         """
@@ -158,19 +226,20 @@ class ControlFlowGraph:
         Initially used for the ``if True:`` branch node emitted by
         the top-level ``while True:`` found in FSM definitions.
         """
-        for block in self.get_basic_blocks_followed_by_branches():
+        for block in list(self.get_basic_blocks_followed_by_branches()):
             constants = collect_constant_assigns(block.statements)
             branch = block.outgoing_edge[0]
             cond = deepcopy(branch.cond)
             cond = specialize_constants(cond, constants)
             try:
                 if eval(astor.to_source(cond)):
-                    # FIXME: Interface violation, need a remove method from blocks
-                    block.outgoing_edges = {(branch.true_edge, "")}
+                    sink = branch.true_edge
                 else:
-                    block.outgoing_edges = {(branch.false_edge, "")}
+                    sink = branch.false_edge
             except NameError:
-                pass
+                continue
+            self.remove_edge(block.id, branch.id)
+            self.add_edge(block.id, sink.id)
 
 
     def gen_new_block(self):
@@ -178,9 +247,7 @@ class ControlFlowGraph:
         Instantiates a new ``BasicBlock``, appends it to ``self.blocks``, and
         returns it.
         """
-        block = BasicBlock()
-        self.blocks.append(block)
-        return block
+        return self.add_block(BasicBlock())
 
     def add_new_block(self):
         """
@@ -202,11 +269,9 @@ class ControlFlowGraph:
         adds an edge from the new ``Yield`` block to this new ``BasicBlock``.
         """
         old_block = self.curr_block
-        self.curr_block = Yield()
-        add_edge(old_block, self.curr_block)
-        self.blocks.append(self.curr_block)
         # We need unique ids for each yield in the current cfg
-        self.curr_block.yield_id = self.curr_yield_id
+        self.curr_block = self.add_block(Yield(self.curr_yield_id))
+        add_edge(old_block, self.curr_block)
         self.curr_yield_id += 1
 
         self.add_new_block()
@@ -224,8 +289,7 @@ class ControlFlowGraph:
         """
         old_block = self.curr_block
         # First we create an explicit branch node
-        self.curr_block = Branch(cond)
-        self.blocks.append(self.curr_block)
+        self.curr_block = self.add_block(Branch(cond))
         add_edge(old_block, self.curr_block)
         branch = self.curr_block
         # Then we add a basic block for the true edge
@@ -284,56 +348,22 @@ class ControlFlowGraph:
             # Append a normal statement to the current block
             self.curr_block.add(stmt)
 
-    def remove_block(self, block):
-        """
-        Removes ``block`` from the control flow graph and collapses incoming
-        edges to outgoing edges.
-        """
-        for source, source_label in block.incoming_edges:
-            source.outgoing_edges.remove((block, source_label))
-        for sink, sink_label in block.outgoing_edges:
-            sink.incoming_edges.remove((block, sink_label))
-        for source, source_label in block.incoming_edges:
-            if isinstance(source, Branch):
-                if len(block.outgoing_edges) == 1:
-                    sink, sink_label = list(block.outgoing_edges)[0]
-                    add_edge(source, sink, source_label)
-                    if source_label == "F":
-                        source.false_edge = sink
-                    elif source_label == "T":
-                        source.true_edge = sink
-                    else:  # pragma: no cover
-                        assert False
-                else:
-                    assert not block.outgoing_edges
-            else:
-                for sink, sink_label in block.outgoing_edges:
-                    add_edge(source, sink, source_label)
-
     def consolidate_empty_blocks(self):
         """
         Remove any empty basic blocks
         """
-        new_blocks = []
         for block in self.blocks:
             if isinstance(block, BasicBlock) and not block.statements:
-                self.remove_block(block)
-            else:
-                new_blocks.append(block)
-        self.blocks = new_blocks
+                self.remove_block(block.id)
 
     def remove_if_trues(self):
         """
         Remove any if true blocks
         """
-        new_blocks = []
         for block in self.blocks:
             if isinstance(block, Branch) and (isinstance(block.cond, ast.NameConstant) \
                     and block.cond.value is True):
-                self.remove_block(block)
-            else:
-                new_blocks.append(block)
-        self.blocks = new_blocks
+                self.remove_block(block.id)
 
     def render(self):  # pragma: no cover
         """
@@ -394,51 +424,117 @@ def render_fsm(states):
     dot.render(file_name, view=True)
 
 
-def render_paths_between_yields(paths):  # pragma: no cover
+def render_paths_between_yields(blocks, paths):  # pragma: no cover
     """
-    Render all the paths between yields using graphviz
+    Render the DAG of paths between yields (as returned by
+    ``ControlFlowGraph.collect_paths_between_yields``) using graphviz
     """
     from graphviz import Digraph
     dot = Digraph(name="top")
-    for i, path in enumerate(paths):
-        prev = None
-        for block in path:
-            if isinstance(block, Branch):
-                label = "if " + astor.to_source(block.cond)
-                dot.node(str(i) + str(id(block)), label.rstrip(), {"shape": "invhouse"})
-            elif isinstance(block, Yield):
-                label = "yield {}".format(block.yield_id)
-                dot.node(str(i) + str(id(block)), label.rstrip(), {"shape": "oval"})
-            elif isinstance(block, BasicBlock):
-                label = "\n".join(astor.to_source(stmt) for stmt in block.statements)
-                dot.node(str(i) + str(id(block)), label.rstrip(), {"shape": "box"})
-            elif isinstance(block, HeadBlock):
-                label = "Initial"
-                dot.node(str(i) + str(id(block)), label.rstrip(), {"shape": "doublecircle"})
-            elif isinstance(block, State):
-                label = "{}".format(astor.to_source(block.yield_state).rstrip())
-                if block.conds:
-                    label += " && "
-                label += " && ".join(astor.to_source(cond) for cond in block.conds)
-                label += "\n"
-                label += "\n".join(astor.to_source(statement) for statement in block.statements)
-                dot.node(str(i) + str(id(block)), label.rstrip(), {"shape": "doubleoctagon"})
-            else:
-                raise NotImplementedError(type(block))
-            if prev is not None:
-                if isinstance(prev, Branch):
-                    if block is prev.false_edge:
-                        label = "F"
-                    else:
-                        label = "T"
-                else:
-                    label = ""
-                dot.edge(str(i) + str(id(prev)), str(i) + str(id(block)), label)
-            prev = block
+    seen = set()
+    worklist = list(paths)
+    while worklist:
+        node = worklist.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        name = "{}{}".format(node.block_id, node.label)
+        block = blocks[node.block_id]
+        if isinstance(block, Branch):
+            label = "if " + astor.to_source(block.cond)
+            dot.node(name, label.rstrip(), {"shape": "invhouse"})
+        elif isinstance(block, Yield):
+            label = "yield {}".format(block.yield_id)
+            dot.node(name, label.rstrip(), {"shape": "oval"})
+            if node not in paths:
+                continue
+        elif isinstance(block, BasicBlock):
+            label = "\n".join(astor.to_source(stmt) for stmt in block.statements)
+            dot.node(name, label.rstrip(), {"shape": "box"})
+        elif isinstance(block, HeadBlock):
+            label = "Initial"
+            dot.node(name, label.rstrip(), {"shape": "doublecircle"})
+        else:
+            raise NotImplementedError(type(block))
+        for successor in node.successors:
+            dot.edge(name, "{}{}".format(successor.block_id, successor.label),
+                     node.label)
+            worklist.append(successor)
 
     file_name = tempfile.mktemp("gv")
     dot.render(file_name, view=True)
 
+
+class CombinationalLoopError(Exception):
+    """
+    Raised when the FSM contains a loop without a ``yield``
+    """
+    pass
+
+
+def get_line_numbers(block):
+    """
+    Returns the set of source line numbers of the statements (or condition)
+    in ``block``.  Nodes generated by transformations may not have one.
+    """
+    if isinstance(block, BasicBlock):
+        nodes = block.statements
+    elif isinstance(block, Branch):
+        nodes = [block.cond]
+    else:
+        nodes = []
+    return {node.lineno for node in nodes if hasattr(node, "lineno")}
+
+
+def strongly_connected_components(nodes, successors):
+    """
+    Tarjan's algorithm, using an explicit stack so the size of the graph is
+    not limited by the recursion limit.
+
+    ``successors`` is a function that returns the successors of a node.
+    Returns a list of components (lists of nodes), successors before
+    predecessors.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    def push(node):
+        index[node] = lowlink[node] = len(index)
+        stack.append(node)
+        on_stack.add(node)
+        return (node, iter(successors(node)))
+
+    for start in nodes:
+        if start in index:
+            continue
+        work = [push(start)]
+        while work:
+            node, remaining = work[-1]
+            for successor in remaining:
+                if successor not in index:
+                    work.append(push(successor))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member is node:
+                            break
+                    components.append(component)
+    return components
+
 def collect_constant_assigns(statements):
     """
     Collect statements that assign a variable ``var`` to a constant value
@@ -466,66 +562,488 @@ def is_assign_to_name(statement):
            isinstance(statement.targets[0], ast.Name)
 
 
-def promote_live_variables(paths):
+def collect_reads(blocks, paths):
+    """
+    For each ``PathNode`` reachable from ``paths``, collect the names that may
+    be read from that node until the end of the cycle (the next ``Yield``).
+
+    Returns a dict mapping nodes to frozensets of names
+    """
+    reads = {}
+    stack = [(root, False) for root in paths]
+    while stack:
+        node, expanded = stack.pop()
+        if node in reads:
+            continue
+        # Reaching a ``Yield`` ends the cycle, so we never look past it
+        successors = [successor for successor in node.successors
+                      if not isinstance(blocks[successor.block_id], Yield)]
+        if not expanded:
+            stack.append((node, True))
+            stack.extend((successor, False) for successor in successors)
+            continue
+        block = blocks[node.block_id]
+        names = set()
+        if isinstance(block, BasicBlock):
+            for statement in block.statements:
+                names |= collect_names(statement, ast.Load)
+        elif isinstance(block, Branch):
+            names |= collect_names(block.cond, ast.Load)
+        for successor in successors:
+            names |= reads[successor]
+        reads[node] = frozenset(names)
+    return reads
+
+
+def is_bool_constant(tree):
+    """Returns true if ``tree`` is the constant ``True`` or ``False``"""
+    return isinstance(tree, ast.NameConstant) and tree.value in (True, False)
+
+
+def promote_live_variables(blocks, paths, expressions):
     """
     Currently silica has blocking assingment semantics. To encode this in the
     CFG, for each path between yields we store the value of writes to a
     variable and promote any subsequents reads of that variable to the written
     value (rather than the value during the previous clock cycle).
+
+    ``paths`` are the roots of the DAG returned by
+    ``ControlFlowGraph.collect_paths_between_yields``.  Rather than promoting
+    each path separately, we build a decision diagram of ``Step``,
+    ``Decision`` and ``End`` nodes.  The diagram for a node of the DAG only
+    depends on the values in the symbol table that are read later in the
+    cycle, so it is memoized on those values.  Together with hash-consing
+    the diagram nodes, this means independent branches (e.g.  a sequence of
+    ``if valid_x: ...``) produce a diagram that grows linearly instead of
+    one path per combination of branches.  The DAG is walked with an
+    explicit stack and the blocks of the CFG are not modified.
+
+    Statements and conditions are interned in ``expressions`` (an
+    ``ExpressionTable``), so promoting a variable shares its value instead
+    of copying it and interned nodes can be compared by identity.
+
+    Returns a dict mapping the id of each yield (0 for the initial block) to
+    the root of its decision diagram
     """
-    for path in paths:
-        symbol_table = {}  # We build a new symbol table for each path
-        for block in path:
-            if isinstance(block, BasicBlock):
-                new_statements = []
-                for statement in block.statements:
-                    # Replace any symbols currently in the symbol table
-                    statement = replace_symbols(statement, symbol_table, ctx=ast.Load)
-                    # Fold constants
-                    statement = constant_fold(statement)
-                    # Update symbol table if the statement is an assign
-                    if is_assign_to_name(statement):
-                        symbol_table[statement.targets[0].id] = statement.value
-                    new_statements.append(statement)
-                block.statements = new_statements
-            elif isinstance(block, Branch):
-                # For branches we just promote in the condition
-                block.cond = replace_symbols(block.cond, symbol_table, ctx=ast.Load)
-                block.cond = constant_fold(block.cond)
-    return paths
-
-
-def build_state_info(paths, outputs, inputs):
-    """
-    Constructs a ``State`` object for each path in paths.
-
-    Returns a 2 element tuple of:
-        list of State objects
-        set of state variable names
+    reads = collect_reads(blocks, paths)
+    table = {}  # Hash-consing table for diagram nodes
+    memo = {}
+
+    def make(key, node_type, *args):
+        if key not in table:
+            table[key] = node_type(*args)
+        return table[key]
+
+    def memo_key(node, symbol_table):
+        return (node, tuple(sorted(((name, symbol_table[name])
+                                    for name in reads[node]
+                                    if name in symbol_table),
+                                   key=lambda item: item[0])))
+
+    def promote(tree, symbol_table):
+        return expressions.fold(expressions.substitute(tree, symbol_table,
+                                                       ast.Load))
+
+    transitions = {}
+    for root in paths:
+        # ``stack`` holds ("visit", node, symbol_table, is_root) tasks and
+        # ("build", ...) continuations that pop the diagrams of a node's
+        # successors from ``results`` and push the diagram of the node
+        stack = [("visit", root, {}, True)]
+        results = []
+        while stack:
+            task = stack.pop()
+            if task[0] == "visit":
+                _, node, symbol_table, is_root = task
+                block = blocks[node.block_id]
+                if isinstance(block, Yield) and not is_root:
+                    results.append(make(("end", block.yield_id), End,
+                                        block.yield_id))
+                    continue
+                key = memo_key(node, symbol_table)
+                if key in memo:
+                    results.append(memo[key])
+                    continue
+                statements = None
+                if isinstance(block, BasicBlock):
+                    # We build a new symbol table for each path, so copy it
+                    # before adding the writes of this block
+                    symbol_table = dict(symbol_table)
+                    statements = []
+                    for statement in block.statements:
+                        # Replace any symbols currently in the symbol table
+                        # and fold constants
+                        statement = promote(statement, symbol_table)
+                        # Update symbol table if the statement is an assign
+                        if is_assign_to_name(statement):
+                            symbol_table[statement.targets[0].id] = \
+                                statement.value
+                        statements.append(statement)
+                cond = None
+                successors = node.successors
+                if len(successors) == 2:
+                    # Entering a branch, the successors are its true and false
+                    # edges.  For branches we just promote in the condition
+                    branch = blocks[successors[0].block_id]
+                    cond = promote(branch.cond, symbol_table)
+                    if is_bool_constant(cond):
+                        # The condition folded to a constant (e.g. ``i < 8``
+                        # after ``i = 0``), only the taken edge is feasible
+                        successors = [successors[0 if cond.value else 1]]
+                        cond = None
+                stack.append(("build", key, statements, cond))
+                # Push in reverse so the true edge is visited first
+                for successor in reversed(successors):
+                    stack.append(("visit", successor, symbol_table, False))
+            else:
+                _, key, statements, cond = task
+                if cond is None:
+                    result = results.pop()
+                else:
+                    false_edge = results.pop()
+                    true_edge = results.pop()
+                    if true_edge is false_edge:
+                        # Both edges do the same thing, no need to decide
+                        result = true_edge
+                    else:
+                        result = make(("decision", cond, true_edge,
+                                       false_edge), Decision, cond, true_edge,
+                                      false_edge)
+                if statements is not None:
+                    result = make(("step", tuple(statements), result), Step,
+                                  statements, result)
+                memo[key] = result
+                results.append(result)
+        block = blocks[root.block_id]
+        yield_id = 0 if isinstance(block, HeadBlock) else block.yield_id
+        transitions[yield_id] = results.pop()
+    return transitions
+
+
+compare_ops = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+def is_compare_to_constant(cond):
+    """Returns true if ``cond`` is of the form ``expr <op> n``"""
+    return isinstance(cond, ast.Compare) and len(cond.ops) == 1 and \
+           type(cond.ops[0]) in compare_ops and \
+           isinstance(cond.comparators[0], ast.Num)
+
+
+def get_fact_keys(cond):
     """
-    states = []
-    state_vars = {"yield_state"}
-    for path in paths:
-        if isinstance(path[0], HeadBlock):
-            start_yield_id = 0
+    Returns the keys of the facts (see ``learn_facts``) that
+    ``evaluate_cond`` may look up to evaluate ``cond``
+    """
+    keys = {cond}
+    if isinstance(cond, ast.UnaryOp) and isinstance(cond.op, ast.Not):
+        keys |= get_fact_keys(cond.operand)
+    elif isinstance(cond, ast.BoolOp):
+        for value in cond.values:
+            keys |= get_fact_keys(value)
+    elif is_compare_to_constant(cond):
+        keys.add(("value", cond.left))
+    return keys
+
+
+def evaluate_cond(cond, facts):
+    """
+    Evaluates ``cond`` using the ``facts`` known on the current path
+
+    Returns ``True`` or ``False``, or ``None`` if the value is not known
+    """
+    if cond in facts:
+        return facts[cond]
+    elif is_bool_constant(cond):
+        return cond.value
+    elif isinstance(cond, ast.UnaryOp) and isinstance(cond.op, ast.Not):
+        value = evaluate_cond(cond.operand, facts)
+        return None if value is None else not value
+    elif isinstance(cond, ast.BoolOp):
+        # ``True`` for ``and`` and ``False`` for ``or`` do not change the
+        # result, the other value decides it
+        identity = isinstance(cond.op, ast.And)
+        values = [evaluate_cond(value, facts) for value in cond.values]
+        if (not identity) in values:
+            return not identity
+        elif all(value is identity for value in values):
+            return identity
+    elif is_compare_to_constant(cond):
+        value = facts.get(("value", cond.left))
+        if value is not None:
+            return compare_ops[type(cond.ops[0])](value,
+                                                  cond.comparators[0].n)
+    return None
+
+
+def learn_facts(cond, value, facts):
+    """
+    Adds what is known on a path where ``cond`` evaluated to ``value`` to
+    ``facts``, a dict mapping (interned) conditions to their value and
+    ``("value", expr)`` to the constant value of ``expr``
+    """
+    facts[cond] = value
+    if isinstance(cond, ast.UnaryOp) and isinstance(cond.op, ast.Not):
+        learn_facts(cond.operand, not value, facts)
+    elif isinstance(cond, ast.BoolOp) and \
+            value is isinstance(cond.op, ast.And):
+        # Every operand of a true ``and`` (or a false ``or``) has that value
+        for operand in cond.values:
+            learn_facts(operand, value, facts)
+    elif is_compare_to_constant(cond):
+        op = type(cond.ops[0])
+        if (op is ast.Eq and value) or (op is ast.NotEq and not value):
+            facts[("value", cond.left)] = cond.comparators[0].n
+
+
+def prune_infeasible_paths(transitions):
+    """
+    Conditions in the decision diagrams returned by ``promote_live_variables``
+    only refer to values from the start of the cycle, so a condition has the
+    same value everywhere on a path.  Walks each diagram with the facts
+    learned from the decisions taken so far and removes the edges that
+    contradict them, e.g. the inner ``if`` in ``if x == 0: if x == 1: ...``.
+
+    The result for a node only depends on the facts about conditions decided
+    below it, so it is memoized on those.
+
+    Returns the new transitions
+    """
+    nodes = sort_transitions(transitions)
+    decided = {}  # The fact keys used by the decisions below each node
+    for node in reversed(nodes):
+        if isinstance(node, Step):
+            decided[node] = decided[node.next]
+        elif isinstance(node, Decision):
+            decided[node] = decided[node.true_edge] | \
+                decided[node.false_edge] | get_fact_keys(node.cond)
         else:
-            start_yield_id = path[0].yield_id
-        end_yield_id = path[-1].yield_id
-        state = State(start_yield_id, end_yield_id)
-        for i in range(1, len(path)):
-            block = path[i]
-            if isinstance(block, Branch):
-                cond = block.cond
-                if path[i + 1] is block.false_edge:
-                    cond = ast.UnaryOp(ast.Invert(), cond)
-                names = collect_names(cond)
-                for name in names:
-                    if name not in outputs and \
-                       name not in inputs:
-                        state_vars.update(names)
-                state.conds.append(cond)
-            elif isinstance(block, BasicBlock):
-                state.statements.extend(block.statements)
-        states.append(state)
-    return states, state_vars
+            decided[node] = frozenset()
+
+    table = {}  # Hash-consing table for rebuilt nodes
+    memo = {}
 
+    def make(key, node_type, *args):
+        if key not in table:
+            table[key] = node_type(*args)
+        return table[key]
+
+    new_transitions = {}
+    for yield_id, root in transitions.items():
+        stack = [("visit", root, {})]
+        results = []
+        while stack:
+            task = stack.pop()
+            if task[0] == "visit":
+                _, node, facts = task
+                key = (node, frozenset((fact, value)
+                                       for fact, value in facts.items()
+                                       if fact in decided[node]))
+                if key in memo:
+                    results.append(memo[key])
+                elif isinstance(node, End):
+                    memo[key] = node
+                    results.append(node)
+                elif isinstance(node, Step):
+                    stack.append(("build", key, node))
+                    stack.append(("visit", node.next, facts))
+                else:
+                    value = evaluate_cond(node.cond, facts)
+                    if value is not None:
+                        # Only one edge is feasible, drop the decision
+                        stack.append(("build", key, None))
+                        edge = node.true_edge if value else node.false_edge
+                        stack.append(("visit", edge, facts))
+                        continue
+                    stack.append(("build", key, node))
+                    for edge, value in ((node.false_edge, False),
+                                        (node.true_edge, True)):
+                        edge_facts = dict(facts)
+                        learn_facts(node.cond, value, edge_facts)
+                        stack.append(("visit", edge, edge_facts))
+            else:
+                _, key, node = task
+                if node is None:
+                    result = results.pop()
+                elif isinstance(node, Step):
+                    next = results.pop()
+                    if next is node.next:
+                        result = node
+                    else:
+                        result = make(("step", id(node.statements), next),
+                                      Step, node.statements, next)
+                else:
+                    false_edge = results.pop()
+                    true_edge = results.pop()
+                    if true_edge is node.true_edge and \
+                            false_edge is node.false_edge:
+                        result = node
+                    elif true_edge is false_edge:
+                        result = true_edge
+                    else:
+                        result = make(("decision", id(node.cond), true_edge,
+                                       false_edge), Decision, node.cond,
+                                      true_edge, false_edge)
+                memo[key] = result
+                results.append(result)
+        new_transitions[yield_id] = results.pop()
+    return new_transitions
+
+
+def find_joins(nodes):
+    """
+    For each ``Decision`` in ``nodes`` (in topological order), find the first
+    node that both of its edges reach (its immediate postdominator), or
+    ``None`` if they end in different yields.  Backends use this to emit the
+    diagram as structured ``if``/``else`` blocks followed by the join.
+
+    Returns a dict mapping each ``Decision`` to its join
+    """
+    successor = {}  # The immediate postdominator of each node
+    for node in reversed(nodes):
+        if isinstance(node, Step):
+            successor[node] = node.next
+        elif isinstance(node, Decision):
+            true_path = set()
+            curr = node.true_edge
+            while curr is not None:
+                true_path.add(curr)
+                curr = successor[curr]
+            curr = node.false_edge
+            while curr is not None and curr not in true_path:
+                curr = successor[curr]
+            successor[node] = curr
+        else:
+            successor[node] = None
+    return {node: join for node, join in successor.items()
+            if isinstance(node, Decision)}
+
+
+def collect_names_in_transitions(transitions):
+    """
+    Returns a tuple ``(reads, writes)`` of the sets of names loaded and
+    stored by the statements and conditions in ``transitions``.  Interned
+    expressions share subtrees, so each node is only visited once.
+    """
+    reads = set()
+    writes = set()
+    stack = []
+    for node in sort_transitions(transitions):
+        if isinstance(node, Step):
+            stack.extend(node.statements)
+        elif isinstance(node, Decision):
+            stack.append(node.cond)
+    seen = set()
+    while stack:
+        tree = stack.pop()
+        if tree in seen:
+            continue
+        seen.add(tree)
+        if isinstance(tree, ast.Name):
+            if isinstance(tree.ctx, ast.Store):
+                writes.add(tree.id)
+            else:
+                reads.add(tree.id)
+        stack.extend(ast.iter_child_nodes(tree))
+    return reads, writes
+
+
+def remove_dead_assigns(transitions, outputs):
+    """
+    Liveness analysis over the decision diagrams.  Statements are promoted,
+    so any name they read refers to its value from the previous cycle: the
+    variables read anywhere are exactly the ones live across a ``yield``.
+    Assignments to any other variable (that is not an output) only feed
+    reads in the same cycle, which already use the assigned value, so they
+    are removed and the variable does not need a register.  Removing an
+    assignment can make the variables it reads dead, so this is repeated
+    until nothing changes.
+
+    Returns the new transitions
+    """
+    while True:
+        reads, _ = collect_names_in_transitions(transitions)
+        keep = reads | outputs
+        table = {}  # Hash-consing table for rebuilt nodes
+        renamed = {}
+        changed = False
+        for node in reversed(sort_transitions(transitions)):
+            if isinstance(node, Step):
+                next = renamed[node.next]
+                statements = [statement for statement in node.statements
+                              if not is_assign_to_name(statement) or
+                              statement.targets[0].id in keep]
+                if len(statements) < len(node.statements):
+                    changed = True
+                if not statements:
+                    renamed[node] = next
+                    continue
+                key = ("step", tuple(statements), next)
+                if key not in table:
+                    table[key] = Step(statements, next)
+            elif isinstance(node, Decision):
+                true_edge = renamed[node.true_edge]
+                false_edge = renamed[node.false_edge]
+                if true_edge is false_edge:
+                    renamed[node] = true_edge
+                    continue
+                key = ("decision", node.cond, true_edge, false_edge)
+                if key not in table:
+                    table[key] = Decision(node.cond, true_edge, false_edge)
+            else:
+                key = ("end", node.end_yield_id)
+                if key not in table:
+                    table[key] = node
+            renamed[node] = table[key]
+        if not changed:
+            return transitions
+        transitions = {yield_id: renamed[root]
+                       for yield_id, root in transitions.items()}
+
+
+def collect_state_vars(transitions, outputs, inputs, registers=()):
+    """
+    Returns the set of state variable names, ``yield_state`` and the
+    variables (neither inputs nor outputs) that are assigned and live across
+    a ``yield`` (see ``remove_dead_assigns``).  The ``registers`` declared
+    with ``Register()`` that are read but never assigned keep their initial
+    value, they are state variables too.  Other local variables are only
+    wires and do not need a register.
+    """
+    reads, writes = collect_names_in_transitions(transitions)
+    return {"yield_state"} | \
+        ((reads & (writes | set(registers))) - outputs - inputs)
+
+
+def build_state_info(transitions):
+    """
+    Constructs a ``State`` object for each path through the decision diagrams
+    in ``transitions``.  The number of paths can grow exponentially with the
+    number of sequential branches, so backends should prefer the diagrams.
+
+    Returns a list of State objects
+    """
+    states = []
+    for start_yield_id, root in sorted(transitions.items()):
+        stack = [(root, [], [])]
+        while stack:
+            node, conds, statements = stack.pop()
+            if isinstance(node, Step):
+                stack.append((node.next, conds, statements + node.statements))
+            elif isinstance(node, Decision):
+                cond = ast.UnaryOp(ast.Invert(), node.cond)
+                stack.append((node.false_edge, conds + [cond], statements))
+                stack.append((node.true_edge, conds + [node.cond], statements))
+            else:
+                state = State(start_yield_id, node.end_yield_id)
+                state.conds.extend(conds)
+                state.statements.extend(statements)
+                states.append(state)
+    return states
@@ -0,0 +1,203 @@
+"""
+Hash-consed expressions for the CFG passes and backends
+
+The CFG is built from (mutable) ``ast`` nodes.  Passes after that work on
+interned nodes: structurally equal trees are the same object, so identity
+can be used for equality and nodes can be used as dict keys.  Substitution
+only rebuilds the nodes above a replaced name and shares everything else
+(including the replacement values), so interned nodes must never be
+modified.  They are still ``ast`` nodes, so code emission (``astor``) does
+not need to convert them.
+"""
+import ast
+
+from silica.transformations.constant_fold import fold_rules
+
+
+def get_key(value):
+    """
+    Returns a hashable key for a field of an interned node, the identity of
+    a child node or a tuple of keys for a list.  The type is included so
+    ``1`` and ``True`` get different keys.
+    """
+    if isinstance(value, ast.AST):
+        return id(value)
+    elif isinstance(value, list):
+        return tuple(get_key(item) for item in value)
+    return (type(value), value)
+
+
+class ExpressionTable:
+    """
+    Fields:
+        * ``self.nodes`` - a dict mapping keys (see ``make``) to interned
+          nodes
+        * ``self.interned`` - a dict mapping ``id(tree)`` to ``(tree,
+          interned)``, holding ``tree`` so its id is not reused
+        * ``self.folded`` - a dict mapping interned nodes to their constant
+          folded version
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.interned = {}
+        self.folded = {}
+
+    def make(self, node, fields):
+        """
+        Returns the interned node with the type of ``node`` and ``fields`` (a
+        dict mapping field names to interned children or plain values).  New
+        nodes take the source location of ``node``.
+        """
+        key = (type(node), ) + tuple((name, get_key(value))
+                                     for name, value in sorted(fields.items()))
+        if key not in self.nodes:
+            new_node = ast.copy_location(type(node)(**fields), node)
+            self.nodes[key] = new_node
+            self.interned[id(new_node)] = (new_node, new_node)
+        return self.nodes[key]
+
+    def rebuild(self, node, results):
+        """
+        Returns ``node`` with each child replaced by ``results[child]``, or
+        ``node`` itself if no child changed
+        """
+        fields = {}
+        changed = False
+        for name, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST):
+                new_value = results[value]
+                changed |= new_value is not value
+            elif isinstance(value, list):
+                new_value = [results[item] if isinstance(item, ast.AST)
+                             else item for item in value]
+                changed |= any(new is not old
+                               for new, old in zip(new_value, value))
+            else:
+                new_value = value
+            fields[name] = new_value
+        if not changed:
+            return node
+        return self.make(node, fields)
+
+    def intern(self, tree):
+        """
+        Returns the interned node structurally equal to ``tree``
+        """
+        if id(tree) in self.interned:
+            return self.interned[id(tree)][1]
+        # Post-order walk with an explicit stack, expressions built by
+        # promoting variables can be deeper than the recursion limit
+        stack = [(tree, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if id(node) in self.interned:
+                continue
+            if not expanded:
+                stack.append((node, True))
+                stack.extend((child, False)
+                             for child in ast.iter_child_nodes(node))
+                continue
+            fields = {}
+            for name, value in ast.iter_fields(node):
+                if isinstance(value, ast.AST):
+                    value = self.interned[id(value)][1]
+                elif isinstance(value, list):
+                    value = [self.interned[id(item)][1]
+                             if isinstance(item, ast.AST) else item
+                             for item in value]
+                fields[name] = value
+            self.interned[id(node)] = (node, self.make(node, fields))
+        return self.interned[id(tree)][1]
+
+    def with_ctx(self, tree, ctx):
+        """
+        Returns ``tree`` (interned) with its ``ctx`` replaced by ``ctx``
+        """
+        if not hasattr(tree, "ctx"):
+            return tree
+        fields = dict(ast.iter_fields(tree))
+        fields["ctx"] = self.intern(ctx)
+        return self.make(tree, fields)
+
+    def transform(self, tree, function):
+        """
+        Rebuilds ``tree`` bottom up, replacing each node (with its children
+        already transformed) by ``function(node)``.  ``function`` must not
+        modify the node, it returns the node or a replacement.
+
+        Returns the interned result
+        """
+        tree = self.intern(tree)
+        results = {}
+        stack = [(tree, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if node in results:
+                continue
+            if not expanded:
+                stack.append((node, True))
+                stack.extend((child, False)
+                             for child in ast.iter_child_nodes(node))
+                continue
+            results[node] = self.intern(function(self.rebuild(node, results)))
+        return results[tree]
+
+    def substitute(self, tree, symbol_table, ctx=None):
+        """
+        Like ``silica.transformations.replace_symbols``, but shares the
+        replacement values and the unchanged subtrees of ``tree`` instead of
+        copying them.  ``ctx=None`` replaces every use of a name, keeping the
+        ``ctx`` of the use, otherwise only the names used with ``ctx`` are
+        replaced.
+
+        Returns the interned result
+        """
+        tree = self.intern(tree)
+        results = {}
+        stack = [(tree, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if node in results:
+                continue
+            if isinstance(node, ast.Name):
+                result = node
+                if node.id in symbol_table and \
+                        (ctx is None or isinstance(node.ctx, ctx)):
+                    result = self.intern(symbol_table[node.id])
+                    if ctx is None:
+                        result = self.with_ctx(result, node.ctx)
+                results[node] = result
+            elif not expanded:
+                stack.append((node, True))
+                stack.extend((child, False)
+                             for child in ast.iter_child_nodes(node))
+            else:
+                results[node] = self.rebuild(node, results)
+        return results[tree]
+
+    def fold(self, tree):
+        """
+        Constant folds ``tree`` bottom up with the rules of
+        ``silica.transformations.constant_fold``.  Results are memoized, so
+        folding a tree built from already folded subtrees only visits the new
+        nodes.
+
+        Returns the interned result
+        """
+        tree = self.intern(tree)
+        stack = [(tree, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if node in self.folded:
+                continue
+            if not expanded:
+                stack.append((node, True))
+                stack.extend((child, False)
+                             for child in ast.iter_child_nodes(node))
+                continue
+            result = self.rebuild(node, self.folded)
+            if type(result) in fold_rules:
+                result = self.intern(fold_rules[type(result)](result))
+            self.folded[node] = result
+            self.folded[result] = result
+        return self.folded[tree]
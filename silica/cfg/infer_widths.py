@@ -0,0 +1,384 @@
+"""
+Range and bit width inference for the local variables of a
+``ControlFlowGraph``
+
+Computes an interval ``(lo, hi)`` containing every value a variable can take
+at the start of each yield by abstract interpretation of the decision
+diagrams.  Conditions narrow the intervals on the edges they decide, so a
+counter guarded by ``if count < 9`` gets the interval ``(0, 9)``.  Bounds
+that keep growing are widened to infinity, then a few narrowing iterations
+recover the bounds implied by the conditions.
+
+Promoted statements and conditions only read values from the start of the
+cycle, so they are all evaluated with the intervals of the yield the
+diagram starts from (narrowed by the conditions on the path).
+"""
+import ast
+
+from silica.cfg.types import Step, Decision, sort_transitions
+from silica.ast_utils import get_index
+
+INF = float("inf")
+UNKNOWN = (-INF, INF)
+
+# Number of iterations before a bound that is still changing is widened
+WIDEN_AFTER = 8
+NARROWING_ITERATIONS = 4
+
+
+class WidthInferenceError(Exception):
+    """
+    Raised when a variable declared without a width is not bounded
+    """
+    pass
+
+
+def join(a, b):
+    """Returns the smallest interval containing intervals ``a`` and ``b``"""
+    if a is None:
+        return b
+    elif b is None:
+        return a
+    return (min(a[0], b[0]), max(a[1], b[1]))
+
+
+def is_finite(interval):
+    return -INF < interval[0] and interval[1] < INF
+
+
+def is_natural(interval):
+    """Returns true if the interval is bounded and has no negative values"""
+    return is_finite(interval) and interval[0] >= 0
+
+
+def evaluate(expr, ranges):
+    """
+    Returns an interval containing the values of ``expr`` when each variable
+    ``name`` takes a value in ``ranges[name]``
+    """
+    if isinstance(expr, ast.NameConstant) and expr.value in (True, False):
+        return (int(expr.value), int(expr.value))
+    elif isinstance(expr, ast.Num):
+        return (expr.n, expr.n)
+    elif isinstance(expr, ast.Name):
+        return ranges.get(expr.id, UNKNOWN)
+    elif isinstance(expr, (ast.Compare, ast.BoolOp)) or \
+            (isinstance(expr, ast.UnaryOp) and isinstance(expr.op, ast.Not)):
+        return (0, 1)
+    elif isinstance(expr, ast.Subscript) and get_index(expr) is not None:
+        # Indexing a single bit
+        return (0, 1)
+    elif isinstance(expr, ast.IfExp):
+        return join(evaluate(expr.body, ranges), evaluate(expr.orelse, ranges))
+    elif isinstance(expr, ast.BinOp):
+        left = evaluate(expr.left, ranges)
+        right = evaluate(expr.right, ranges)
+        if isinstance(expr.op, ast.Add):
+            return (left[0] + right[0], left[1] + right[1])
+        elif isinstance(expr.op, ast.Sub):
+            return (left[0] - right[1], left[1] - right[0])
+        elif not (is_natural(left) and is_natural(right)):
+            # The bitwise operators depend on the width of negative or
+            # unbounded values
+            return UNKNOWN
+        elif isinstance(expr.op, ast.Mult):
+            return (left[0] * right[0], left[1] * right[1])
+        elif isinstance(expr.op, ast.BitAnd):
+            return (0, min(left[1], right[1]))
+        elif isinstance(expr.op, (ast.BitOr, ast.BitXor)):
+            width = max(left[1].bit_length(), right[1].bit_length())
+            return (0, (1 << width) - 1)
+        elif isinstance(expr.op, ast.LShift):
+            return (left[0] << right[0], left[1] << right[1])
+        elif isinstance(expr.op, ast.RShift):
+            return (left[0] >> right[1], left[1] >> right[0])
+        elif isinstance(expr.op, ast.Mod) and right[0] > 0:
+            return (0, min(left[1], right[1] - 1))
+    return UNKNOWN
+
+
+negated_ops = {
+    ast.Lt: ast.GtE,
+    ast.LtE: ast.Gt,
+    ast.Gt: ast.LtE,
+    ast.GtE: ast.Lt,
+    ast.Eq: ast.NotEq,
+    ast.NotEq: ast.Eq,
+}
+
+flipped_ops = {
+    ast.Lt: ast.Gt,
+    ast.LtE: ast.GtE,
+    ast.Gt: ast.Lt,
+    ast.GtE: ast.LtE,
+    ast.Eq: ast.Eq,
+    ast.NotEq: ast.NotEq,
+}
+
+
+def get_offset_name(expr):
+    """
+    Returns ``(name, offset)`` if ``expr`` is of the form ``name``,
+    ``name + n`` or ``name - n``, otherwise ``None``
+    """
+    if isinstance(expr, ast.Name):
+        return expr.id, 0
+    elif isinstance(expr, ast.BinOp) and isinstance(expr.left, ast.Name) and \
+            isinstance(expr.right, ast.Num):
+        if isinstance(expr.op, ast.Add):
+            return expr.left.id, expr.right.n
+        elif isinstance(expr.op, ast.Sub):
+            return expr.left.id, -expr.right.n
+    return None
+
+
+def refine(cond, value, ranges):
+    """
+    Narrows ``ranges`` with the knowledge that ``cond`` evaluated to
+    ``value``.  Only comparisons between a variable (plus or minus a
+    constant) and another expression, possibly combined with ``not``,
+    ``and`` and ``or``, are used.
+
+    Returns the new ranges, or ``None`` if ``cond`` can not have ``value``
+    """
+    if isinstance(cond, ast.UnaryOp) and isinstance(cond.op, ast.Not):
+        return refine(cond.operand, not value, ranges)
+    elif isinstance(cond, ast.BoolOp):
+        if value is not isinstance(cond.op, ast.And):
+            # A false ``and`` or a true ``or`` does not tell which operand
+            # decided it
+            return ranges
+        for operand in cond.values:
+            ranges = refine(operand, value, ranges)
+            if ranges is None:
+                return None
+        return ranges
+    elif not isinstance(cond, ast.Compare) or len(cond.ops) != 1 or \
+            type(cond.ops[0]) not in negated_ops:
+        return ranges
+    op = type(cond.ops[0])
+    left, right = cond.left, cond.comparators[0]
+    if get_offset_name(left) is None:
+        left, right = right, left
+        op = flipped_ops[op]
+    offset_name = get_offset_name(left)
+    if offset_name is None or offset_name[0] not in ranges:
+        return ranges
+    if not value:
+        op = negated_ops[op]
+    name, offset = offset_name
+    # name + offset <op> right
+    other = evaluate(right, ranges)
+    lo, hi = ranges[name]
+    if op is ast.Lt:
+        hi = min(hi, other[1] - 1 - offset)
+    elif op is ast.LtE:
+        hi = min(hi, other[1] - offset)
+    elif op is ast.Gt:
+        lo = max(lo, other[0] + 1 - offset)
+    elif op is ast.GtE:
+        lo = max(lo, other[0] - offset)
+    elif op is ast.Eq:
+        lo = max(lo, other[0] - offset)
+        hi = min(hi, other[1] - offset)
+    elif other[0] == other[1]:
+        # name + offset != n, only narrows the interval at its bounds
+        if lo == other[0] - offset:
+            lo += 1
+        if hi == other[0] - offset:
+            hi -= 1
+    if lo > hi:
+        return None
+    ranges = dict(ranges)
+    ranges[name] = (lo, hi)
+    return ranges
+
+
+def widen_lower(lo):
+    """
+    Widens a decreasing lower bound.  Variables are usually unsigned, so stop
+    at 0 before going to minus infinity.
+    """
+    return 0 if lo >= 0 else -INF
+
+
+def join_ranges(a, b):
+    """Joins two dicts mapping names to intervals, ``None`` is empty"""
+    if a is None:
+        return b
+    elif b is None:
+        return a
+    return {name: join(interval, b[name]) for name, interval in a.items()}
+
+
+def transfer(root, ranges, variables):
+    """
+    Walks the diagram starting at ``root`` in topological order, narrowing
+    ``ranges`` (the intervals at the start of the cycle) on the edges of each
+    ``Decision``.  ``variables`` are the names that may be assigned.  The
+    ranges reaching a node shared by several paths are joined.
+
+    Assigned values only depend on the start of the cycle, so they are
+    evaluated when the path ends, with the ranges narrowed by every
+    condition on the path (including the ones after the assignment).
+
+    Returns a dict mapping each yield the diagram ends in to the intervals of
+    ``variables`` at the start of the next cycle
+    """
+    # Each node maps to a tuple (ranges, assigned).  ``assigned`` maps
+    # variables to the value assigned on the paths to the node, an
+    # expression or an interval
+    incoming = {root: (ranges, {})}
+
+    def resolve(var, assigned, node_ranges):
+        value = assigned.get(var)
+        if value is None:
+            return node_ranges[var]
+        elif isinstance(value, tuple):
+            return value
+        return evaluate(value, node_ranges)
+
+    def add_incoming(node, node_ranges, assigned):
+        if node_ranges is None:
+            # Infeasible edge
+            return
+        if node in incoming:
+            # Joining the ranges loses the conditions that only hold on one
+            # of the paths, so the assigned values are evaluated first
+            other_ranges, other_assigned = incoming[node]
+            assigned = {
+                var: join(resolve(var, assigned, node_ranges),
+                          resolve(var, other_assigned, other_ranges))
+                for var in set(assigned) | set(other_assigned)
+            }
+            node_ranges = join_ranges(node_ranges, other_ranges)
+        incoming[node] = (node_ranges, assigned)
+
+    result = {}
+    for node in sort_transitions({0: root}):
+        if node not in incoming:
+            # Only reached through infeasible edges
+            continue
+        node_ranges, assigned = incoming.pop(node)
+        if isinstance(node, Step):
+            assigned = dict(assigned)
+            for statement in node.statements:
+                if not isinstance(statement, ast.Assign):
+                    continue
+                for target in statement.targets:
+                    if isinstance(target, ast.Name):
+                        if target.id in variables:
+                            assigned[target.id] = statement.value
+                    else:
+                        # Partial assignments (e.g. ``x[0] = 1``)
+                        for name in ast.walk(target):
+                            if isinstance(name, ast.Name) and \
+                                    name.id in variables:
+                                assigned[name.id] = UNKNOWN
+            add_incoming(node.next, node_ranges, assigned)
+        elif isinstance(node, Decision):
+            add_incoming(node.true_edge,
+                         refine(node.cond, True, node_ranges), assigned)
+            add_incoming(node.false_edge,
+                         refine(node.cond, False, node_ranges), assigned)
+        else:
+            next_ranges = {var: resolve(var, assigned, node_ranges)
+                           for var in variables}
+            result[node.end_yield_id] = join_ranges(
+                result.get(node.end_yield_id), next_ranges)
+    return result
+
+
+def infer_ranges(transitions, variables, inputs):
+    """
+    ``variables`` are the names of the local variables, which start at 0,
+    and ``inputs`` a list of ``(name, width)`` tuples.
+
+    The intervals are computed separately for the start of each yield, e.g.
+    a loop variable is only known to be smaller than the bound in the yields
+    inside the loop.
+
+    Returns a dict mapping each variable to an interval containing the
+    values it can take, with infinite bounds if it is not bounded
+    """
+    input_ranges = {name: (0, (1 << width) - 1) for name, width in inputs}
+    initial = dict(input_ranges)
+    initial.update({var: (0, 0) for var in variables})
+    variables = set(variables)
+
+    def iterate(ranges, widen):
+        """Returns the ranges after one cycle from each yield in ``ranges``"""
+        new_ranges = {0: initial}
+        for yield_id, yield_ranges in ranges.items():
+            for target, target_ranges in transfer(
+                    transitions[yield_id], yield_ranges, variables).items():
+                # Inputs can change every cycle
+                target_ranges.update(input_ranges)
+                new_ranges[target] = join_ranges(new_ranges.get(target),
+                                                 target_ranges)
+        if widen:
+            for yield_id, yield_ranges in new_ranges.items():
+                old = ranges.get(yield_id)
+                if old is None:
+                    continue
+                new_ranges[yield_id] = {
+                    name: (widen_lower(new[0]) if new[0] < old[name][0]
+                           else new[0],
+                           INF if new[1] > old[name][1] else new[1])
+                    for name, new in join_ranges(yield_ranges, old).items()
+                }
+        return new_ranges
+
+    ranges = {0: initial}
+    iteration = 0
+    while True:
+        new_ranges = iterate(ranges, iteration >= WIDEN_AFTER)
+        for yield_id, yield_ranges in ranges.items():
+            new_ranges[yield_id] = join_ranges(new_ranges.get(yield_id),
+                                               yield_ranges)
+        if new_ranges == ranges:
+            break
+        ranges = new_ranges
+        iteration += 1
+    # Every value at the start of a yield is either the initial value or
+    # comes from a transition, so this is still sound and tightens the
+    # widened bounds
+    for _ in range(NARROWING_ITERATIONS):
+        ranges = iterate(ranges, False)
+
+    result = {}
+    for yield_ranges in ranges.values():
+        for var in variables:
+            result[var] = join(result.get(var), yield_ranges[var])
+    return result
+
+
+def infer_widths(transitions, local_vars, inputs, default_width=None):
+    """
+    ``local_vars`` is a list of ``(name, width)`` tuples with the declared
+    width of each local variable (``None`` if it was not declared).  A
+    variable gets the width of its inferred range if the range is bounded,
+    not negative and does not overflow the declared width (otherwise it
+    relies on wrapping around and keeps the declared width).  Variables that
+    are not bounded and not declared get ``default_width``, or raise a
+    ``WidthInferenceError`` if it is ``None``.
+
+    Returns a new list of ``(name, width)`` tuples
+    """
+    ranges = infer_ranges(transitions, [name for name, _ in local_vars],
+                          inputs)
+    widths = []
+    for name, declared in local_vars:
+        lo, hi = ranges[name]
+        if is_natural((lo, hi)) and (declared is None or hi < 1 << declared):
+            width = max(int(hi).bit_length(), 1)
+        elif declared is None and default_width is not None:
+            width = default_width
+        elif declared is None:
+            raise WidthInferenceError(
+                "Could not infer the width of `{}`, declare it with "
+                "`{} = Register(width)`".format(name, name))
+        else:
+            width = declared
+        widths.append((name, width))
+    return widths
@@ -0,0 +1,180 @@
+"""
+State minimization for the decision diagrams of a ``ControlFlowGraph``
+
+Two yields are equivalent if their diagrams only differ in the (equivalent)
+yields they end in.  Equivalent yields are merged with Hopcroft's partition
+refinement algorithm and the remaining yields are renumbered.
+"""
+from silica.cfg.types import Step, Decision, End, sort_transitions
+
+
+def get_contents(nodes):
+    """
+    Returns a dict mapping each node to a hashable description of the node
+    without its successors.  Statements and conditions are interned (see
+    ``silica.cfg.expressions``), so they are compared by identity.
+    """
+    contents = {}
+    for node in nodes:
+        if isinstance(node, Step):
+            contents[node] = ("step", tuple(node.statements))
+        elif isinstance(node, Decision):
+            contents[node] = ("decision", node.cond)
+        else:
+            contents[node] = ("end",)
+    return contents
+
+
+def get_signature(root, contents):
+    """
+    Returns a tuple ``(signature, targets)`` for the diagram starting at
+    ``root``.  ``signature`` describes the diagram with the yield of each
+    ``End`` node abstracted away and ``targets`` lists those yields, so two
+    diagrams with the same signature are equivalent if their ``targets`` are
+    equivalent position by position.
+    """
+    order = {}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node in order:
+            continue
+        order[node] = len(order)
+        if isinstance(node, Step):
+            stack.append(node.next)
+        elif isinstance(node, Decision):
+            stack.append(node.false_edge)
+            stack.append(node.true_edge)
+    signature = []
+    targets = []
+    for node in sorted(order, key=order.get):
+        if isinstance(node, Step):
+            successors = (order[node.next],)
+        elif isinstance(node, Decision):
+            successors = (order[node.true_edge], order[node.false_edge])
+        else:
+            successors = ()
+            targets.append(node.end_yield_id)
+        signature.append((contents[node], successors))
+    return tuple(signature), targets
+
+
+def refine_partition(states, signatures, targets):
+    """
+    Hopcroft's algorithm.  ``states`` are yield ids, the initial partition
+    groups states with the same signature and the transition on symbol ``k``
+    from state ``s`` is ``targets[s][k]``.
+
+    Returns a list of sets of equivalent states
+    """
+    partition = {}
+    for state in states:
+        partition.setdefault(signatures[state], set()).add(state)
+    blocks = list(partition.values())
+    block_of = {}
+    for i, block in enumerate(blocks):
+        for state in block:
+            block_of[state] = i
+
+    # inverse[target][k] is the set of states whose k-th target is target
+    inverse = {state: {} for state in states}
+    for state in states:
+        for k, target in enumerate(targets[state]):
+            inverse[target].setdefault(k, set()).add(state)
+
+    worklist = list(range(len(blocks)))
+    in_worklist = set(worklist)
+    while worklist:
+        splitter = worklist.pop()
+        in_worklist.remove(splitter)
+        predecessors = {}
+        for target in blocks[splitter]:
+            for k, sources in inverse[target].items():
+                predecessors.setdefault(k, set()).update(sources)
+        for k, sources in sorted(predecessors.items()):
+            touched = {}
+            for state in sources:
+                touched.setdefault(block_of[state], set()).add(state)
+            for i, inside in sorted(touched.items()):
+                if len(inside) == len(blocks[i]):
+                    continue
+                outside = blocks[i] - inside
+                blocks[i] = inside
+                blocks.append(outside)
+                new = len(blocks) - 1
+                for state in outside:
+                    block_of[state] = new
+                if i in in_worklist:
+                    worklist.append(new)
+                    in_worklist.add(new)
+                else:
+                    smaller = i if len(inside) <= len(outside) else new
+                    worklist.append(smaller)
+                    in_worklist.add(smaller)
+    return blocks
+
+
+def rename_ends(transitions, new_ids, nodes):
+    """
+    Rebuilds the diagrams in ``transitions`` (whose nodes, in topological
+    order, are ``nodes``) with each ``End`` moved to ``new_ids[end_yield_id]``.
+    Decisions whose edges become identical are removed.
+    """
+    table = {}
+    renamed = {}
+    for node in reversed(nodes):
+        if isinstance(node, Step):
+            next = renamed[node.next]
+            key = ("step", id(node.statements), next)
+            if key not in table:
+                table[key] = Step(node.statements, next)
+        elif isinstance(node, Decision):
+            true_edge = renamed[node.true_edge]
+            false_edge = renamed[node.false_edge]
+            if true_edge is false_edge:
+                renamed[node] = true_edge
+                continue
+            key = ("decision", id(node.cond), true_edge, false_edge)
+            if key not in table:
+                table[key] = Decision(node.cond, true_edge, false_edge)
+        else:
+            key = ("end", new_ids[node.end_yield_id])
+            if key not in table:
+                table[key] = End(new_ids[node.end_yield_id])
+        renamed[node] = table[key]
+    return {new_ids[yield_id]: renamed[root]
+            for yield_id, root in transitions.items() if yield_id in new_ids}
+
+
+def minimize_states(transitions):
+    """
+    Removes yields that are unreachable from the initial state (yield 0) and
+    merges equivalent yields.  Yields are renumbered in order of their
+    smallest original id, so the initial state stays 0.
+
+    Returns the new transitions (see ``promote_live_variables``)
+    """
+    nodes = sort_transitions(transitions)
+    contents = get_contents(nodes)
+    signatures = {}
+    targets = {}
+    states = []
+    worklist = [0]
+    while worklist:
+        state = worklist.pop()
+        if state in signatures:
+            continue
+        states.append(state)
+        signatures[state], targets[state] = \
+            get_signature(transitions[state], contents)
+        worklist.extend(targets[state])
+
+    classes = sorted(refine_partition(states, signatures, targets), key=min)
+    new_ids = {}
+    for new_id, states in enumerate(classes):
+        for state in states:
+            new_ids[state] = new_id
+    representatives = {min(states): transitions[min(states)]
+                       for states in classes}
+    return rename_ends(representatives, new_ids,
+                       sort_transitions(representatives))
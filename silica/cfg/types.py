@@ -4,27 +4,42 @@ Class definitions for nodes in the CFG
 import ast
 
 class Block:
+    """
+    Base class for nodes in the CFG.  Blocks do not store their edges, they
+    are stored by the ``BlockGraph`` the block was added to, indexed by the
+    block's integer ``id``.  The edge attributes of a block are views over
+    that storage.
+    """
+    __slots__ = ("id", "graph")
+
     def __init__(self):
-        self.outgoing_edges = set()
-        self.incoming_edges = set()
+        self.id = None
+        self.graph = None
 
-    def add_outgoing_edge(self, sink, label=""):
-        self.outgoing_edges.add((sink, label))
+    @property
+    def outgoing_edges(self):
+        return {(self.graph.blocks[sink], label)
+                for sink, label in self.graph.outgoing[self.id]}
 
-    def add_incoming_edge(self, source, label=""):
-        self.incoming_edges.add((source, label))
+    @property
+    def incoming_edges(self):
+        return {(self.graph.blocks[source], label)
+                for source, label in self.graph.incoming[self.id]}
 
     @property
     def outgoing_edge(self):
-        assert len(self.outgoing_edges) == 1
-        return next(iter(self.outgoing_edges))
+        assert len(self.graph.outgoing[self.id]) == 1
+        sink, label = self.graph.outgoing[self.id][0]
+        return self.graph.blocks[sink], label
 
 
 class HeadBlock(Block):
-    pass
+    __slots__ = ()
 
 
 class BasicBlock(Block):
+    __slots__ = ("statements",)
+
     def __init__(self):
         super().__init__()
         self.statements = []
@@ -35,21 +50,114 @@ class BasicBlock(Block):
 
 
 class Branch(Block):
+    __slots__ = ("cond",)
+
     def __init__(self, cond):
         super().__init__()
         self.cond = cond
-        self.true_edge = None
-        self.false_edge = None
 
-    def add_false_edge(self, sink):
-        self.false_edge = sink
+    @property
+    def true_edge(self):
+        return self.graph.get_sink(self.id, "T")
 
-    def add_true_edge(self, sink):
-        self.true_edge = sink
+    @property
+    def false_edge(self):
+        return self.graph.get_sink(self.id, "F")
 
 
 class Yield(Block):
-    pass
+    __slots__ = ("yield_id",)
+
+    def __init__(self, yield_id=None):
+        super().__init__()
+        self.yield_id = yield_id
+
+
+class BlockGraph:
+    """
+    Compact storage for the CFG.  Blocks are numbered in the order they are
+    added and ``blocks``, ``outgoing`` and ``incoming`` are lists indexed by
+    block id.  Edges are stored as ``(block id, label)`` pairs, where the
+    label is "T" or "F" for the edges leaving a ``Branch`` and "" otherwise.
+
+    Removing a block leaves a ``None`` hole in the lists until ``compact`` is
+    called, so ids stay valid while the graph is being simplified.
+    """
+    def __init__(self):
+        self.blocks = []
+        self.outgoing = []
+        self.incoming = []
+
+    def add_block(self, block):
+        block.id = len(self.blocks)
+        block.graph = self
+        self.blocks.append(block)
+        self.outgoing.append([])
+        self.incoming.append([])
+        return block
+
+    def add_edge(self, source, sink, label=""):
+        """
+        Add an edge between the blocks with ids source and sink with label
+        """
+        edge = (sink, label)
+        if edge not in self.outgoing[source]:
+            self.outgoing[source].append(edge)
+            self.incoming[sink].append((source, label))
+
+    def remove_edge(self, source, sink, label=""):
+        self.outgoing[source].remove((sink, label))
+        self.incoming[sink].remove((source, label))
+
+    def get_sink(self, source, label):
+        """
+        Returns the block the edge leaving source with label leads to (or
+        ``None``)
+        """
+        for sink, sink_label in self.outgoing[source]:
+            if sink_label == label:
+                return self.blocks[sink]
+        return None
+
+    def remove_block(self, block_id):
+        """
+        Removes the block with id ``block_id`` from the graph and collapses
+        incoming edges to outgoing edges.
+        """
+        incoming = self.incoming[block_id]
+        outgoing = self.outgoing[block_id]
+        for source, source_label in incoming:
+            self.outgoing[source].remove((block_id, source_label))
+        for sink, sink_label in outgoing:
+            self.incoming[sink].remove((block_id, sink_label))
+        for source, source_label in incoming:
+            if isinstance(self.blocks[source], Branch):
+                if len(outgoing) == 1:
+                    self.add_edge(source, outgoing[0][0], source_label)
+                else:
+                    assert not outgoing
+            else:
+                for sink, _ in outgoing:
+                    self.add_edge(source, sink, source_label)
+        self.blocks[block_id] = None
+        self.outgoing[block_id] = None
+        self.incoming[block_id] = None
+
+    def compact(self):
+        """
+        Renumber the blocks to remove the holes left by ``remove_block``
+        """
+        blocks = [block for block in self.blocks if block is not None]
+        new_ids = {block.id: i for i, block in enumerate(blocks)}
+
+        def renumber(edges):
+            return [(new_ids[block_id], label) for block_id, label in edges]
+
+        self.outgoing = [renumber(self.outgoing[block.id]) for block in blocks]
+        self.incoming = [renumber(self.incoming[block.id]) for block in blocks]
+        for i, block in enumerate(blocks):
+            block.id = i
+        self.blocks = blocks
 
 
 class State:
@@ -67,3 +175,92 @@ class State:
             [ast.Name("yield_state", ast.Store())],
             ast.Num(end_yield_id)
         ))
+
+
+class PathNode:
+    """
+    A node in the DAG of paths between yields.
+
+    Each node is identified by the id of a block in the CFG and the label of
+    the edge taken out of that block ("T" or "F" for a ``Branch``, "" otherwise).
+    A node is created once per (block id, label) pair, so every path through an
+    edge shares the same node and the DAG has at most two nodes per block.
+    """
+    __slots__ = ("block_id", "label", "successors")
+
+    def __init__(self, block_id, label=""):
+        self.block_id = block_id
+        self.label = label
+        self.successors = []
+
+
+class Transition:
+    """
+    Base class for the nodes of the decision diagram describing one clock
+    cycle of the FSM (built by ``promote_live_variables``).  Statements and
+    conditions have been promoted, so they only read values from the
+    previous cycle.  Nodes are hash-consed: structurally identical nodes are
+    the same object, so a diagram shares every common suffix.
+    """
+    __slots__ = ()
+
+
+class Step(Transition):
+    """
+    Executes ``statements`` then continues to ``next``
+    """
+    __slots__ = ("statements", "next")
+
+    def __init__(self, statements, next):
+        self.statements = statements
+        self.next = next
+
+
+class Decision(Transition):
+    """
+    Continues to ``true_edge`` if ``cond`` holds, otherwise to ``false_edge``
+    """
+    __slots__ = ("cond", "true_edge", "false_edge")
+
+    def __init__(self, cond, true_edge, false_edge):
+        self.cond = cond
+        self.true_edge = true_edge
+        self.false_edge = false_edge
+
+
+class End(Transition):
+    """
+    Ends the cycle by moving to the yield with id ``end_yield_id``
+    """
+    __slots__ = ("end_yield_id",)
+
+    def __init__(self, end_yield_id):
+        self.end_yield_id = end_yield_id
+
+
+def sort_transitions(transitions):
+    """
+    Returns the nodes of the decision diagrams in ``transitions`` (as returned
+    by ``promote_live_variables``) in topological order, i.e. every node
+    comes before its successors
+    """
+    order = []
+    seen = set()
+    stack = [(root, False) for _, root in sorted(transitions.items(),
+                                                 reverse=True)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            order.append(node)
+            continue
+        if node in seen:
+            continue
+        seen.add(node)
+        stack.append((node, True))
+        if isinstance(node, Step):
+            stack.append((node.next, False))
+        elif isinstance(node, Decision):
+            stack.append((node.false_edge, False))
+            stack.append((node.true_edge, False))
+    order.reverse()
+    return order
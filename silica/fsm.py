@@ -2,9 +2,10 @@ import magma
 import ast
 import astor
 import inspect
-from silica.backend import PyFSM
+from silica.backend import PyFSMDefinition
 import silica.backend
 from silica.cfg import ControlFlowGraph
+from silica.cfg.infer_widths import infer_widths
 import silica.ast_utils as ast_utils
 from silica.transformations import desugar_for_loops, \
     desugar_yield_from_range, specialize_constants, constant_fold, \
@@ -37,8 +38,24 @@ def validate_arguments(func):
 
 
 def FSM(f, func_locals, func_globals, backend, clock_enable=False,
-        render_cfg=False):
+        render_cfg=False, minimize_states=False, coverage=False,
+        encoding="binary"):
+    if coverage and backend != "pysim":
+        raise NotImplementedError(
+            "Coverage is only supported by the pysim backend")
+    if clock_enable and backend == "batch":
+        raise NotImplementedError(
+            "Clock enables are not supported by the batch backend")
+    if encoding != "binary" and backend not in ("magma", "netlist"):
+        raise NotImplementedError(
+            "State encodings are only supported by the magma and netlist "
+            "backends")
     constants = {}
+    if backend == "pysim":
+        # Like ``PyFSM``, pysim reads module level constants at compile time
+        for name, value in func_globals.items():
+            if isinstance(value, (int, )):
+                constants[name] = value
     for name, value in func_locals.items():
         if isinstance(value, (int, )):
             constants[name] = value
@@ -47,7 +64,11 @@ def FSM(f, func_locals, func_globals, backend, clock_enable=False,
     file_dir = os.path.dirname(_file)
     # `ast_utils.get_ast` returns a module so grab first statement in body
     tree = ast_utils.get_ast(f).body[0]
-    validate_arguments(tree)
+    # Report errors with line numbers in the file defining the FSM
+    ast.increment_lineno(tree, line_no - 1)
+    if backend not in ("pysim", "batch", "c"):
+        # pysim, batch and c use the types of the python backend
+        validate_arguments(tree)
 
     local_vars = set()
     tree = specialize_constants(tree, constants)
@@ -58,16 +79,33 @@ def FSM(f, func_locals, func_globals, backend, clock_enable=False,
     tree, loopvars = desugar_for_loops(tree)
     local_vars.update(loopvars)
 
-    cfg = ControlFlowGraph(tree)
+    cfg = ControlFlowGraph(tree, minimize_states)
     local_vars.update(cfg.local_vars)
 
-    local_vars = list(sorted(local_vars))
     if render_cfg:
         cfg.render()  # pragma: no cover
+    if backend == "pysim":
+        return silica.backend.pysim.compile(cfg, sorted(local_vars), tree,
+                                            func_globals, func_locals,
+                                            coverage, _file)
+    elif backend == "batch":
+        return silica.backend.batch.compile(cfg, sorted(local_vars), tree,
+                                            func_globals, func_locals)
+    elif backend == "c":
+        return silica.backend.c.compile(cfg, sorted(local_vars), tree,
+                                        clock_enable, func_globals,
+                                        func_locals)
+
+    local_vars = infer_widths(cfg.transitions, list(sorted(local_vars)),
+                              ast_utils.get_inputs_from_func(tree))
     if backend == "magma":
         return silica.backend.magma.compile(cfg, local_vars, tree,
                                             clock_enable, func_globals,
-                                            func_locals)
+                                            func_locals, encoding)
+    elif backend == "netlist":
+        tree = silica.backend.magma.build_netlist(cfg, local_vars, tree,
+                                                  clock_enable, encoding)
+        return silica.backend.netlist.compile(tree, clock_enable)
     elif backend == "verilog":
         return silica.backend.verilog.compile(cfg, local_vars, tree,
                                               clock_enable, func_globals,
@@ -75,17 +113,26 @@ def FSM(f, func_locals, func_globals, backend, clock_enable=False,
     raise NotImplementedError(backend)
 
 
-def fsm(mode_or_fn="magma", clock_enable=False, render_cfg=False):
+def fsm(mode_or_fn="magma", clock_enable=False, render_cfg=False,
+        minimize_states=False, coverage=False, encoding="binary"):
     stack = inspect.stack()
     func_locals = stack[1].frame.f_locals
     func_globals = stack[1].frame.f_globals
     if isinstance(mode_or_fn, str):
         def wrapped(fn):
             if mode_or_fn == "python":
-                return PyFSM(fn, clock_enable)
+                if coverage:
+                    raise NotImplementedError(
+                        "Coverage is only supported by the pysim backend")
+                if encoding != "binary":
+                    raise NotImplementedError(
+                        "State encodings are only supported by the magma "
+                        "and netlist backends")
+                return PyFSMDefinition(fn, clock_enable)
             else:
                 return FSM(fn, func_locals, func_globals, mode_or_fn,
-                           clock_enable, render_cfg)
+                           clock_enable, render_cfg, minimize_states,
+                           coverage, encoding)
         return wrapped
     return FSM(mode_or_fn, func_locals, func_globals, "magma", clock_enable,
-               render_cfg)
+               render_cfg, minimize_states, encoding=encoding)
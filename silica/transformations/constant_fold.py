@@ -2,25 +2,85 @@ import ast
 import astor
 
 
+def fold_binop(node):
+    if isinstance(node.left, ast.Num) and \
+       isinstance(node.right, ast.Num):
+        result = eval(astor.to_source(node))
+        if result is True or result is False:
+            return ast.NameConstant(result)
+        return ast.Num(result)
+    elif isinstance(node.op, ast.Mult) and \
+         ((isinstance(node.left, ast.Num) and node.left.n == 0) or
+          (isinstance(node.right, ast.Num) and node.right.n == 0)):
+        return ast.Num(0)
+    elif isinstance(node.op, ast.Add):
+        if isinstance(node.left, ast.Num) and node.left.n == 0:
+            return node.right
+        elif isinstance(node.right, ast.Num) and node.right.n == 0:
+            return node.left
+        elif isinstance(node.right, ast.Num) and \
+             isinstance(node.left, ast.BinOp) and \
+             isinstance(node.left.op, ast.Add) and \
+             isinstance(node.left.right, ast.Num):
+            # (x + a) + b -> x + (a + b), so repeatedly incrementing a
+            # variable does not build a deeply nested expression
+            return ast.BinOp(node.left.left, ast.Add(),
+                             ast.Num(node.left.right.n + node.right.n))
+    return node
+
+
+def fold_compare(node):
+    if isinstance(node.left, ast.Num) and \
+       all(isinstance(comparator, ast.Num)
+           for comparator in node.comparators):
+        return ast.NameConstant(eval(astor.to_source(node)))
+    return node
+
+
+def fold_boolop(node):
+    # ``True`` for ``and`` and ``False`` for ``or`` do not change the
+    # result, the other constant decides it
+    identity = isinstance(node.op, ast.And)
+    values = []
+    for value in node.values:
+        if isinstance(value, ast.NameConstant) and \
+           value.value in (True, False):
+            if value.value is not identity:
+                return ast.NameConstant(not identity)
+        else:
+            values.append(value)
+    if not values:
+        return ast.NameConstant(identity)
+    elif len(values) == 1:
+        return values[0]
+    elif len(values) < len(node.values):
+        return ast.BoolOp(node.op, values)
+    return node
+
+
+def fold_unaryop(node):
+    if isinstance(node.op, ast.Not) and \
+       isinstance(node.operand, ast.NameConstant) and \
+       node.operand.value in (True, False):
+        return ast.NameConstant(not node.operand.value)
+    return node
+
+
+# Rules applied to a node once its children have been folded.  A rule does
+# not modify the node, it returns the node or its replacement
+fold_rules = {
+    ast.BinOp: fold_binop,
+    ast.Compare: fold_compare,
+    ast.BoolOp: fold_boolop,
+    ast.UnaryOp: fold_unaryop,
+}
+
+
 class ConstantFold(ast.NodeTransformer):
-    def visit_BinOp(self, node):
-        node.left = self.visit(node.left)
-        node.right = self.visit(node.right)
-        if isinstance(node.left, ast.Num) and \
-           isinstance(node.right, ast.Num):
-            result = eval(astor.to_source(node))
-            if result is True or result is False:
-                return ast.NameConstant(result)
-            return ast.Num(result)
-        elif isinstance(node.op, ast.Mult) and \
-             ((isinstance(node.left, ast.Num) and node.left.n == 0) or
-              (isinstance(node.right, ast.Num) and node.right.n == 0)):
-            return ast.Num(0)
-        elif isinstance(node.op, ast.Add):
-            if isinstance(node.left, ast.Num) and node.left.n == 0:
-                return node.right
-            elif isinstance(node.right, ast.Num) and node.right.n == 0:
-                return node.left
+    def generic_visit(self, node):
+        node = super().generic_visit(node)
+        if type(node) in fold_rules:
+            return fold_rules[type(node)](node)
         return node
 
 def constant_fold(tree):
@@ -47,22 +47,23 @@ class ForLoopDesugarer(ast.NodeTransformer):
             if isinstance(stop, ast.Num):
                 width = (stop.n - 1).bit_length()
             else:
-                width = None
+                # Without ``bit_width`` the width is left to
+                # ``silica.cfg.infer_widths``
                 for keyword in node.iter.keywords:
                     if keyword.arg == "bit_width":
                         assert isinstance(keyword.value, ast.Num)
                         width = keyword.value.n
                         break
-                assert width is not None
             self.loopvars.add((node.target.id, width))
-            return [
+            # Keep the line number of the for loop for error messages
+            return [ast.copy_location(new_node, node) for new_node in [
                 ast.Assign([ast.Name(node.target.id, ast.Store())], start),
-                ast.While(ast.BinOp(ast.Name(node.target.id, ast.Load()), ast.Lt(), stop),
+                ast.While(ast.copy_location(ast.BinOp(ast.Name(node.target.id, ast.Load()), ast.Lt(), stop), node),
                     node.body + [
-                        ast.Assign([ast.Name(node.target.id, ast.Store())], ast.BinOp(
-                            ast.Name(node.target.id, ast.Load()), ast.Add(), incr))
+                        ast.copy_location(ast.Assign([ast.Name(node.target.id, ast.Store())], ast.BinOp(
+                            ast.Name(node.target.id, ast.Load()), ast.Add(), incr)), node)
                     ], [])
-            ]
+            ]]
         else:  # pragma: no cover
             print_ast(node)
             raise NotImplementedError("Unsupported for loop construct `{}`".format(to_source(node.iter)))
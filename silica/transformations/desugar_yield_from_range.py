@@ -4,11 +4,11 @@ class YieldFromRangeDesugarer(ast.NodeTransformer):
     def __init__(self):
         super().__init__()
         self.loopvars = set()
+        self.unique_id = -1
 
-    unique_id = -1
     def gen_loopvar(self, width):
-        YieldFromRangeDesugarer.unique_id += 1
-        loopvar = "____x{}".format(YieldFromRangeDesugarer.unique_id)
+        self.unique_id += 1
+        loopvar = "____x{}".format(self.unique_id)
         self.loopvars.add((loopvar, width))
         return loopvar
 
@@ -18,9 +18,10 @@ class YieldFromRangeDesugarer(ast.NodeTransformer):
             node = node.value
             width = node.value.args[-1].n.bit_length()
             loopvar = self.gen_loopvar(width)
-            return ast.For(ast.Name(loopvar, ast.Load()),
-                           node.value,
-                           [ast.Expr(ast.Yield(None))], None)
+            return ast.copy_location(ast.For(ast.Name(loopvar, ast.Load()),
+                                             node.value,
+                                             [ast.Expr(ast.Yield(None))], None),
+                                     node)
         node.value = self.visit(node.value)
         return node
 
@@ -7,7 +7,7 @@ class InlineConstants(ast.NodeTransformer):
         self.constants = constants
 
     def visit_Name(self, node):
-        if node.id in self.constants:
+        if node.id in self.constants and isinstance(node.ctx, ast.Load):
             return ast.Num(self.constants[node.id])
         return node
 
@@ -5,6 +5,78 @@ class IO:
 Output = IO()
 Input = IO()
 
+class BitVector:
+    """
+    A ``width`` bit value backed by an int.  Indexing and slicing are MSB
+    first, like the list of bits the value used to be, and a ``BitVector``
+    compares equal to that list (see ``as_list``) as well as to its integer
+    value.
+    """
+    __slots__ = ("_value", "width")
+
+    def __init__(self, value, width):
+        self._value = value & ((1 << width) - 1)
+        self.width = width
+
+    def __len__(self):
+        return self.width
+
+    def __int__(self):
+        return self._value
+
+    __index__ = __int__
+
+    def as_int(self):
+        return self._value
+
+    def as_list(self):
+        """
+        Returns the bits as a list, MSB first
+        """
+        return [(self._value >> i) & 1
+                for i in range(self.width - 1, -1, -1)]
+
+    def __iter__(self):
+        return iter(self.as_list())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.width)
+            if step != 1:
+                bits = self.as_list()[index]
+                value = 0
+                for bit in bits:
+                    value = (value << 1) | bit
+                return BitVector(value, len(bits))
+            width = max(stop - start, 0)
+            return BitVector(self._value >> (self.width - stop), width)
+        if index < 0:
+            index += self.width
+        if not 0 <= index < self.width:
+            raise IndexError("BitVector index out of range")
+        return (self._value >> (self.width - 1 - index)) & 1
+
+    def __eq__(self, other):
+        if isinstance(other, BitVector):
+            return self.width == other.width and self._value == other._value
+        elif isinstance(other, list):
+            return self.as_list() == other
+        elif isinstance(other, int):
+            return self._value == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "BitVector({}, {})".format(self._value, self.width)
+
+
 class _IO:
     def __init__(self, width=1):
         self._value = 0
@@ -13,17 +85,18 @@ class _IO:
     @property
     def value(self):
         if self.width > 1:
-            val = []
-            _val = self._value
-            for i in range(0, self.width):
-                val.insert(0, _val & 1)
-                _val >>= 1
-            return val
+            return BitVector(self._value, self.width)
         return self._value
 
     @value.setter
     def value(self, value):
-        self._value = value
+        if isinstance(value, list):
+            # Bits, MSB first
+            bits = value
+            value = 0
+            for bit in bits:
+                value = (value << 1) | bit
+        self._value = int(value) & ((1 << self.width) - 1)
 
 
 class Output_(_IO):
@@ -22,3 +22,7 @@ def test_is_subscript_true():
 def test_is_subscript_false():
     assert not is_subscript(ast.Num(3))
 
+
+def test_get_index():
+    assert to_source(get_index(ast.parse("a[i]").body[0].value)) == "i"
+    assert get_index(ast.parse("a[1:3]").body[0].value) is None
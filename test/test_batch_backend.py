@@ -0,0 +1,100 @@
+import numpy as np
+from silica import fsm, Input, Output
+
+
+def uart_transmitter(mode):
+    @fsm(mode)
+    def uart_transmitter(data : Input[8], signal : Input, tx : Output):
+        while True:
+            yield
+            if signal:
+                tx = 0  # start bit
+                yield
+                for i in range(0, 8):
+                    tx = data[i]
+                    yield
+                tx = 1  # end bit
+                yield
+    return uart_transmitter
+
+
+def test_uart_tx():
+    uart = uart_transmitter("batch")(3)
+    data = np.array([0xBE, 0x01, 0x80])
+    uart.IO.data.value = data
+    uart.IO.signal.value = 1
+
+    actual = ["", "", ""]
+    for i in range(0, 10):
+        next(uart)
+        for j, tx in enumerate(uart.IO.tx.value):
+            actual[j] += str(tx)
+    assert actual == ["0{0:08b}1".format(x) for x in data]
+
+
+def test_matches_python_backend():
+    instances = 16
+    rng = np.random.RandomState(0)
+    batch = uart_transmitter("batch")(instances)
+    pythons = [uart_transmitter("python") for _ in range(instances)]
+    for _ in range(100):
+        data = rng.randint(0, 256, instances)
+        signal = rng.randint(0, 2, instances)
+        batch.IO.data.value = data
+        batch.IO.signal.value = signal
+        next(batch)
+        for j, python in enumerate(pythons):
+            python.IO.data.value = int(data[j])
+            python.IO.signal.value = int(signal[j])
+            next(python)
+        assert list(batch.IO.tx.value) == \
+            [python.IO.tx.value for python in pythons]
+
+
+def test_bool_ops():
+    @fsm("batch")
+    def window(x : Input[4], inside : Output, edge : Output):
+        while True:
+            inside = 3 <= x < 12 and not x == 7
+            edge = x == 0 or x == 15
+            yield
+
+    sim = window(16)
+    sim.IO.x.value = np.arange(16)
+    next(sim)
+    xs = range(16)
+    assert list(sim.IO.inside.value) == \
+        [int(3 <= x < 12 and not x == 7) for x in xs]
+    assert list(sim.IO.edge.value) == [int(x == 0 or x == 15) for x in xs]
+
+
+def test_wrap_around():
+    def make(mode):
+        @fsm(mode)
+        def count(value : Output[4], odd : Output):
+            while True:
+                for i in range(0, 20):
+                    # Wider than the outputs
+                    value = i
+                    odd = i + 1
+                    yield
+        return count
+
+    batch, python = make("batch")(2), make("python")
+    for _ in range(50):
+        next(batch)
+        next(python)
+        assert list(batch.IO.value.value) == [int(python.IO.value.value)] * 2
+        assert list(batch.IO.odd.value) == [python.IO.odd.value] * 2
+
+
+def test_clock_enable_not_supported():
+    import pytest
+
+    with pytest.raises(NotImplementedError):
+        @fsm("batch", clock_enable=True)
+        def count(value : Output[4]):
+            while True:
+                for i in range(0, 16):
+                    value = i
+                    yield
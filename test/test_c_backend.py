@@ -0,0 +1,157 @@
+import numpy as np
+from silica import fsm, Input, Output
+
+
+def uart_transmitter(mode):
+    @fsm(mode)
+    def uart_transmitter(data : Input[8], signal : Input, tx : Output):
+        while True:
+            yield
+            if signal:
+                tx = 0  # start bit
+                yield
+                for i in range(0, 8):
+                    tx = data[i]
+                    yield
+                tx = 1  # end bit
+                yield
+    return uart_transmitter
+
+
+def test_uart_tx():
+    uart = uart_transmitter("c")()
+    uart.IO.data.value = 0xBE
+    uart.IO.signal.value = 1
+    actual = ""
+    for i in range(0, 10):
+        next(uart)
+        actual += str(uart.IO.tx.value)
+    assert actual == "0{0:08b}1".format(0xBE)
+
+
+def test_matches_pysim_backend():
+    @fsm("c")
+    def accumulate(add : Input, clear : Input, value : Input[4],
+                   total : Output[8], odd : Output):
+        x = Register(8)
+        while True:
+            if clear:
+                x = 0
+                odd = 0
+            elif add:
+                x = x + value
+                odd = value % 2 == 1
+            total = x
+            yield
+
+    @fsm("pysim")
+    def reference(add : Input, clear : Input, value : Input[4],
+                  total : Output[8], odd : Output):
+        x = Register(8)
+        while True:
+            if clear:
+                x = 0
+                odd = 0
+            elif add:
+                x = x + value
+                odd = value % 2 == 1
+            total = x
+            yield
+
+    rng = np.random.RandomState(0)
+    inputs = {"add": rng.randint(0, 2, 1000),
+              "clear": (rng.random_sample(1000) < 0.05).astype(np.int64),
+              "value": rng.randint(0, 16, 1000)}
+    c, python = accumulate(), reference()
+    actual = c.run(inputs)
+    expected = python.run(inputs)
+    # The registers of the C backend wrap at their width
+    assert list(actual["total"]) == list(expected["total"] % 256)
+    assert list(actual["odd"]) == list(expected["odd"])
+    assert int(c.IO.total.value) == int(python.IO.total.value) % 256
+    assert c.cycle == python.cycle == 1000
+    # An iterator might never run out, a list bounds it
+    import itertools
+    import pytest
+    with pytest.raises(ValueError):
+        c.run({"add": itertools.repeat(1)})
+    outputs = c.run({"add": itertools.repeat(1), "value": [1, 2]})
+    assert len(outputs["total"]) == 2
+
+
+def test_run_buffers():
+    @fsm("c")
+    def count(step : Input[4], value : Output[16]):
+        # Unbounded, so it is a 64 bit integer
+        x = Register()
+        while True:
+            x = x + step
+            value = x
+            yield
+
+    counter = count()
+    steps = np.arange(100, dtype=np.int64).reshape(100, 1) % 16
+    values = np.zeros((100, 1), dtype=np.int64)
+    counter.run_buffers(100, steps, values)
+    assert list(values[:, 0]) == list(np.cumsum(steps[:, 0]))
+    # Without an input buffer, the inputs keep their current value
+    counter.IO.step.value = 1
+    counter.run_buffers(10, outputs=values)
+    assert values[9, 0] == np.sum(steps) + 10
+    counter.run_until(5)
+    assert int(counter.IO.value.value) == np.sum(steps) + 15
+
+
+def test_snapshot_and_clock_enable():
+    @fsm("c", clock_enable=True)
+    def count(value : Output[8]):
+        x = Register(8)
+        while True:
+            x = x + 1
+            value = x
+            yield
+
+    # The first cycle is run by the constructor
+    counter = count()
+    counter.IO.CE.value = 0
+    counter.run_until(10)
+    assert int(counter.IO.value.value) == 1
+    counter.IO.CE.value = 1
+    counter.run_until(300)
+    assert int(counter.IO.value.value) == 301 % 256
+    snapshot = counter.snapshot()
+    next(counter)
+    counter.restore(snapshot)
+    next(counter)
+    assert int(counter.IO.value.value) == 302 % 256
+
+
+def test_overflow_matches_netlist_backend():
+    from magma import In, Out, Array, Bit
+
+    @fsm("c")
+    def count(step : Input[4], value : Output[8]):
+        x = Register(4)
+        while True:
+            x = x + step
+            # ``x + step`` wraps at the width of ``x``
+            value = x
+            yield
+
+    @fsm("netlist")
+    def reference(step : In(Array(4, Bit)), value : Out(Array(8, Bit))):
+        x = Register(4)
+        while True:
+            x = x + step
+            value = x
+            yield
+
+    c, netlist = count(), reference()
+    values = []
+    for cycle in range(40):
+        for sim in (c, netlist):
+            sim.IO.step.value = cycle % 7
+            next(sim)
+        values.append(int(c.IO.value.value))
+        assert values[-1] == int(netlist.IO.value.value)
+    assert max(values) < 16
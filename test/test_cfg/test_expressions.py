@@ -0,0 +1,41 @@
+import ast
+import astor
+
+from silica.cfg.expressions import ExpressionTable
+
+
+def test_intern():
+    expressions = ExpressionTable()
+    a = expressions.intern(ast.parse("x + (y * 2)").body[0].value)
+    b = expressions.intern(ast.parse("x + (y * 2)").body[0].value)
+    c = expressions.intern(ast.parse("x + (y * 3)").body[0].value)
+    assert a is b
+    assert a is not c
+    assert a.left is c.left
+
+
+def test_substitute_shares_values():
+    expressions = ExpressionTable()
+    tree = ast.parse("z = x + x * y").body[0]
+    value = ast.parse("a - 1").body[0].value
+    result = expressions.substitute(tree, {"x": value}, ast.Load)
+    assert astor.to_source(result).rstrip() == "z = a - 1 + (a - 1) * y"
+    assert result.value.left is result.value.right.left
+    # The original tree is not modified
+    assert astor.to_source(tree).rstrip() == "z = x + x * y"
+    # Neither is the interned version
+    assert expressions.substitute(tree, {}, ast.Load) is \
+        expressions.intern(tree)
+
+
+def test_fold():
+    expressions = ExpressionTable()
+    tree = ast.parse("x = 0").body[0]
+    increment = ast.parse("x = x + 1").body[0]
+    for _ in range(3):
+        increment = expressions.fold(expressions.substitute(
+            increment, {"x": ast.parse("x + 1").body[0].value}, ast.Load))
+    assert astor.to_source(increment).rstrip() == "x = x + 4"
+    result = expressions.fold(expressions.substitute(
+        ast.parse("x < 8 and y").body[0].value, {"x": tree.value}))
+    assert astor.to_source(result).rstrip() == "y"
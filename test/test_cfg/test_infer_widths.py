@@ -0,0 +1,77 @@
+from magma import *
+from silica.cfg import ControlFlowGraph
+from silica.cfg.infer_widths import infer_widths, infer_ranges, \
+    WidthInferenceError
+from silica.ast_utils import get_ast
+
+
+def test_guarded_counter():
+    def func(a : In(Bit), b : Out(Bit)):
+        count = Register(32)
+        while True:
+            if count < 9:
+                count = count + 1
+            else:
+                count = 0
+            b = count == 0
+            yield
+
+    cfg = ControlFlowGraph(get_ast(func).body[0])
+    assert infer_ranges(cfg.transitions, ["count"], [("a", 1)]) == \
+        {"count": (0, 9)}
+    assert infer_widths(cfg.transitions, [("count", 32)], [("a", 1)]) == \
+        [("count", 4)]
+
+
+def test_loop_variable():
+    def func(n : In(Array(3, Bit)), data : In(Array(8, Bit)),
+             tx : Out(Bit)):
+        i = Register()
+        while True:
+            i = 0
+            while i < n:
+                tx = data[i]
+                yield
+                i = i + 1
+            tx = 1
+            yield
+
+    cfg = ControlFlowGraph(get_ast(func).body[0])
+    assert infer_widths(cfg.transitions, [("i", None)], [("n", 3)]) == \
+        [("i", 3)]
+
+
+def test_bit_select():
+    def func(data : In(Array(8, Bit)), tx : Out(Bit)):
+        i = Register(3)
+        bit = Register()
+        while True:
+            bit = data[i]
+            yield
+            tx = bit
+            i = i + 1
+            yield
+
+    cfg = ControlFlowGraph(get_ast(func).body[0])
+    assert infer_widths(cfg.transitions, [("bit", None), ("i", 3)],
+                        [("data", 8)]) == [("bit", 1), ("i", 3)]
+
+
+def test_wrap_around_keeps_declared_width():
+    def func(a : In(Bit), b : Out(Array(4, Bit))):
+        count = Register(4)
+        x = Register()
+        while True:
+            count = count + 1
+            x = x + 1
+            b = count + x
+            yield
+
+    cfg = ControlFlowGraph(get_ast(func).body[0])
+    assert infer_widths(cfg.transitions, [("count", 4)], []) == [("count", 4)]
+    try:
+        infer_widths(cfg.transitions, [("x", None)], [])
+        assert False, "Unbounded variable without a width should raise"
+    except WidthInferenceError as e:
+        assert str(e) == "Could not infer the width of `x`, declare it " \
+                         "with `x = Register(width)`"
@@ -0,0 +1,40 @@
+from magma import *
+from silica.cfg import ControlFlowGraph
+from silica.cfg.types import Step, End
+from silica.ast_utils import get_ast
+
+
+def test_merge_equivalent_yields():
+    def func(a : In(Bit), b : Out(Bit)):
+        while True:
+            b = a
+            yield
+            b = a
+            yield
+
+    tree = get_ast(func).body[0]
+    assert len(ControlFlowGraph(tree).transitions) == 3
+    cfg = ControlFlowGraph(tree, minimize=True)
+    assert list(cfg.transitions) == [0]
+    step = cfg.transitions[0]
+    assert isinstance(step, Step)
+    assert isinstance(step.next, End) and step.next.end_yield_id == 0
+    assert len(cfg.states) == 1
+
+
+def test_distinguish_yields_by_successor():
+    def func(a : In(Bit), b : Out(Bit)):
+        while True:
+            b = 1
+            yield
+            b = 1
+            yield
+            b = 0
+            yield
+
+    cfg = ControlFlowGraph(get_ast(func).body[0], minimize=True)
+    # The initial state and the last yield both assign ``b = 1`` twice before
+    # ``b = 0``, the other two yields are distinct
+    assert sorted(cfg.transitions) == [0, 1, 2]
+    assert sorted((state.start_yield_id, state.end_yield_id)
+                  for state in cfg.states) == [(0, 1), (1, 2), (2, 0)]
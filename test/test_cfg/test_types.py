@@ -1,23 +1,43 @@
-
 def test_Block():
-    from silica.cfg.types import Block
+    from silica.cfg.types import Block, BlockGraph
 
-    b = Block()
+    graph = BlockGraph()
+    b = graph.add_block(Block())
+    assert b.id == 0
     assert len(b.incoming_edges) == 0
     assert len(b.outgoing_edges) == 0
     assert isinstance(b.incoming_edges, set)
     assert isinstance(b.outgoing_edges, set)
 
     get_item_from_set = lambda _set: next(iter(_set))
-    c = Block()
-    b.add_outgoing_edge(c)
+    c = graph.add_block(Block())
+    graph.add_edge(b.id, c.id)
     assert get_item_from_set(b.outgoing_edges) == (c, "")
+    assert graph.outgoing[b.id] == [(c.id, "")]
 
-    d = Block()
-    d.add_incoming_edge(b, "F")
+    d = graph.add_block(Block())
+    graph.add_edge(b.id, d.id, "F")
     assert get_item_from_set(d.incoming_edges) == (b, "F")
 
 
+def test_BlockGraph_remove_block():
+    from silica.cfg.types import Block, BlockGraph
+
+    graph = BlockGraph()
+    a, b, c = [graph.add_block(Block()) for _ in range(3)]
+    graph.add_edge(a.id, b.id)
+    graph.add_edge(b.id, c.id)
+    graph.remove_block(b.id)
+    assert graph.blocks == [a, None, c]
+    assert a.outgoing_edges == {(c, "")}
+
+    graph.compact()
+    assert graph.blocks == [a, c]
+    assert c.id == 1
+    assert graph.outgoing == [[(1, "")], []]
+    assert graph.incoming == [[], [(0, "")]]
+
+
 def test_BasicBlock():
     from silica.cfg.types import BasicBlock, Block
     a = BasicBlock()
@@ -31,17 +51,18 @@ def test_BasicBlock():
 
 
 def test_Branch():
-    from silica.cfg.types import Branch, Block
-    a = Branch("cond")
+    from silica.cfg.types import Branch, Block, BlockGraph
+    graph = BlockGraph()
+    a = graph.add_block(Branch("cond"))
     assert isinstance(a, Block)
     assert a.cond == "cond"
     assert a.false_edge is None
     assert a.true_edge is None
 
-    b = Block()
-    a.add_false_edge(b)
+    b = graph.add_block(Block())
+    graph.add_edge(a.id, b.id, "F")
     assert a.false_edge is b
-    a.add_true_edge(b)
+    graph.add_edge(a.id, b.id, "T")
     assert a.true_edge is b
 
 def test_Yield():
@@ -1,8 +1,10 @@
 import ast
+import astor
 
 from magma import *
 from silica.cfg import ControlFlowGraph, Yield, BasicBlock, Branch
 from silica.cfg.types import HeadBlock
+from silica.cfg.control_flow_graph import CombinationalLoopError
 from silica.ast_utils import get_ast
 
 
@@ -29,3 +31,119 @@ def test1():
     branch = blocks[1]
     assert ast.dump(branch.cond) == ast.dump(ast.Name("b", ast.Load())), "branch.cond should be `b`"
 
+
+
+def test_wide_branching_paths_are_shared():
+    num_ifs = 10
+    args = ", ".join("valid_{0} : In(Bit), out_{0} : Out(Bit)".format(i)
+                     for i in range(num_ifs))
+    body = "".join("        if valid_{0}:\n            out_{0} = 1\n".format(i)
+                   for i in range(num_ifs))
+    src = "def func({}):\n    while True:\n{}        yield\n".format(args, body)
+    cfg = ControlFlowGraph(ast.parse(src).body[0])
+
+    nodes = set()
+    worklist = list(cfg.collect_paths_between_yields())
+    while worklist:
+        node = worklist.pop()
+        if node not in nodes:
+            nodes.add(node)
+            worklist.extend(node.successors)
+    assert len(nodes) <= 2 * len(cfg.blocks), "Path DAG should be linear in the size of the CFG"
+    # One path per combination of branches from the initial block and the yield
+    assert len(cfg.states) == 2 * 2 ** num_ifs
+
+
+def test_loop_without_yield():
+    def func(a : In(Bit), b : Out(Bit)):
+        while True:
+            while a:
+                b = 1
+            yield
+
+    try:
+        ControlFlowGraph(get_ast(func).body[0])
+        assert False, "Loop without a yield should raise an exception"
+    except CombinationalLoopError as e:
+        assert str(e) == "Found a loop without a yield in the FSM (lines 3, 4)"
+
+
+def test_long_fsm():
+    # Longer than the default recursion limit
+    num_statements = 3000
+    body = "        x = x + 1\n        out = x\n        yield\n" * num_statements
+    body += "        x = x + 1\n" * num_statements
+    src = "def func(out : Out(Array(16, Bit))):\n    x = Register(16)\n" \
+          "    while True:\n{}        yield\n".format(body)
+    cfg = ControlFlowGraph(ast.parse(src).body[0])
+    assert len(cfg.transitions) == num_statements + 2
+
+
+def test_wide_branching_transitions_are_linear():
+    from silica.cfg.control_flow_graph import sort_transitions
+    num_ifs = 100
+    args = ", ".join("valid_{0} : In(Bit), out_{0} : Out(Bit)".format(i)
+                     for i in range(num_ifs))
+    body = "".join("        if valid_{0}:\n            out_{0} = 1\n".format(i)
+                   for i in range(num_ifs))
+    src = "def func({}):\n    while True:\n{}        yield\n".format(args, body)
+    cfg = ControlFlowGraph(ast.parse(src).body[0])
+    # A decision and an assignment per if, and the end of the cycle.  The
+    # initial block and the yield share the same diagram.
+    assert len(sort_transitions(cfg.transitions)) == 2 * num_ifs + 1
+    assert cfg.transitions[0] is cfg.transitions[1]
+
+
+def test_infeasible_paths_are_pruned():
+    def func(a : In(Bit), x : In(Array(2, Bit)), b : Out(Bit)):
+        while True:
+            i = 0
+            if a:
+                i = 1
+            # Folds to a constant on both paths
+            if i < 1:
+                b = 1
+            yield
+            if x == 0:
+                b = 0
+            # Infeasible after ``x == 0``
+            if x == 1:
+                b = 1
+            yield
+
+    cfg = ControlFlowGraph(get_ast(func).body[0])
+    assert sorted((state.start_yield_id, len(state.conds))
+                  for state in cfg.states) == \
+        [(0, 1), (0, 1), (1, 1), (1, 2), (1, 2), (2, 1), (2, 1)]
+
+
+def test_locals_not_live_across_yields_are_removed():
+    def func(a : In(Array(4, Bit)), b : In(Array(4, Bit)),
+             c : Out(Array(4, Bit))):
+        tmp = Register(4)
+        count = Register(4)
+        while True:
+            tmp = a + b
+            c = tmp + count
+            count = count + 1
+            yield
+
+    cfg = ControlFlowGraph(get_ast(func).body[0])
+    assert cfg.state_vars == {"yield_state", "count"}
+    for state in cfg.states:
+        assert [astor.to_source(statement).rstrip()
+                for statement in state.statements[1:]] == \
+            ["c = a + b + count", "count = count + 1"]
+
+
+def test_read_only_registers_are_state_vars():
+    def func(a : In(Array(4, Bit)), c : Out(Array(4, Bit))):
+        offset = Register(4)
+        tmp = Register(4)
+        while True:
+            tmp = a
+            c = tmp + offset
+            yield
+
+    cfg = ControlFlowGraph(get_ast(func).body[0])
+    assert cfg.state_vars == {"yield_state", "offset"}
@@ -0,0 +1,176 @@
+import random
+
+from magma import *
+from silica import fsm, Input, Output
+from silica.ast_utils import get_ast, to_source
+from silica.cfg import ControlFlowGraph
+from silica.backend.magma import build_netlist
+from silica.backend.netlist import Netlist
+
+
+def uart_transmitter(encoding="binary"):
+    @fsm("netlist", encoding=encoding)
+    def uart_transmitter(data : In(Array(8, Bit)), valid : In(Bit), tx : Out(Bit)):
+        i = Register(4)
+        while True:
+            if valid:
+                tx = 0
+                yield
+                i = 0
+                while i < 8:
+                    tx = data[i]
+                    yield
+                    i = i + 1
+                tx = 1
+                yield
+                yield
+            else:
+                tx = 1
+                yield
+    return uart_transmitter
+
+
+def test_uart():
+    uart = uart_transmitter()()
+    uart.IO.data.value = 0x61
+    uart.IO.valid.value = 1
+    actual = []
+    for _ in range(11):
+        next(uart)
+        actual.append(uart.IO.tx.value)
+    # Bits are sent LSB first, as in the circuit built by magma
+    assert actual == [0] + int2seq(0x61, 8) + [1, 1]
+
+
+def test_state_encodings():
+    random.seed(0)
+    inputs = [(random.randint(0, 255), int(random.random() < 0.3))
+              for _ in range(300)]
+    expected = None
+    for encoding, width in (("binary", 3), ("one-hot", 5), ("gray", 3)):
+        uart = uart_transmitter(encoding)()
+        assert dict(uart.definition.registers)["yield_state"] == width
+        actual = []
+        for data, valid in inputs:
+            uart.IO.data.value = data
+            uart.IO.valid.value = valid
+            next(uart)
+            actual.append(uart.IO.tx.value)
+        if expected is None:
+            expected = actual
+        assert actual == expected
+
+
+def test_matches_pysim():
+    @fsm("netlist")
+    def accumulate(add : In(Bit), clear : In(Bit), value : In(Array(4, Bit)),
+                   total : Out(Array(8, Bit)), odd : Out(Bit)):
+        x = Register(8)
+        while True:
+            if clear:
+                x = 0
+                odd = 0
+            elif add:
+                x = x + value
+                odd = value[0]
+            total = x
+            yield
+
+    @fsm("pysim")
+    def reference(add : Input, clear : Input, value : Input[4],
+                  total : Output[8], odd : Output):
+        x = Register(8)
+        while True:
+            if clear:
+                x = 0
+                odd = 0
+            elif add:
+                x = x + value
+                odd = value & 1
+            total = x
+            yield
+
+    random.seed(0)
+    netlist, python = accumulate(), reference()
+    for _ in range(500):
+        inputs = {"add": random.randint(0, 1),
+                  "clear": int(random.random() < 0.05),
+                  "value": random.randint(0, 15)}
+        for sim in (netlist, python):
+            for name, value in inputs.items():
+                getattr(sim.IO, name).value = value
+            next(sim)
+        assert int(netlist.IO.total.value) == int(python.IO.total.value) % 256
+        assert netlist.IO.odd.value == python.IO.odd.value
+
+
+def test_read_only_register():
+    @fsm("netlist")
+    def offset(value : In(Array(4, Bit)), result : Out(Array(4, Bit))):
+        x = Register(4)
+        while True:
+            result = value + x
+            yield
+
+    # ``x`` is never assigned, it holds its initial value
+    adder = offset()
+    adder.IO.value.value = 3
+    next(adder)
+    assert int(adder.IO.result.value) == 3
+
+
+def test_clock_enable():
+    @fsm("netlist", clock_enable=True)
+    def count(value : Out(Array(8, Bit))):
+        x = Register(8)
+        while True:
+            x = x + 1
+            value = x
+            yield
+
+    # The first cycle is run by the constructor
+    counter = count()
+    counter.IO.CE.value = 0
+    counter.run_until(10)
+    assert int(counter.IO.value.value) == 1
+    counter.IO.CE.value = 1
+    counter.run_until(300)
+    assert int(counter.IO.value.value) == 301 % 256
+    snapshot = counter.snapshot()
+    next(counter)
+    counter.restore(snapshot)
+    next(counter)
+    assert int(counter.IO.value.value) == 302 % 256
+
+
+def test_shared_logic_and_hold_states():
+    def counter(go : In(Bit), count : Out(Array(4, Bit))):
+        x = Register(4)
+        while True:
+            while not go:
+                yield
+            x = x + 1
+            count = x
+            yield
+            x = x + 1
+            count = x
+            yield
+
+    tree = get_ast(counter).body[0]
+    netlist = Netlist(build_netlist(ControlFlowGraph(tree), [("x", 4)], tree,
+                                   False))
+    drivers = {net: to_source(driver)
+               for net, driver in netlist.drivers.items()}
+    assert netlist.registers == {"x_reg": 4, "count_reg": 4,
+                                 "yield_state_reg": 2}
+    # The states assigning ``x + 1`` share one adder (and no mux selects
+    # between them), the muxes are the enable and the next state
+    assert drivers["x_reg.I"] == drivers["count_reg.I"]
+    assert drivers[drivers["x_reg.I"]] == "(x_reg.O + 1)"
+    assert sorted(netlist.muxes) == ["x_en_sel_1", "x_en_sel_2",
+                                     "yield_state_3", "yield_state_sel_4",
+                                     "yield_state_sel_5"]
+    # The hold state clears the enable instead of feeding ``x`` back
+    assert drivers["x_reg.CE"] == drivers["count_reg.CE"] == "x_en_sel_2.O"
+    assert "x_reg.O" not in [driver for net, driver in drivers.items()
+                             if net.endswith((".I", ".I0", ".I1"))]
@@ -0,0 +1,103 @@
+from silica import fsm, Input, Output
+from silica.backend.network import Network
+
+
+@fsm("python")
+def producer(ack : Input, valid : Output, data : Output[8]):
+    count = 0
+    while True:
+        valid = 1
+        data = count
+        yield
+        while not ack:
+            yield
+        count = count + 1
+        valid = 0
+        yield
+
+
+@fsm("pysim")
+def consumer(valid : Input, data : Input[8], ack : Output, total : Output[16]):
+    x = Register(16)
+    while True:
+        ack = 0
+        while not valid:
+            yield
+        ack = 1
+        x = x + data
+        total = x + data
+        yield
+        ack = 0
+        yield
+        yield
+        yield
+
+
+@fsm("python")
+def waiter(go : Input, done : Output):
+    while True:
+        done = 0
+        while not go:
+            yield
+        done = 1
+        yield
+
+
+def step_by_hand(cycles):
+    """
+    Runs the network of ``test_network`` one instance at a time, the inputs
+    are the outputs from the previous cycle
+    """
+    source, sink = producer(), consumer()
+    total = []
+    for _ in range(cycles):
+        valid, data, ack = source.IO.valid.value, \
+            int(source.IO.data.value), sink.IO.ack.value
+        sink.IO.valid.value = valid
+        sink.IO.data.value = data
+        source.IO.ack.value = ack
+        next(source)
+        next(sink)
+        total.append(int(sink.IO.total.value))
+    return total
+
+
+def test_network():
+    network = Network()
+    source = network.add("source", producer())
+    sink = network.add("sink", consumer())
+    idle = network.add("idle", waiter)
+    network.connect(source.IO.valid, sink.IO.valid)
+    network.connect(source.IO.data, sink.IO.data)
+    network.connect(sink.IO.ack, source.IO.ack)
+
+    expected = step_by_hand(200)
+    for cycle in range(100):
+        next(network)
+        assert int(sink.IO.total.value) == expected[cycle]
+    network.run_until(100)
+    assert int(sink.IO.total.value) == expected[-1]
+    assert network.cycle == 200
+    assert sink.cycle == source.cycle == idle.cycle == 200
+
+    # Inputs set from outside are picked up by the next call
+    idle.IO.go.value = 1
+    next(network)
+    assert idle.IO.done.value == 1
+
+
+def test_network_errors():
+    import pytest
+
+    network = Network()
+    source = network.add("source", producer())
+    sink = network.add("sink", consumer())
+    with pytest.raises(ValueError):
+        network.add("sink", consumer())
+    with pytest.raises(ValueError):
+        network.connect(source.IO.data, sink.IO.valid)
+    with pytest.raises(ValueError):
+        network.connect(sink.IO.valid, source.IO.ack)
+    network.connect(source.IO.valid, sink.IO.valid)
+    with pytest.raises(ValueError):
+        network.connect(source.IO.valid, sink.IO.valid)
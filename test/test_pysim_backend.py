@@ -0,0 +1,461 @@
+from silica import fsm, Input, Output
+
+@fsm("pysim")
+def signal(valid : Input, done : Input, run : Output):
+    while True:
+        yield
+        if valid:
+            run = 1
+            while not done:
+                yield
+            run = 0
+
+def test_1():
+    signal.IO.valid.value = 1
+    signal.IO.done.value = 0
+    next(signal)
+    next(signal)
+    next(signal)
+    assert signal.IO.run.value == 1
+    signal.IO.done.value = 1
+    next(signal)
+    assert signal.IO.run.value == 0
+
+@fsm("pysim")
+def counter(run : Input, done : Output):
+    while True:
+        yield
+        if run:
+            for i in range(0, 15):
+                yield
+            done = 1
+            yield
+            done = 0
+
+def test_counter():
+    counter.IO.run.value = 1
+    next(counter)
+    for i in range(0, 15):
+        assert counter.IO.done.value == 0
+        next(counter)
+    assert counter.IO.done.value == 1
+
+@fsm("pysim")
+def uart_transmitter(data : Input[8], signal : Input, tx : Output):
+    while True:
+        yield
+        if signal:
+            tx = 0  # start bit
+            yield
+            for i in range(0, 8):
+                tx = data[i]
+                yield
+            tx = 1  # end bit
+            yield
+
+def test_uart_tx():
+    data = 0xBE
+    uart_transmitter.IO.data.value   = data
+    uart_transmitter.IO.signal.value = 1
+
+    expected = "0{0:b}1".format(data)
+    actual = ""
+    for i in range(0, 10):
+        next(uart_transmitter)
+        actual += str(uart_transmitter.IO.tx.value)
+    assert expected == actual
+
+
+def test_input_type_error():
+    try:
+        @fsm("pysim")
+        def write_to_input(a : Input, b : Output):
+            while True:
+                yield
+                a = 1
+                b = a
+        assert False, "Program should throw a type error"
+    except TypeError as e:
+        pass
+
+
+def test_output_type_error():
+    try:
+        @fsm("pysim")
+        def read_from_output(a : Input, b : Output, c : Output):
+            while True:
+                yield
+                b = a
+                c = b
+        assert False, "Program should throw a type error"
+    except TypeError as e:
+        assert str(e) == "Attempting to read from an Output variable b"
+
+
+VGA_NUM_ROWS     = 48
+VGA_NUM_COLS     = 64
+
+
+# Following in terms of 25 MHz clock
+VGA_HSYNC_TDISP  = VGA_NUM_COLS
+VGA_HSYNC_TPW    = 9
+VGA_HSYNC_TFP    = 1
+VGA_HSYNC_TBP    = 4
+VGA_HSYNC_OFFSET = VGA_HSYNC_TPW + VGA_HSYNC_TBP
+VGA_HSYNC_TS     = VGA_HSYNC_OFFSET + VGA_HSYNC_TDISP + VGA_HSYNC_TFP
+
+# Following in terms of lines
+VGA_VSYNC_TDISP  = VGA_NUM_ROWS
+VGA_VSYNC_TPW    = 2
+VGA_VSYNC_TFP    = 1
+VGA_VSYNC_TBP    = 3
+VGA_VSYNC_OFFSET = VGA_VSYNC_TPW + VGA_VSYNC_TBP
+VGA_VSYNC_TS     = VGA_VSYNC_OFFSET + VGA_VSYNC_TDISP + VGA_VSYNC_TFP
+def test_vga():
+
+    @fsm("pysim", clock_enable=True)
+    def vga_timing(
+            horizontal_sync : Output,
+            vertical_sync   : Output,
+            pixel_valid     : Output,
+            vga_row         : Output[10],
+            vga_col         : Output[10]):
+        while True:
+            for row in range(0, VGA_VSYNC_TS):
+                for col in range(0, VGA_HSYNC_TS):
+                    pixel_valid = VGA_VSYNC_OFFSET <= row <= VGA_VSYNC_OFFSET + VGA_NUM_ROWS and \
+                                  VGA_HSYNC_OFFSET <= col <= VGA_HSYNC_OFFSET + VGA_NUM_COLS
+
+                    horizontal_sync = 0 <= col < VGA_HSYNC_TPW
+                    vertical_sync   = 0 <= row < VGA_VSYNC_TPW
+
+                    vga_col = col - VGA_HSYNC_OFFSET
+                    vga_row = row - VGA_VSYNC_OFFSET
+                    yield
+
+    for row in range(0, VGA_VSYNC_TS):
+        for col in range(0, VGA_HSYNC_TS):
+            assert vga_timing.IO.pixel_valid.value == (VGA_VSYNC_OFFSET <= row <= VGA_VSYNC_OFFSET + VGA_NUM_ROWS and \
+                          VGA_HSYNC_OFFSET <= col <= VGA_HSYNC_OFFSET + VGA_NUM_COLS)
+
+            assert vga_timing.IO.horizontal_sync.value == (0 <= col < VGA_HSYNC_TPW)
+            assert vga_timing.IO.vertical_sync.value   == (0 <= row < VGA_VSYNC_TPW)
+
+            int2bits = lambda x: [int(n) for n in bin(x)[2:].zfill(10)]
+            if vga_timing.IO.pixel_valid.value:
+                assert vga_timing.IO.vga_col.value == int2bits(col - VGA_HSYNC_OFFSET)
+                assert vga_timing.IO.vga_row.value == int2bits(row - VGA_VSYNC_OFFSET)
+            next(vga_timing)
+
+
+def test_matches_python_backend():
+    import random
+
+    def make(mode):
+        @fsm(mode)
+        def uart(data : Input[8], signal : Input, tx : Output):
+            while True:
+                yield
+                if signal:
+                    tx = 0
+                    yield
+                    for i in range(0, 8):
+                        tx = data[i]
+                        yield
+                    tx = 1
+                    yield
+        return uart
+
+    python, pysim = make("python"), make("pysim")
+    random.seed(0)
+    for _ in range(200):
+        data, signal = random.randrange(256), random.randrange(2)
+        for uart in (python, pysim):
+            uart.IO.data.value = data
+            uart.IO.signal.value = signal
+            next(uart)
+        assert python.IO.tx.value == pysim.IO.tx.value
+
+
+def test_wrap_around():
+    def make(mode):
+        @fsm(mode)
+        def count(value : Output[4], odd : Output):
+            while True:
+                for i in range(0, 20):
+                    # Wider than the outputs
+                    value = i
+                    odd = i + 1
+                    yield
+        return count
+
+    python, pysim = make("python"), make("pysim")
+    values = []
+    for _ in range(50):
+        next(python)
+        next(pysim)
+        assert int(python.IO.value.value) == int(pysim.IO.value.value)
+        assert python.IO.odd.value == pysim.IO.odd.value
+        values.append(int(pysim.IO.value.value))
+    assert values[:20] == [i % 20 % 16 for i in range(1, 21)]
+
+
+def test_run():
+    import numpy as np
+
+    @fsm("pysim")
+    def uart(data : Input[8], signal : Input, tx : Output):
+        while True:
+            yield
+            if signal:
+                tx = 0  # start bit
+                yield
+                for i in range(0, 8):
+                    tx = data[i]
+                    yield
+                tx = 1  # end bit
+                yield
+
+    data = 0xBE
+    outputs = uart.run({"data": data, "signal": np.ones(10, int)})
+    expected = "0{0:b}1".format(data)
+    assert "".join(str(tx) for tx in outputs["tx"]) == expected
+
+
+def test_run_until():
+    def make():
+        @fsm("pysim")
+        def blink(start : Input, led : Output, count : Output[16]):
+            while True:
+                led = 0
+                while not start:
+                    yield
+                for i in range(0, 1000):
+                    led = 1
+                    count = i
+                    yield
+                yield from range(0, 500)
+
+        return blink
+
+    for cycles in [0, 1, 2, 3, 10, 999, 1000, 1001, 1500, 1502, 4000]:
+        for start in [0, 1]:
+            stepped, skipped = make(), make()
+            for blink in (stepped, skipped):
+                blink.IO.start.value = start
+                next(blink)
+            for _ in range(cycles):
+                next(stepped)
+            skipped.run_until(cycles)
+            assert stepped.IO.led.value == skipped.IO.led.value
+            assert stepped.IO.count.value == skipped.IO.count.value
+            # The next cycles match as well
+            for blink in (stepped, skipped):
+                blink.IO.start.value = 1 - start
+                next(blink)
+            assert stepped.IO.led.value == skipped.IO.led.value
+            assert stepped.IO.count.value == skipped.IO.count.value
+
+
+def test_run_until_skips_loops():
+    @fsm("pysim")
+    def delay(done : Output):
+        while True:
+            done = 0
+            yield from range(0, 10 ** 12)
+            done = 1
+            yield
+
+    delay.run_until(10 ** 12)
+    assert delay.IO.done.value == 1
+    assert "_skip" in delay.source
+
+
+def test_run_until_keeps_calls():
+    polls = []
+
+    @fsm("pysim")
+    def wait(go : Input, done : Output):
+        while True:
+            done = 0
+            while not go:
+                polls.append(go)
+                yield
+            done = 1
+            yield
+
+    # Loops with statements other than assignments are not skipped
+    wait.run_until(5)
+    assert len(polls) == 6
+
+
+def test_snapshot():
+    import pickle
+
+    @fsm("pysim")
+    def count(start : Input, value : Output[16]):
+        x = Register(16)
+        while True:
+            if start:
+                x = x + 1
+            value = x
+            yield
+
+    count.IO.start.value = 1
+    count.run_until(50)
+    snapshot = count.snapshot()
+    assert snapshot.state["x"] == 50
+    assert snapshot.cycle == 50
+
+    count.run_until(10)
+    assert int(count.IO.value.value) == 60
+
+    fork = count()
+    fork.restore(pickle.loads(pickle.dumps(snapshot)))
+    assert int(fork.IO.value.value) == 50
+    assert fork.IO.start.value == 1
+    fork.run_until(10)
+    assert int(fork.IO.value.value) == 60
+    assert fork.cycle == count.cycle
+    fork.IO.start.value = 0
+    next(fork)
+    assert int(fork.IO.value.value) == 60
+
+    count.restore(snapshot)
+    next(count)
+    assert int(count.IO.value.value) == 51
+
+    # Inputs are masked to the width of their port
+    snapshot.io["start"] = 2
+    count.restore(snapshot)
+    assert count.IO.start.value == 0
+
+
+def test_restore_held_output():
+    @fsm("pysim")
+    def latch(load : Input, data : Input[4], out : Output[4]):
+        while True:
+            if load:
+                out = data
+            yield
+
+    latch.IO.load.value = 1
+    latch.IO.data.value = 5
+    next(latch)
+    snapshot = latch.snapshot()
+    latch.IO.data.value = 9
+    next(latch)
+    assert int(latch.IO.out.value) == 9
+    # Cycles that do not assign the output hold the restored value
+    latch.restore(snapshot)
+    latch.IO.load.value = 0
+    latch.run_until(3)
+    assert int(latch.IO.out.value) == 5
+
+
+def read_vcd(text):
+    """
+    Returns a dict mapping each signal to a list of ``(time, value)``
+    """
+    names = {}
+    changes = {}
+    time = 0
+    for line in text.splitlines():
+        if line.startswith("$var"):
+            _, _, _, identifier, name, _ = line.split()
+            names[identifier] = name
+            changes[name] = []
+        elif line.startswith("#"):
+            time = int(line[1:])
+        elif line.startswith("b"):
+            value, identifier = line[1:].split()
+            changes[names[identifier]].append((time, int(value, 2)))
+        elif line and line[0] in "01" and line[1:] in names:
+            changes[names[line[1:]]].append((time, int(line[0])))
+    return changes
+
+
+def test_trace():
+    import io
+
+    @fsm("pysim")
+    def uart(data : Input[8], signal : Input, tx : Output):
+        while True:
+            yield
+            if signal:
+                tx = 0  # start bit
+                yield
+                for i in range(0, 8):
+                    tx = data[i]
+                    yield
+                tx = 1  # end bit
+                yield
+
+    uart.IO.data.value = 0xBE
+    uart.IO.signal.value = 1
+    next(uart)
+    vcd = io.StringIO()
+    tracer = uart.trace(vcd, chunk_size=4)
+    expected = [(uart.cycle, uart.IO.tx.value)]
+    for cycle in range(30):
+        if cycle < 20:
+            next(uart)
+        else:
+            uart.run_until(1)
+        expected.append((uart.cycle, uart.IO.tx.value))
+    # The generated function flushes the lines every chunk while running
+    assert len(tracer.lines) < 4 * 8
+    assert vcd.getvalue().count("#") > 20
+    uart.stop_trace()
+
+    changes = read_vcd(vcd.getvalue())
+    # Only the changes are written
+    expected = [change for i, change in enumerate(expected)
+                if i == 0 or change[1] != expected[i - 1][1]]
+    assert changes["tx"] == expected
+    assert changes["data"] == [(1, 0xBE)]
+    # ``i`` is 3 bits wide (see ``desugar_for_loops``), so its last
+    # increment wraps around
+    assert [value for _, value in changes["i"]][:10] == \
+        [0, 1, 2, 3, 4, 5, 6, 7, 0, 1]
+
+
+def test_coverage():
+    import pickle
+
+    @fsm("pysim", coverage=True)
+    def count(start : Input, stop : Input, value : Output[16]):
+        x = Register(16)
+        while True:
+            if start:
+                x = x + 1
+            elif stop:
+                x = 0
+            value = x
+            yield
+            yield from range(0, 100)
+
+    count.IO.start.value = 1
+    next(count)
+    count.IO.start.value = 0
+    count.run_until(500)
+    coverage = count.get_coverage()
+    assert coverage.counts.sum() == count.cycle + 1
+    # Counts the cycles skipped by ``run_until``
+    assert coverage.counts.max() > 400
+
+    report = coverage.report()
+    assert "states: 4/8 covered" in report
+    assert "branches: 6/10 covered" in report
+    assert "elif stop: never true (from yield 2)" in report
+    assert __file__ in report
+
+    other = count()
+    other.IO.stop.value = 1
+    other.run_until(200)
+    merged = pickle.loads(pickle.dumps(coverage)) + other.get_coverage()
+    assert merged.counts.sum() == coverage.counts.sum() + 201
+    assert "branches: 7/10 covered" in merged.report()
+
+    count.reset_coverage()
+    assert count.get_coverage().counts.sum() == 0
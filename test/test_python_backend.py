@@ -146,3 +146,151 @@ def test_vga():
                 assert vga_timing.IO.vga_col.value == int2bits(col - VGA_HSYNC_OFFSET)
                 assert vga_timing.IO.vga_row.value == int2bits(row - VGA_VSYNC_OFFSET)
             next(vga_timing)
+
+
+def test_run():
+    @fsm("python")
+    def uart(data : Input[8], signal : Input, tx : Output):
+        while True:
+            yield
+            if signal:
+                tx = 0  # start bit
+                yield
+                for i in range(0, 8):
+                    tx = data[i]
+                    yield
+                tx = 1  # end bit
+                yield
+
+    data = 0xBE
+    outputs = uart.run({"data": data, "signal": [1] * 10})
+    expected = "0{0:b}1".format(data)
+    assert "".join(str(tx) for tx in outputs["tx"]) == expected
+
+    import pytest
+    import itertools
+    for inputs in ({}, {"data": data, "signal": 1},
+                   {"data": data, "signal": itertools.repeat(1)}):
+        with pytest.raises(ValueError):
+            uart.run(inputs)
+    assert len(uart.run({}, cycles=5)["tx"]) == 5
+    # The lists bound the iterators
+    outputs = uart.run({"data": itertools.repeat(data), "signal": [1] * 3})
+    assert len(outputs["tx"]) == 3
+
+
+def test_stream():
+    import itertools
+    import numpy as np
+
+    @fsm("python")
+    def delay(a : Input, b : Output):
+        while True:
+            b = a
+            yield
+
+    chunks = list(delay.stream({"a": itertools.cycle([0, 1, 1])}, cycles=10,
+                               chunk_size=4))
+    assert [len(chunk["b"]) for chunk in chunks] == [4, 4, 2]
+    trace = np.concatenate([chunk["b"] for chunk in chunks])
+    assert list(trace) == [0, 1, 1] * 3 + [0]
+    # Inputs are masked to the width of their port
+    delay.run({"a": [3, 2]})
+    assert delay.IO.a.value == 0
+
+
+def test_bit_vector():
+    from silica.types import BitVector, Input_
+    bits = BitVector(0xB6, 8)
+    assert bits == [1, 0, 1, 1, 0, 1, 1, 0]
+    assert bits == 0xB6
+    assert bits[0] == 1 and bits[1] == 0 and bits[-1] == 0
+    assert bits[2:6] == [1, 1, 0, 1]
+    assert int(bits[2:6]) == 0b1101
+    assert bits[::2] == [1, 1, 0, 1]
+
+    port = Input_(4)
+    port.value = 0x1F  # masked to the width of the port
+    assert int(port.value) == 0xF
+    port.value = [0, 1, 1, 0]
+    assert port.value.as_int() == 6
+    assert port.value.as_list() == [0, 1, 1, 0]
+
+
+def test_instances():
+    @fsm("python")
+    def toggle(enable : Input, out : Output):
+        state = 0
+        while True:
+            if enable:
+                state = 1 - state
+            out = state
+            yield
+
+    first, second = toggle(), toggle()
+    first.IO.enable.value = 1
+    second.IO.enable.value = 0
+    for _ in range(3):
+        next(first)
+        next(second)
+    assert first.IO.out.value == 1
+    assert second.IO.out.value == 0
+    # The default instance is independent of the others
+    assert toggle.IO.out.value == 0
+    assert toggle.IO.enable is not first.IO.enable
+    # Generators can not be copied
+    assert not hasattr(first, "snapshot")
+
+
+def test_clock_enable():
+    @fsm("python", clock_enable=True)
+    def count(value : Output[8]):
+        x = 0
+        while True:
+            value = x
+            x = x + 1
+            yield
+
+    counter = count()
+    next(counter)
+    counter.IO.CE.value = 0
+    next(counter)
+    next(counter)
+    assert int(counter.IO.value.value) == 1
+    assert counter.cycle == 3
+
+    # Enabled on the cycles that are multiples of 103
+    counter.set_ce_schedule(103)
+    counter.run_until(103 * 10)
+    assert int(counter.IO.value.value) == 11
+    assert counter.cycle == 3 + 103 * 10
+
+    counter = count()
+    counter.set_ce_schedule([0, 5, 6, 100])
+    for _ in range(7):
+        next(counter)
+    assert int(counter.IO.value.value) == 3
+    counter.run_until(1000)
+    assert int(counter.IO.value.value) == 4
+
+
+def test_trace():
+    import io
+    from test_pysim_backend import read_vcd
+
+    @fsm("python")
+    def blink(led : Output):
+        while True:
+            for i in range(0, 3):
+                led = 1
+                yield
+            led = 0
+            yield
+
+    vcd = io.StringIO()
+    blink.trace(vcd)
+    blink.run_until(8)
+    blink.stop_trace()
+    changes = read_vcd(vcd.getvalue())
+    assert changes["led"] == [(0, 1), (3, 0), (4, 1), (7, 0), (8, 1)]
+    assert [value for _, value in changes["i"]] == [0, 1, 2, 0, 1, 2, 0]
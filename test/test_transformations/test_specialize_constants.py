@@ -15,6 +15,12 @@ def test1():
     assert astor.to_source(tree) == expected
 
 
+def test_store():
+    tree = ast.parse("x = x + 1")
+    tree = specialize_constants(tree, {"x": 100})
+    assert astor.to_source(tree).rstrip() == "x = 100 + 1"
+
+
 # def test_mul_by_0():
 #     tree = ast.parse("y * 0")
 #     tree = specialize_constants(tree, {"x": 100})